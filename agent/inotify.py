@@ -2,16 +2,95 @@
 # -*- coding: utf-8 -*-
 """
 This agent uses the Linux inotify subsystem to watch for filesystem changes and then send MCP events.
+
+Raw inotify records are not sent as events. A file being written produces many records (CREATE, MODIFY, CLOSE_WRITE),
+they are collected per path until the path has been quiet for 'quiet' seconds, then one 'ready' or 'removed' event
+is sent for it. A file is ready once it was closed after writing (CLOSE_WRITE) or moved in (MOVED_TO), a file that is
+still open when it goes quiet is reported when it is closed. A file created and removed within the quiet period is
+not reported. When 'batch' or more files
+become ready or removed at once, one event listing all of their paths is sent instead of an event for each.
+
+With 'recursive' (the default) every directory below a watched path is watched too. New directories are watched
+as they appear, including any files already in them, and the watches of removed directories are released.
+Watches are indexed by watch descriptor, so the path of each record is found with one lookup.
+Paths can be watched and unwatched at runtime with 'addWatch' and 'removeWatch' message events, the path in the
+event data. The number of watches is checked against the system limit, fs.inotify.max_user_watches.
+
+In the mcp the inotify descriptor is served by the shared event loop (lib.eventloop), the agent has no thread of its own.
+Run without an event loop, such as in an agent process, it reads on its own thread.
 """
+import os
+import errno
 import logging
 import threading
+from collections import OrderedDict
+from time import time
 
 from inotify_simple import INotify, flags
 
-import lib.event
+from lib.event import event
+from lib.eventloop import getloop
 
 logger = logging.getLogger(__name__)
 
+FLAGS = ['CREATE', 'DELETE', 'CLOSE_WRITE', 'MOVED_TO', 'MOVED_FROM', 'DELETE_SELF']
+QUIET = 2
+BATCH = 10
+MAXWATCHES = '/proc/sys/fs/inotify/max_user_watches'
+# warn when this share of the system watch limit is used
+WATCHWARN = 0.8
+
+"""
+    Collects inotify records per path and reports each path once it has been quiet for quiet seconds.
+"""
+class debouncer:
+    def __init__(self, quiet = QUIET):
+        self.quiet = quiet
+        # path -> [last record time, action, created], ordered by last record time
+        self.pending = OrderedDict()
+        self.records = 0
+
+    """ Add a record for path, action is 'ready', 'removed' or None for a file still being written.
+        created tells the record is the file appearing, CREATE or MOVED_TO.
+    """
+    def add(self, path, action, now = None, created = False):
+        if now is None: now = time()
+        self.records += 1
+        entry = self.pending.pop(path, None)
+        if entry is None:
+            entry = [now, action, created]
+        else:
+            entry[0] = now
+            # a removed file written again is reported removed until it is closed
+            if action is not None or entry[1] != 'removed':
+                entry[1] = action
+        self.pending[path] = entry
+
+    """ Return the seconds until the next path is due, None if no paths are pending """
+    def due(self, now = None):
+        if not self.pending:
+            return None
+        if now is None: now = time()
+        return max(next(self.pending.itervalues())[0] + self.quiet - now, 0)
+
+    """ Remove the paths that have been quiet for long enough, returns a list of (path, action) """
+    def expired(self, now = None):
+        if now is None: now = time()
+        done = list()
+        while self.pending:
+            path, entry = next(self.pending.iteritems())
+            if entry[0] + self.quiet > now:
+                break
+            del self.pending[path]
+            # created and removed again within the quiet period, there is nothing to report
+            if entry[1] == 'removed' and entry[2]:
+                continue
+            # still open for writing, it is reported when it is closed
+            if entry[1] is None:
+                continue
+            done.append((path, entry[1]))
+        return done
+
 class inotify:
     def __init__(self, config, state, eventcallback):
         self.config  = config
@@ -19,19 +98,38 @@ class inotify:
         # register messsage handler
         self.eventcallback = eventcallback
         self.run = True
-        
+        self.recursive = config.get('recursive', True)
+        # watch descriptor -> path and path -> watch descriptor
+        self.watches = dict()
+        self.paths = dict()
+        self.lock = threading.Lock()
+        self.limit = self.watchlimit()
+        self.warned = False
+        self.full = False
+        self.inotify = INotify()
+        self.mask = self.watchflags()
+        if self.recursive:
+            # new and removed directories must be seen to keep the watches up to date
+            self.mask |= flags.CREATE | flags.MOVED_TO | flags.DELETE | flags.MOVED_FROM
+        self.debouncer = debouncer(config.get('quiet', QUIET))
+        self.batch = config.get('batch', BATCH)
+        self.sent = 0
+
         # id, event = '', type = 'message', agent = '', user = '', data = dict()
         # subscribe to shutdown event
-        eventcallback(lib.event.event('shutdown', '', 'subscribe', 'shutdown'))
+        eventcallback(event('shutdown', '', 'subscribe', 'shutdown'))
         # subscribe to inotify_INSTANCEID events
-        eventcallback(lib.event.event(config['instanceid'], '', 'subscribe', 'ALL'))
+        eventcallback(event(config['instanceid'], '', 'subscribe', 'ALL'))
         #self.client.RegisterHandler('message', self.receive)
         self.daemonizeit()
 
     def shutdown(self):
         logger.debug("Shutdown called")
         self.run = False
-        logger.info("Shutdown complete")
+        if self.loop is not None:
+            self.loop.call_soon(self.stop)
+        logger.info("Shutdown complete - watches: %i records: %i events sent: %i", len(self.watches),
+                    self.debouncer.records, self.sent)
 
     def eventhandler(self, event):
         logger.debug("Eventhandler - event: %s", event.dump())
@@ -40,42 +138,226 @@ class inotify:
             self.shutdown()
         elif event.eventtype() == 'message':
             logger.debug("Got message event")
-            # FIXME:
-            # add ability to watch or stop watching
+            path = event.eventdata().get('path')
+            if event.eventbody() == 'addWatch' and path:
+                self.addwatch(path)
+            elif event.eventbody() == 'removeWatch' and path:
+                self.removewatch(path)
 
-    def setupandloop(self):
-        self.inotify = INotify()
-        # FIXME: make flags configuratble
-        watch_flags = flags.CREATE | flags.DELETE | flags.CLOSE_WRITE | flags.DELETE_SELF
-        #watch_flags = flags.CREATE | flags.DELETE | flags.MODIFY | flags.CLOSE_WRITE | flags.DELETE_SELF
+    """ Return the inotify watch mask for the configured flag names """
+    def watchflags(self):
+        mask = 0
+        for name in self.config.get('flags', FLAGS):
+            try:
+                mask |= getattr(flags, name.upper())
+            except AttributeError:
+                logger.error("Unknown inotify flag '%s', ignoring", name)
+        return mask
+
+    """ Return the system limit of inotify watches per user, None if it is not known """
+    def watchlimit(self):
+        try:
+            with open(MAXWATCHES) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    """ Watch path, and the directories below it when recursive, returns the number of watches added.
+        With report, files already in the directories are reported as ready, they may have been written
+        before the watch was added.
+    """
+    def addwatch(self, path, report = False):
+        path = path.rstrip(os.sep) or os.sep
+        added = 0
+        with self.lock:
+            if not self.recursive or not os.path.isdir(path):
+                return self.add(path)
+            for top, dirs, files in os.walk(path):
+                if top in self.paths:
+                    continue
+                added += self.add(top)
+                if self.full:
+                    # out of watches, the rest of the tree would fail too
+                    break
+                if report:
+                    for name in files:
+                        self.debouncer.add(os.path.join(top, name), 'ready')
+        logger.debug("Watching %s - watches added: %i total: %i", path, added, len(self.watches))
+        return added
+
+    """ Add one watch, returns 1 if it was added, called with the lock held """
+    def add(self, path):
+        try:
+            wd = self.inotify.add_watch(path, self.mask)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                self.full = True
+                logger.error("Out of inotify watches (limit %s), not watching %s", self.limit, path)
+                self.send('watch limit reached, not watching {}'.format(path), {'action': 'watchlimit', 'path': path},
+                          'high')
+            else:
+                logger.error("Cannot watch %s: %s", path, e)
+            return 0
+        self.watches[wd] = path
+        self.paths[path] = wd
+        if self.limit and not self.warned and len(self.watches) > self.limit * WATCHWARN:
+            self.warned = True
+            logger.warning("Using %i of %i inotify watches, raise fs.inotify.max_user_watches", len(self.watches), self.limit)
+        return 1
+
+    """ Stop watching path and the directories below it, returns the number of watches removed """
+    def removewatch(self, path):
+        path = path.rstrip(os.sep) or os.sep
+        prefix = path if path.endswith(os.sep) else path + os.sep
+        with self.lock:
+            wds = [ wd for p, wd in self.paths.iteritems() if p == path or p.startswith(prefix) ]
+            for wd in wds:
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    # already removed by the kernel
+                    pass
+                self.forget(wd)
+        logger.debug("Unwatched %s - watches removed: %i total: %i", path, len(wds), len(self.watches))
+        return len(wds)
+
+    """ Drop a released watch from the index, called with the lock held """
+    def forget(self, wd):
+        path = self.watches.pop(wd, None)
+        if path is not None:
+            # a watch was released, new ones can be added again
+            self.full = False
+            if self.paths.get(path) == wd:
+                del self.paths[path]
+
+    def setup(self):
         for i in self.config['watch']:
             logging.debug('Watching: %s', i)
-            wd = self.inotify.add_watch(i, watch_flags)
+            self.addwatch(i)
+
+    """ Read the records ready on the inotify descriptor, runs on the event loop thread """
+    def readable(self):
+        for ievent in self.inotify.read(timeout=0):
+            self.record(ievent)
+        self.flush()
+        self.schedule()
+
+    """ Flush again when the next pending path is due, on the event loop """
+    def schedule(self):
+        due = self.debouncer.due()
+        if due is not None and not self.scheduled:
+            self.scheduled = True
+            self.loop.call_later(due, self.tick)
+
+    def tick(self):
+        self.scheduled = False
+        self.flush()
+        self.schedule()
+
+    """ Stop reading and report what is pending, on the event loop """
+    def stop(self):
+        self.loop.remove_reader(self.inotify.fileno())
+        self.flush(float('inf'))
 
+    def setupandloop(self):
+        self.setup()
         # loop while run is True
         while self.run:
-            # wait for events for 1 second
-            for event in self.inotify.read(timeout=1000):
-                print(event)
-                # FIXME
-                # id, event = '', type = 'message', ageent = '', user = ''
-                self.eventcallback(lib.event.event(self.config['instanceid'], event, 'message', '', '', {'flags': str(flags.from_mask(event.mask)), 'event': event}))
-                #for flag in flags.from_mask(event.mask):
+            # wait for events for 1 second, or until the next pending path is due
+            due = self.debouncer.due()
+            timeout = 1000 if due is None else min(int(due * 1000) + 1, 1000)
+            for ievent in self.inotify.read(timeout=timeout):
+                self.record(ievent)
+            self.flush()
+        # report what is pending before stopping
+        self.flush(float('inf'))
+
+    """ Keep the watches up to date and pass file records to the debouncer """
+    def record(self, ievent):
+        if ievent.mask & flags.IGNORED:
+            # the watch is gone, removed or its directory deleted
+            with self.lock:
+                self.forget(ievent.wd)
+            return
+        directory = self.watches.get(ievent.wd)
+        if directory is None:
+            return
+        if ievent.mask & flags.DELETE_SELF:
+            if directory in self.config['watch'] or directory + os.sep in self.config['watch']:
+                logger.warning("Watched path removed: %s", directory)
+            return
+        path = os.path.join(directory, ievent.name)
+        if ievent.mask & flags.ISDIR:
+            if not self.recursive:
+                return
+            if ievent.mask & (flags.CREATE | flags.MOVED_TO):
+                self.addwatch(path, True)
+            elif ievent.mask & flags.MOVED_FROM:
+                self.removewatch(path)
+            # a deleted directory's watches are released by the kernel, see IGNORED
+            return
+        if ievent.mask & (flags.DELETE | flags.MOVED_FROM):
+            self.debouncer.add(path, 'removed')
+        elif ievent.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+            self.debouncer.add(path, 'ready', created=bool(ievent.mask & flags.MOVED_TO))
+        else:
+            self.debouncer.add(path, None, created=bool(ievent.mask & flags.CREATE))
+
+    """ Send events for the paths that have been quiet for long enough """
+    def flush(self, now = None):
+        done = self.debouncer.expired(now)
+        if not done:
+            return
+        for action in ('ready', 'removed'):
+            paths = [ path for path, a in done if a == action ]
+            if not paths:
+                continue
+            if len(paths) >= self.batch:
+                self.send('{} files {}'.format(len(paths), action), {'action': action, 'paths': paths})
+            else:
+                for path in paths:
+                    self.send('{} {}'.format(path, action), {'action': action, 'path': path})
+
+    def send(self, body, data, priority = None):
+        self.sent += 1
+        # id, event = '', type = 'message', agent = '', user = '', data = dict()
+        self.eventcallback(event(self.config['instanceid'], body, 'message', '', '', data, priority=priority))
 
     def daemonizeit(self):
+        self.loop = getloop()
+        if self.loop is not None:
+            self.scheduled = False
+            self.setup()
+            self.loop.add_reader(self.inotify.fileno(), self.readable)
+            return
         self.thread = threading.Thread(name=self.config['instanceid'], target=self.setupandloop)
         self.thread.setDaemon(False)
         self.thread.start()
 
-    # FIXME: add method to add watching
-    # FIXME: add method to remove watching
-
 
 ### Main ###
 if __name__ == "__main__":
+    import sys
     logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
                             datefmt='%Y/%m/%d-%H:%M:%S', level=logging.DEBUG)
 
+    # benchmark: python -m agent.inotify --benchmark, records of a burst of camera clips through the debouncer
+    if '--benchmark' in sys.argv:
+        d = debouncer(2)
+        clips, modifies = 500, 200
+        start = time()
+        for c in range(clips):
+            path = '/cameras/camera1/clip{:04d}.mp4'.format(c)
+            d.add(path, None, c * 0.01, True)
+            for m in range(modifies):
+                d.add(path, None, c * 0.01 + m * 0.001)
+            d.add(path, 'ready', c * 0.01 + modifies * 0.001)
+        ready = len(d.expired(clips * 0.01 + 3))
+        events = 1 if ready >= BATCH else ready
+        print '{} records in {:.1f} ms, {} paths ready, sent as {} events ({:.0f}x fewer than records)'.format(
+            d.records, (time() - start) * 1000, ready, events, float(d.records) / events)
+        sys.exit(0)
+
     def dummycallback(event):
         logger.debug('Received message: %s', event.eventbody())
 
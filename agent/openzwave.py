@@ -6,14 +6,38 @@ This agent uses the python-openzwave library to connect to a USB Zwave controlle
 
 from lib.event import event
 from lib.timetools import howlongago
+from agent.openzwave_store import store
+from agent.openzwave_history import history
+from agent.openzwave_queue import sendqueue
+from agent.openzwave_filter import valuefilter
+from agent.openzwave_poll import poller
+from agent.openzwave_status import statusview
 
 from libopenzwave import PyManager, PyOptions
 from time import time
+from functools import partial
 from logging import getLogger
-from yaml import dump
 
 # Global Variables
 logger = getLogger(__name__)
+# value notifications that are filtered and coalesced, the others are always emitted
+FILTERED = ('ValueChanged', 'ValueRefreshed')
+
+""" Return the text of a notification event from its data """
+def message(data):
+    msg = data['node'] + ': ' + str(data['notificationType'])
+    if data.get('label') is not None:
+        msg += ' ' + data['label'] + ' ='
+    if 'value' in data:
+        msg += ' ' + str(data['value'])
+    if 'units' in data:
+        msg += ' ' + str(data['units'])
+    if data.get('readonly'):
+        msg += ' (ReadOnly)'
+    for key in ('notificationCode', 'event', 'groupIdx'):
+        if key in data:
+            msg += ' {} = {}'.format(key, data[key])
+    return msg
 
 # FIXME: These are command definitions that enable sending events, commands through XMPP for example, and making things happen in the Zwave network, such as turning lights on or off. These commands below are specific to certain nodes in my Zwave network so for them to work on a nother network the commands will need to be modified. These should be moved to a file that contains user logic.
 COMMANDS = { 
@@ -134,15 +158,41 @@ COMMANDS = {
                                                 'handlerevent' : { 'id': 'openzwave', 'event': 'isNodeFailed',
                                                                     'data': { 'nodeid': 8 }}},
                                                                    #'data': { 'node': 'Dimmer - Livingroom' }}},
-                            },           
+                            },
+             'history'    : { 'description'  : 'Show the history of a value: history NODE LABEL [HOURS]',
+                              'authorized'   : 'ALL',
+                              'handlerevent' : { 'id': 'openzwave', 'event': 'getHistory' }},           
+             'zwavequeue' : { 'description'  : 'Show the Zwave send queue depth and latency',
+                              'authorized'   : 'ALL',
+                              'handlerevent' : { 'id': 'openzwave', 'event': 'getQueueStats' }},
+             'zwavestatus': { 'description'  : 'Show the status of Zwave nodes: zwavestatus [NODE ...]',
+                              'authorized'   : 'ALL',
+                              'handlerevent' : { 'id': 'openzwave', 'event': 'getStatus' }},
+             'zwavepoll'  : { 'description'  : 'Show the Zwave values polled and their poll intervals',
+                              'authorized'   : 'ALL',
+                              'handlerevent' : { 'id': 'openzwave', 'event': 'getPollStats' }},
            }
 
 class openzwave:
     def __init__(self, config, state, eventcallback):
-        self.nodes = config['nodes'] 
-        self.byname = dict()
+        # nodes are kept in the agent state, so a warm restart starts with the names, values and labels already known
+        self.store = store(state.setdefault('nodes', dict()), config.get('nodes', {}))
+        # numeric values are recorded in the history when it is enabled
+        self.history = None
+        if config.get('history', {}).get('enabled'):
+            self.history = history(config['history'])
         self.config = config
         self.receiver = eventcallback
+        # value writes are coalesced per valueId and paced to the rate the network can carry
+        self.queue = sendqueue(self.sendvalue, config.get('queue', {}))
+        self.filter = valuefilter(config.get('filter', {}), config.get('nodes', {}), self.release)
+        # values that do not report by themselves are polled when polling is enabled
+        self.poller = None
+        if config.get('poll', {}).get('enabled'):
+            self.poller = poller(config['poll'], config.get('nodes', {}), self.refreshvalue, self.nodestate)
+        self.homeid = None
+        # status replies come from rows rendered when a node changes, statistics are refreshed every 'ttl' seconds
+        self.status = statusview(self.store, self.nodestatistics, config.get('status', {}))
 
         zopts = { 'user_path': '.', 'cmd_line': '--logging false' }
         if self.config.has_key('config_path'):
@@ -166,8 +216,15 @@ class openzwave:
     def shutdown(self):
         logger.debug('Shutdown: Remove watcher')
         self.manager.removeWatcher(self.callback)
+        if self.poller is not None:
+            self.poller.stop()
+        self.status.stop()
+        logger.debug('Shutdown: Send queued values')
+        self.queue.stop()
         logger.debug('Shutdown: Remove device')
         self.manager.removeDriver(self.config['device'])
+        if self.history is not None:
+            self.history.close()
         logger.info('Shutdown Complete')
 
 
@@ -187,6 +244,9 @@ class openzwave:
                 logger.debug("getNodeName node id '%i' name is '%s'", data['nodeid'], name)
             if event.eventbody() == 'setNodeName':
                 self.manager.setNodeName(self.homeid, data['nodeid'], data['name'])
+                if data['nodeid'] in self.store.nodes:
+                    self.store.rename(self.store.nodes[data['nodeid']], data['name'])
+                    self.status.touch(data['nodeid'])
                 logger.debug("setNodeName setting node id '%i' name to '%s'", data['nodeid'], data['name'])
             if event.eventbody() == 'getNodeLocation':
                 location = self.manager.getNodeLocation(self.homeid, data['nodeid'])
@@ -201,16 +261,21 @@ class openzwave:
                 self.manager.setNodeOff(self.homeid, data['nodeid'])
                 logger.debug("setNodeOff turning off node id %i", data['nodeid'])
             if event.eventbody() == 'setValue':
-                logger.debug("setValue node name '%s' = '%s'", data['node'], self.byname[data['node']])
-                logger.debug("setValue '%s'", str(self.byname[data['node']]['bylabel'][data['name']]))
-                self.manager.setValue(self.byname[data['node']]['bylabel'][data['name']]['id'], data['value'])
+                value = self.store.lookup(data['node'], data['name'])
+                if value is None:
+                    logger.error("setValue node '%s' has no value '%s'", data['node'], data['name'])
+                else:
+                    logger.debug("setValue '%s' = '%s'", value, data['value'])
+                    # writes from user commands go before scheduled ones
+                    self.queue.put(value.id, value.nodeid, data['value'],
+                                   interactive=event.eventpriority() in ('high', 'critical'))
             if event.eventbody() == 'requestAllConfigParams': 
                 logger.debug("Requesting All Config Params")
                 self.manager.requestAllConfigParams(self.homeid, data['nodeid'])
             if event.eventbody() == 'getNodeStatistics': 
-                logger.debug("Requesting Node Statistics")
-                stats = self.manager.getNodeStatistics(self.homeid, data['nodeid'])
-                logger.debug(dump(stats, default_flow_style=False))
+                self.getstats(event)
+            if event.eventbody() == 'getStatus':
+                self.getstatus(event)
             if event.eventbody() == 'isNodeAwake': 
                 logger.debug("Requesting if node is awake")
                 ret = self.manager.isNodeAwake(self.homeid, data['nodeid'])
@@ -221,8 +286,154 @@ class openzwave:
                 ret = self.manager.isNodeFailed(self.homeid, data['nodeid'])
                 if ret: logger.debug("Node is Failed")
                 else: logger.debug("Node is Not Failed")
+            if event.eventbody() == 'getHistory':
+                self.gethistory(event)
+            if event.eventbody() == 'getQueueStats':
+                self.getqueuestats(event)
+            if event.eventbody() == 'watchValue':
+                value = self.store.lookup(data.get('node'), data.get('name'))
+                if value is None or self.poller is None or not self.poller.watch(value.id, data.get('seconds', 300)):
+                    logger.debug("watchValue node '%s' value '%s' is not polled", data.get('node'), data.get('name'))
+            if event.eventbody() == 'getPollStats':
+                self.getpollstats(event)
         #elif event.eventtype() == 'message' and len(event.eventuser()):
 
+    """ Find the value and hours of a history command, the words are NODE LABEL [HOURS] and names may have spaces.
+        Returns (value, hours) or (None, error message).
+    """
+    def historyargs(self, words):
+        hours = 24
+        if len(words) > 2:
+            try:
+                hours = float(words[-1])
+                words = words[:-1]
+            except ValueError:
+                pass
+        text = ' '.join(words).lower()
+        for node in self.store.nodes.values():
+            if not text.startswith(node.name.lower() +' '):
+                continue
+            label = text[len(node.name) + 1:]
+            for name, value in node.bylabel.items():
+                if name.lower() == label:
+                    return value, hours
+            return None, "Node '{}' has no value '{}', values: {}".format(node.name, label, ', '.join(sorted(node.bylabel)))
+        return None, "No node found, the command is: history NODE LABEL [HOURS]"
+
+    """ Reply with the aggregate history of a value, to the command's user or as an openzwave event.
+        The event data gives the node and value name, or the command args, and 'hours' or 'start' and 'end'.
+        With 'series' the readings are included in the reply data.
+    """
+    def gethistory(self, request):
+        data = request.eventdata()
+        hours = data.get('hours', 24)
+        if self.history is None:
+            value, msg = None, 'The openzwave history is not enabled'
+        elif 'args' in data:
+            value, hours = self.historyargs(data['args'])
+            msg = hours
+        else:
+            value = self.store.lookup(data.get('node'), data.get('name'))
+            msg = "No value '{}' for node '{}'".format(data.get('name'), data.get('node'))
+        reply = dict()
+        if value is not None:
+            end = data.get('end', time())
+            start = data.get('start', end - hours * 3600)
+            agg = self.history.aggregate(value.id, start, end)
+            name = "{} {}".format(self.store.nodes[value.nodeid].name, value.label)
+            period = "{:.4g} hours".format((end - start) / 3600.0)
+            if agg is None:
+                msg = "No history for {} in the last {}".format(name, period)
+            else:
+                msg = "{} in the last {}: {} {} ({}), min {:.1f} max {:.1f} mean {:.1f}, last {:.1f} ({:+.1f}) {}".format(
+                    name, period, agg['count'], 'readings' if agg['tier'] == 'raw' else 'buckets', agg['tier'], agg['min'], agg['max'], agg['mean'], agg['last'],
+                    agg['change'], value.units)
+            reply = {'valueid': value.id, 'history': agg}
+            if data.get('series'):
+                reply['series'] = self.history.series(value.id, start, end)[1]
+        self.receiver(event(data.get('returnid', 'openzwave'), msg, user=request.eventuser(), data=reply, priority='high'))
+
+    def sendvalue(self, valueid, value):
+        self.manager.setValue(valueid, value)
+
+    def refreshvalue(self, valueid):
+        self.manager.refreshValue(valueid)
+
+    """ Return 'awake', 'asleep' or 'failed' for a node, nodes are asleep until the driver is ready """
+    def nodestate(self, nodeid):
+        if self.homeid is None:
+            return 'asleep'
+        if self.manager.isNodeFailed(self.homeid, nodeid):
+            return 'failed'
+        if not self.manager.isNodeAwake(self.homeid, nodeid):
+            return 'asleep'
+        return 'awake'
+
+    def nodestatistics(self, nodeid):
+        if self.homeid is None:
+            return None
+        return self.manager.getNodeStatistics(self.homeid, nodeid)
+
+    """ Reply with the statistics of a node from the status view, as last refreshed """
+    def getstats(self, request):
+        data = request.eventdata()
+        stats, refreshed = self.status.nodestats(data['nodeid'])
+        node = self.store.nodes.get(data['nodeid'])
+        name = node.name if node is not None else 'Node {}'.format(data['nodeid'])
+        if stats is None:
+            msg = "No statistics for {} yet".format(name)
+        else:
+            msg = "{} statistics: {}, refreshed {} ago".format(name, self.status.statstext(stats), howlongago(refreshed))
+        logger.debug(msg)
+        self.receiver(event(data.get('returnid', 'openzwave'), msg, user=request.eventuser(),
+                            data={'nodeid': data['nodeid'], 'statistics': stats, 'refreshed': refreshed}, priority='high'))
+
+    """ Reply with the status of the nodes named or numbered in the command args, or of every node """
+    def getstatus(self, request):
+        data = request.eventdata()
+        words = data.get('args') or list()
+        nodes = [ self.getNode(' '.join(words)) ] if words else list()
+        if words and nodes[0] is None:
+            nodes = [ self.getNode(word) for word in words ]
+        if None in nodes:
+            msg = "No node '{}', the command is: zwavestatus [NODE ...]".format(' '.join(words))
+        else:
+            msg = self.dumpnode([ n.id for n in nodes ])
+        self.receiver(event(data.get('returnid', 'openzwave'), msg, user=request.eventuser(), priority='high'))
+
+    """ Keep the poller up to date with a value notification, changed tells if a reading changed the value """
+    def polling(self, notification, value, commandclass, changed, now):
+        if notification == 'ValueRemoved':
+            self.poller.remove(value.id)
+            return
+        self.poller.add(value, commandclass)
+        if notification in FILTERED:
+            self.poller.reading(value.id, changed, now)
+
+    """ Reply with the values polled, the polls sent, skipped and deferred and the poll intervals """
+    def getpollstats(self, request):
+        data = request.eventdata()
+        if self.poller is None:
+            stats, msg = dict(), 'Zwave polling is not enabled'
+        else:
+            stats = self.poller.stats()
+            msg = "Zwave polling: {} values, {} polls sent, {} skipped for asleep or failed nodes, {} deferred by the budget".format(
+                stats['values'], stats['polls'], stats['asleep'], stats['deferred'])
+            if stats['values']:
+                msg += ", intervals {:.0f} to {:.0f} s, mean {:.0f} s".format(stats['min'], stats['max'], stats['mean'])
+        self.receiver(event(data.get('returnid', 'openzwave'), msg, user=request.eventuser(), data=stats, priority='high'))
+
+    """ Reply with the send queue depth, writes sent and coalesced and the latency from write to send """
+    def getqueuestats(self, request):
+        data = request.eventdata()
+        stats = self.queue.stats()
+        msg = "Zwave queue: {} interactive and {} scheduled writes queued, {} sent, {} coalesced".format(
+            stats['depth']['interactive'], stats['depth']['scheduled'], stats['sent'], stats['coalesced'])
+        for cls, latency in sorted(stats['latency'].items()):
+            if latency['mean'] is not None:
+                msg += ", {} latency {:.2f}s mean {:.2f}s max".format(cls, latency['mean'], latency['max'])
+        self.receiver(event(data.get('returnid', 'openzwave'), msg, user=request.eventuser(), data=stats, priority='high'))
+
 
     # convert C to F
     def convertCtoF(self, c):
@@ -233,70 +444,75 @@ class openzwave:
     # example args
     #    {'homeId': 25480663, 'valueId': {'index': 1, 'units': u'F', 'type': 'Decimal', 'nodeId': 2, 'value': 76.5, 'commandClass': 'COMMAND_CLASS_SENSOR_MULTILEVEL', 'instance': 1, 'readOnly': True, 'homeId': 25480663, 'label': u'Temperature', 'genre': 'User', 'id': 72057594076479506L}, 'notificationType': 'ValueChanged', 'nodeId': 2}
     def callback(self, args):
-        msg = ''
         if not args:
             logger.warning('Callback args are undefined')
             return
         
-        nodeid = args['nodeId']
-        try: #if self.nodes.has_key(nodeid): 
-            nodename = self.nodes[nodeid]['name']
-            self.nodes[nodeid]['lastseen'] = time()
-        except KeyError: 
-            nodename = 'Node '+ str(nodeid)
-            self.nodes[nodeid] = { 'name': nodename, 'lastseen': time() }
-        try: self.nodes[nodeid]['values']
-        except KeyError:
-            self.nodes[nodeid]['values'] = dict()
-        try: self.nodes[nodeid]['bylabel']
-        except KeyError:
-            self.nodes[nodeid]['bylabel'] = dict()
-            
-        if nodename not in self.byname:
-            self.byname[nodename] = self.nodes[nodeid]
-
-        msg = nodename + ': ' + str(args['notificationType'])
-        if 'valueId' in args:
-            v = args['valueId']
-            #print('valueID: {}'.format(v['id']))
-            if not self.nodes[nodeid]['values'].has_key(v['id']):
-                self.nodes[nodeid]['values'][v['id']] = { 'id': v['id'] }  
-            if v.has_key('label'):
-                self.nodes[nodeid]['values'][v['id']]['label'] = v['label']
-                msg += ' ' + v['label'] + ' ='
-                if not self.nodes[nodeid]['bylabel'].has_key(v['label']):
-                    self.nodes[nodeid]['bylabel'][v['label']] = self.nodes[nodeid]['values'][v['id']]  
-            if v.has_key('value'):
-                self.nodes[nodeid]['values'][v['id']]['value'] = v['value']
-                if self.config['convertctof'] == True and v['units'].lower() == 'c':
-                    v['value'] = self.convertCtoF(v['value']) 
-                    self.nodes[nodeid]['values'][v['id']]['value'] = v['value']
-                    v['units'] = 'F'
-                msg += ' ' + str(v['value'])
-            else: self.nodes[nodeid]['values'][v['id']]['value'] = ''
-            try: 
-                self.nodes[nodeid]['values'][v['id']]['units'] = v['units']
-                msg += ' ' + str(v['units'])
-            except KeyError: self.nodes[nodeid]['values'][v['id']]['units'] = ''
-            if v.get('readOnly'):
-                self.nodes[nodeid]['values'][v['id']]['readonly'] = True 
-                msg += ' (ReadOnly)'
-            else: 
-                self.nodes[nodeid]['values'][v['id']]['readonly'] = False
-            self.nodes[nodeid]['values'][v['id']]['updated'] = time()
-     
-        if args['notificationType'] == 'Notification': 
-            msg += ' notificationCode = '+ str(args['notificationCode'])
-        if args['notificationType'] == 'NodeEvent':
-            msg += ' event = '+ str(args['event']) 
-        if args['notificationType'] == 'Group':
-            msg += ' groupIdx = '+ str(args['groupIdx'])
+        now = time()
+        notification = args['notificationType']
+        node = self.store.node(args['nodeId'], now)
+        data = {'notificationType': notification, 'nodeId': node.id, 'node': node.name}
+        v = args.get('valueId')
+        if v is not None:
+            if 'value' in v and self.config['convertctof'] == True and v.get('units', '').lower() == 'c':
+                v['value'] = self.convertCtoF(v['value'])
+                v['units'] = 'F'
+            # whether the reading changed the value, for the poller, whatever the filter emits
+            previous = self.store.values.get(v['id'])
+            changed = previous is not None and 'value' in v and previous.value != v['value']
+            value = self.store.update(node, v, now)
+            self.status.touch(node.id)
+            if self.history is not None and 'value' in v:
+                self.history.record(value.id, value.value, now)
+            emit, old = True, None
+            if 'value' in v:
+                # unchanged values, and changes within the deadband or interval of the value, are not emitted
+                emit, old = self.filter.accept(value, v.get('commandClass'), now, notification not in FILTERED)
+            if self.poller is not None:
+                self.polling(notification, value, v.get('commandClass'), changed, now)
+            if not emit:
+                return
+            self.valuedata(data, value, old, v)
+        else:
+            self.status.touch(node.id)
+        for key in ('notificationCode', 'event', 'groupIdx'):
+            if key in args:
+                data[key] = args[key]
                 
         # {'homeId': 25480663, 'notificationType': 'DriverReady', 'nodeId': 1}
-        if args['notificationType'] == 'DriverReady' and args['nodeId'] == 1:
+        if notification == 'DriverReady' and args['nodeId'] == 1:
             self.homeid = args['homeId'] 
             logger.debug("DriverReady - homeId: %i", args['homeId'])
-        self.receiver(event('openzwave', msg))
+        if notification in ('AllNodesQueried', 'AllNodesQueriedSomeDead'):
+            self.status.refresh()
+        self.notify(data)
+
+    """ Add the fields of a value to the event data, the fields the notification's valueId has """
+    def valuedata(self, data, value, old, v = None):
+        data['valueId'] = value.id
+        data['label'] = value.label
+        if v is None or 'value' in v:
+            data['value'] = value.value
+            data['old'] = old
+        if v is None or 'units' in v:
+            data['units'] = value.units
+        data['readonly'] = value.readonly
+
+    """ Emit a change the filter held back """
+    def release(self, value, old):
+        node = self.store.nodes[value.nodeid]
+        data = {'notificationType': 'ValueChanged', 'nodeId': node.id, 'node': node.name}
+        self.valuedata(data, value, old)
+        self.notify(data)
+
+    def notify(self, data):
+        # notifications are background traffic, keep them behind interactive events
+        # value updates still queued when a newer one for the same value arrives are superseded
+        coalesce = None
+        if self.config.get('coalesce', True) and data['notificationType'] in FILTERED and 'valueId' in data:
+            coalesce = data['valueId']
+        # the text is only rendered if a subscriber reads the event body
+        self.receiver(event('openzwave', partial(message, data), data=data, priority='low', coalesce=coalesce))
 
     def nodeList(self, args):
         nodeType = args['words'][0]
@@ -327,45 +543,21 @@ class openzwave:
         return "Command setLock {}".format(state)
 
     def getNode(self, node):
-        if node.isdigit() and int(node) in NODES:
+        if node.isdigit() and int(node) in self.store.nodes:
             logger.debug("Found node by node number!")
-            return NODES[int(node)]
-        for n in NODES.values():
-            if (n['name'] == node):
-                logger.debug("Found node by node name!")
-                return n
+            return self.store.nodes[int(node)]
+        n = self.store.nodesbyname.get(node)
+        if n is not None:
+            logger.debug("Found node by node name!")
+        return n
 
     def zwavetest(self, args):
         logger.debug("Zwavetest args: {}".format(args))
         return "zwavetest command run"
 
-    # dump status for a single node or several nodes
+    # dump status for a single node or several nodes, by node id, or every node
     def dumpnode(self, nodelist = list()):
-        msg = str()
-        for nodeid in NODES.keys():
-            longago = howlongago(NODES[nodeid]['lastseen'])
-            msg += "{} ID: {} Last: {}\n".format(NODES[nodeid]['name'], nodeid, longago)
-            for valueid in NODES[nodeid]['values']:
-               updated = 0
-               if NODES[nodeid]['values'][valueid].has_key('updated'): updated = NODES[nodeid]['values'][valueid]['updated']
-               else: break
-               value = 'N/A'
-               if NODES[nodeid]['values'][valueid].has_key('value'): value = NODES[nodeid]['values'][valueid]['value']
-               label = 'N/A'
-               if NODES[nodeid]['values'][valueid].has_key('label'): label = NODES[nodeid]['values'][valueid]['label']
-               units = ''
-               if NODES[nodeid]['values'][valueid].has_key('units'): units = NODES[nodeid]['values'][valueid]['units']
-
-               msg += "\t{} = {} {}".format(label, value, units)
-               if NODES[nodeid]['values'][valueid].has_key('readonly') and NODES[nodeid]['values'][valueid]['readonly']:
-                  msg += ' (readonly)'
-               msg += " Updated: {}".format(howlongago(updated))
-               msg += "\n"
-
-        #noalias_dumper = yaml.dumper.SafeDumper
-        #noalias_dumper.ignore_aliases = lambda self, data: True
-        #msg += "\n\nDUMP NODES\n"+ "\n"+ yaml.dump(NODES, default_flow_style=False, Dumper=noalias_dumper)
-        return msg
+        return self.status.dump(nodelist)
 
 
 ### Main ###
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module decides which value notifications the openzwave agent emits as events.
+
+A ValueChanged or ValueRefreshed notification is emitted only when the value differs from the one last emitted:
+    deadband - numeric values must move at least this much from the last emitted value
+    interval - at least this many seconds pass between events of a value, a change that comes sooner is held back
+               and emitted when the interval is over, if the value still differs then
+Both are set per command class in the 'filter' config, and per value by label in the 'values' of a node's config,
+which takes precedence. Other notifications, like ValueAdded, are always emitted.
+"""
+from threading import Lock
+from time import time
+from logging import getLogger
+
+from lib.schedule import timer
+
+logger = getLogger(__name__)
+
+"""
+    What was last emitted for a value and its limits
+"""
+class state:
+    __slots__ = ('value', 'time', 'deadband', 'interval', 'held')
+
+    def __init__(self, value, time, deadband, interval):
+        self.value = value
+        self.time = time
+        self.deadband = deadband
+        self.interval = interval
+        # pending timer entry of a change held back by the interval
+        self.held = None
+
+class valuefilter:
+    """ config is the 'filter' config, nodes the 'nodes' config and emit(record, old) emits a held back change """
+    def __init__(self, config, nodes, emit):
+        self.enabled = config.get('enabled', True)
+        self.deadbands = config.get('deadband') or dict()
+        self.intervals = config.get('interval') or dict()
+        # (node id, label) -> value config
+        self.pervalue = dict()
+        for nodeid, conf in (nodes or {}).items():
+            for label, valueconf in ((conf or {}).get('values') or {}).items():
+                self.pervalue[(nodeid, label)] = valueconf or dict()
+        self.emit = emit
+        self.lock = Lock()
+        self.last = dict()
+        self.timer = None
+        self.passed = 0
+        self.suppressed = 0
+
+    """ Return the deadband and interval of a value """
+    def limits(self, record, commandclass):
+        conf = self.pervalue.get((record.nodeid, record.label), {})
+        return (conf.get('deadband', self.deadbands.get(commandclass, 0)),
+                conf.get('interval', self.intervals.get(commandclass, 0)))
+
+    def changed(self, s, v):
+        if v == s.value:
+            return False
+        if s.deadband:
+            try:
+                return abs(float(v) - float(s.value)) >= s.deadband
+            except (TypeError, ValueError):
+                pass
+        return True
+
+    """ Return (emit, old), whether a notification of the value record is emitted and the value last emitted.
+        With force the notification is emitted regardless, and the value becomes the last emitted.
+    """
+    def accept(self, record, commandclass = None, now = None, force = False):
+        if now is None: now = time()
+        with self.lock:
+            s = self.last.get(record.id)
+            if s is None:
+                deadband, interval = self.limits(record, commandclass)
+                self.last[record.id] = state(record.value, now, deadband, interval)
+                self.passed += 1
+                return True, None
+            if force or not self.enabled:
+                if force:
+                    # a value added again may have a new label
+                    s.deadband, s.interval = self.limits(record, commandclass)
+                if s.held is not None:
+                    self.timer.cancel(s.held)
+                    s.held = None
+                old = s.value
+                s.value, s.time = record.value, now
+                self.passed += 1
+                return True, old
+            if not self.changed(s, record.value):
+                self.suppressed += 1
+                return False, s.value
+            if now - s.time < s.interval:
+                if s.held is None:
+                    if self.timer is None:
+                        self.timer = timer('openzwave-filter')
+                    s.held = self.timer.call(s.time + s.interval - now, self.release, (record,))
+                self.suppressed += 1
+                return False, s.value
+            old = s.value
+            s.value, s.time = record.value, now
+            self.passed += 1
+            return True, old
+
+    """ Emit a change held back by the interval, if the value still differs from the one last emitted """
+    def release(self, record):
+        with self.lock:
+            s = self.last.get(record.id)
+            if s is None:
+                return
+            s.held = None
+            if not self.changed(s, record.value):
+                return
+            old = s.value
+            s.value, s.time = record.value, time()
+            self.passed += 1
+        self.emit(record, old)
+
+
+# MAIN #
+if __name__ == '__main__':
+    import random
+    from functools import partial
+    from timeit import timeit
+    from agent.openzwave_store import value
+
+    """ A day of thermostat readings polled every 30 seconds, drifting a few tenths of a degree """
+    def readings():
+        random.seed(1)
+        t, v = 1700000000.0, 70.0
+        for i in range(2880):
+            v += random.choice((-0.1, 0, 0, 0, 0.1))
+            yield t + i * 30, round(v, 1)
+
+    def text(name, label, v, units):
+        return name + ': ValueChanged ' + label + ' = ' + str(v) + ' ' + units + ' (ReadOnly)'
+
+    cls = 'COMMAND_CLASS_SENSOR_MULTILEVEL'
+    record = value(72057594076479506, 2, u'Temperature', units='F', readonly=True)
+    for name, config in (('every notification', {'enabled': False}),
+                         ('unchanged suppressed', {}),
+                         ('deadband 0.5', {'deadband': {cls: 0.5}})):
+        f = valuefilter(config, {}, lambda record, old: None)
+        for t, v in readings():
+            record.value = v
+            f.accept(record, cls, t)
+        print '{:28} {:5} events emitted, {:5} suppressed'.format(name + ':', f.passed, f.suppressed)
+    number = 100000
+    eager = timeit(lambda: text('Thermostat', u'Temperature', 70.5, 'F'), number=number) / number
+    lazy = timeit(lambda: partial(text, 'Thermostat', u'Temperature', 70.5, 'F'), number=number) / number
+    print 'event text rendered: {:.2f} us, deferred until read: {:.2f} us'.format(eager * 1e6, lazy * 1e6)
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module keeps the history of numeric Zwave values for the openzwave agent, with memory and disk use bounded
+regardless of uptime.
+
+Each valueId has three tiers of fixed size ring buffers:
+    raw    - the last 'raw' readings, as arrays of times and values in memory
+    minute - one minute averages with the minimum and maximum, the last 'minutes' of them
+    hour   - one hour averages with the minimum and maximum, the last 'hours' of them
+The minute and hour tiers are memory mapped column files under 'path', so they survive a restart and only the pages
+in use take memory. The files of at most 'open' values are kept mapped, those of the value least recently used are
+closed to make room, so file descriptors stay bounded however many values there are. A reading updates the open minute and hour buckets, a bucket is written to its tier when a reading
+for a later bucket arrives, or when the history is closed.
+
+Queries use the finest tier that reaches back to the start of the range.
+
+Column file layout:
+    header  - 'MCH', version (B), capacity (I), records written (Q)
+    columns - capacity doubles each: time, mean, min, max
+"""
+import os
+import mmap
+from array import array
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+from struct import Struct
+from threading import Lock
+from time import time
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+MAGIC = 'MCH'
+VERSION = 1
+HEADER = Struct('<3sBIQ')
+COUNT = Struct('<Q')
+DOUBLE = Struct('<d')
+COLUMNS = ('time', 'mean', 'min', 'max')
+# tier name, bucket seconds
+TIERS = (('minute', 60), ('hour', 3600))
+# values whose column files are kept open, two mapped files each
+OPEN = 64
+
+"""
+    A ring buffer of readings in memory
+"""
+class ring:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array('d', [0.0]) * capacity
+        self.values = array('d', [0.0]) * capacity
+        self.count = 0
+
+    def append(self, t, v):
+        i = self.count % self.capacity
+        self.times[i] = t
+        self.values[i] = v
+        self.count += 1
+
+    """ Return the times and values, oldest first """
+    def columns(self):
+        if self.count <= self.capacity:
+            return self.times[:self.count], self.values[:self.count]
+        i = self.count % self.capacity
+        return self.times[i:] + self.times[:i], self.values[i:] + self.values[:i]
+
+    def oldest(self):
+        if not self.count:
+            return None
+        return self.times[self.count % self.capacity if self.count > self.capacity else 0]
+
+"""
+    A ring buffer of downsampled readings in a memory mapped column file
+"""
+class columnfile:
+    def __init__(self, path, capacity):
+        size = HEADER.size + capacity * DOUBLE.size * len(COLUMNS)
+        new = not os.path.exists(path)
+        # the map keeps a descriptor of its own, the file is closed once it is mapped
+        with open(path, 'a+b' if new else 'r+b') as f:
+            if new or os.fstat(f.fileno()).st_size != size:
+                f.truncate(0)
+                f.truncate(size)
+                new = True
+            self.mm = mmap.mmap(f.fileno(), size)
+        if new:
+            HEADER.pack_into(self.mm, 0, MAGIC, VERSION, capacity, 0)
+        magic, version, self.capacity, self.count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION or self.capacity != capacity:
+            logger.error("History file %s has an unknown format, starting it again", path)
+            HEADER.pack_into(self.mm, 0, MAGIC, VERSION, capacity, 0)
+            self.capacity, self.count = capacity, 0
+
+    def offset(self, column, i):
+        return HEADER.size + (column * self.capacity + i) * DOUBLE.size
+
+    def append(self, record):
+        i = self.count % self.capacity
+        for column, v in enumerate(record):
+            DOUBLE.pack_into(self.mm, self.offset(column, i), v)
+        self.count += 1
+        # the count is written last, a crash never leaves a partial record counted
+        COUNT.pack_into(self.mm, HEADER.size - COUNT.size, self.count)
+
+    """ Return the columns, oldest first """
+    def columns(self):
+        n = min(self.count, self.capacity)
+        start = self.count % self.capacity if self.count > self.capacity else 0
+        out = list()
+        for column in range(len(COLUMNS)):
+            a = array('d')
+            a.fromstring(self.mm[self.offset(column, start):self.offset(column, n)])
+            a.fromstring(self.mm[self.offset(column, 0):self.offset(column, start)])
+            out.append(a)
+        return out
+
+    def oldest(self):
+        if not self.count:
+            return None
+        i = self.count % self.capacity if self.count > self.capacity else 0
+        return DOUBLE.unpack_from(self.mm, self.offset(0, i))[0]
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+
+"""
+    The open bucket of a tier: start time, sum, count, min, max
+"""
+class bucket:
+    __slots__ = ('start', 'total', 'count', 'low', 'high')
+
+    def __init__(self, start, v):
+        self.start = start
+        self.total = v
+        self.count = 1
+        self.low = v
+        self.high = v
+
+    def add(self, v):
+        self.total += v
+        self.count += 1
+        if v < self.low: self.low = v
+        if v > self.high: self.high = v
+
+    def record(self):
+        return (self.start, self.total / self.count, self.low, self.high)
+
+class history:
+    def __init__(self, config = dict()):
+        self.path = config.get('path', 'var/history')
+        self.raw = config.get('raw', 1024)
+        self.capacity = {'minute': config.get('minutes', 10080), 'hour': config.get('hours', 8760)}
+        self.open = config.get('open', OPEN)
+        self.lock = Lock()
+        # valueid -> ring, valueid -> {tier: columnfile} least recently used first, valueid -> {tier: bucket}
+        self.rings = dict()
+        self.tiers = OrderedDict()
+        self.buckets = dict()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    """ Return the column files of a value, opened if they are not, called with the lock held """
+    def files(self, valueid):
+        files = self.tiers.pop(valueid, None)
+        if files is None:
+            files = dict((tier, columnfile(os.path.join(self.path, '{}.{}'.format(valueid, tier)), self.capacity[tier]))
+                         for tier, seconds in TIERS)
+            while len(self.tiers) >= self.open:
+                for f in self.tiers.popitem(last=False)[1].values():
+                    f.close()
+        self.tiers[valueid] = files
+        return files
+
+    """ Record a reading, values that are not numbers are ignored. Returns True if it was recorded. """
+    def record(self, valueid, v, t = None):
+        try:
+            v = float(v)
+        except (TypeError, ValueError):
+            return False
+        if t is None: t = time()
+        with self.lock:
+            r = self.rings.get(valueid)
+            if r is None:
+                r = self.rings[valueid] = ring(self.raw)
+                self.buckets[valueid] = dict()
+            r.append(t, v)
+            buckets = self.buckets[valueid]
+            for tier, seconds in TIERS:
+                start = t - t % seconds
+                b = buckets.get(tier)
+                if b is None:
+                    buckets[tier] = bucket(start, v)
+                elif b.start == start:
+                    b.add(v)
+                else:
+                    self.files(valueid)[tier].append(b.record())
+                    buckets[tier] = bucket(start, v)
+        return True
+
+    """ Return the tier name and its (times, means, mins, maxes) columns for a query starting at start.
+        The finest tier that reaches back to start is used, or the one that reaches back furthest.
+    """
+    def select(self, valueid, start):
+        r = self.rings.get(valueid)
+        tiers = list()
+        if r is not None:
+            tiers.append(('raw', r))
+        # after a restart only the tiers on disk are there
+        if r is not None or os.path.exists(os.path.join(self.path, '{}.{}'.format(valueid, TIERS[0][0]))):
+            files = self.files(valueid)
+            tiers += [ (tier, files[tier]) for tier, seconds in TIERS ]
+        found = [ (name, t) for name, t in tiers if t.oldest() is not None ]
+        if not found:
+            return None, None
+        for name, t in found:
+            if start is not None and t.oldest() <= start:
+                break
+        else:
+            name, t = min(found, key=lambda tier: tier[1].oldest())
+        if name == 'raw':
+            times, values = t.columns()
+            return name, (times, values, values, values)
+        return name, t.columns()
+
+    """ Return (tier, [(time, value)]) for readings between start and end, tiers other than raw give bucket means """
+    def series(self, valueid, start = None, end = None):
+        with self.lock:
+            tier, columns = self.select(valueid, start)
+        if tier is None:
+            return None, list()
+        times, means = columns[0], columns[1]
+        lo = bisect_left(times, start) if start is not None else 0
+        hi = bisect_right(times, end) if end is not None else len(times)
+        return tier, zip(times[lo:hi], means[lo:hi])
+
+    """ Return a dict of count, min, max, mean, first, last and change of the readings between start and end,
+        None if there are none.
+    """
+    def aggregate(self, valueid, start = None, end = None):
+        with self.lock:
+            tier, columns = self.select(valueid, start)
+        if tier is None:
+            return None
+        times, means, lows, highs = columns
+        lo = bisect_left(times, start) if start is not None else 0
+        hi = bisect_right(times, end) if end is not None else len(times)
+        if lo >= hi:
+            return None
+        means = means[lo:hi]
+        return {'tier': tier, 'count': hi - lo, 'start': times[lo], 'end': times[hi - 1],
+                'min': min(lows[lo:hi]), 'max': max(highs[lo:hi]), 'mean': sum(means) / len(means),
+                'first': means[0], 'last': means[-1], 'change': means[-1] - means[0]}
+
+    """ Write the open buckets to their tiers and close the column files """
+    def close(self):
+        with self.lock:
+            for valueid, buckets in self.buckets.items():
+                for tier, b in buckets.items():
+                    self.files(valueid)[tier].append(b.record())
+            self.buckets = dict((valueid, dict()) for valueid in self.buckets)
+            for files in self.tiers.values():
+                for f in files.values():
+                    f.close()
+            self.tiers = OrderedDict()
+
+
+# MAIN #
+if __name__ == '__main__':
+    import sys
+    import shutil
+    import tempfile
+
+    # a week of thermostat readings every 30 seconds
+    path = tempfile.mkdtemp()
+    try:
+        h = history({'path': path, 'raw': 1024, 'minutes': 1440, 'hours': 24 * 14})
+        valueid = 72057594076479506
+        now = 1700000000.0
+        count = 7 * 24 * 120
+        start = time()
+        for i in xrange(count):
+            t = now - (count - i) * 30
+            h.record(valueid, 68 + 4 * ((i // 120) % 24 >= 8) + (i % 7) * 0.1, t)
+        elapsed = time() - start
+        print '{} readings recorded in {:.2f} s ({:.1f} us each)'.format(count, elapsed, elapsed / count * 1e6)
+        for hours in (1, 24, 24 * 7):
+            t = time()
+            a = h.aggregate(valueid, now - hours * 3600, now)
+            print 'last {:3} hours from {:6}: {} readings, min {:.1f} max {:.1f} mean {:.2f} in {:.2f} ms'.format(
+                hours, a['tier'], a['count'], a['min'], a['max'], a['mean'], (time() - t) * 1000)
+        disk = sum(os.path.getsize(os.path.join(path, n)) for n in os.listdir(path))
+        print 'memory: {} bytes raw, disk: {} bytes, the same for any uptime'.format(h.raw * DOUBLE.size * 2, disk)
+        h.close()
+    finally:
+        shutil.rmtree(path)
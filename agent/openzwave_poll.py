@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module polls Zwave values that do not report by themselves, for the openzwave agent.
+
+Values of the command classes in the 'interval' config, or with 'poll' seconds in a node's 'values' config, are
+refreshed on their own interval, which adapts between 'min' and 'max' seconds:
+    volatile - a reading that changed the value halves the interval
+    stable   - a reading that did not change it multiplies the interval by 'backoff'
+    watched  - a value watched with a 'watchValue' event is polled every 'min' seconds until the watch expires
+    asleep   - a value of a node that is asleep or failed is not polled, its interval backs off
+Any reading, polled or pushed by the device, moves the next poll of the value an interval later.
+All polls share a budget of 'budget' per minute, polls that are due when the budget is spent wait for it, the most
+overdue first.
+"""
+from random import random
+from threading import Lock
+from time import time
+from logging import getLogger
+
+from lib.schedule import timer
+
+logger = getLogger(__name__)
+
+MIN, MAX, BACKOFF, BUDGET = 30, 3600, 1.5, 30
+
+"""
+    The polling state of a value
+"""
+class polled:
+    __slots__ = ('valueid', 'nodeid', 'interval', 'entry', 'watched')
+
+    def __init__(self, valueid, nodeid, interval):
+        self.valueid = valueid
+        self.nodeid = nodeid
+        self.interval = interval
+        self.entry = None
+        self.watched = 0
+
+class poller:
+    """ refresh(valueid) requests a value from its node, nodestate(nodeid) returns 'awake', 'asleep' or 'failed' """
+    def __init__(self, config, nodes, refresh, nodestate):
+        self.min = config.get('min', MIN)
+        self.max = config.get('max', MAX)
+        self.backoff = config.get('backoff', BACKOFF)
+        self.budget = config.get('budget', BUDGET)
+        self.intervals = config.get('interval') or dict()
+        # (node id, label) -> poll seconds
+        self.pervalue = dict()
+        for nodeid, conf in (nodes or {}).items():
+            for label, valueconf in ((conf or {}).get('values') or {}).items():
+                if (valueconf or {}).get('poll'):
+                    self.pervalue[(nodeid, label)] = valueconf['poll']
+        self.refresh = refresh
+        self.nodestate = nodestate
+        self.lock = Lock()
+        self.values = dict()
+        # node id -> (state, checked), the node state is asked for at most once per 'min' seconds
+        self.nodes = dict()
+        self.tokens = self.budget
+        self.filled = time()
+        self.timer = timer('openzwave-poll')
+        self.polls = 0
+        self.asleep = 0
+        self.deferred = 0
+
+    def clamp(self, interval):
+        return max(self.min, min(self.max, interval))
+
+    """ Start polling a value record if its command class or label has a poll interval """
+    def add(self, record, commandclass = None):
+        interval = self.pervalue.get((record.nodeid, record.label), self.intervals.get(commandclass))
+        if not interval:
+            return False
+        with self.lock:
+            if record.id in self.values:
+                return True
+            p = self.values[record.id] = polled(record.id, record.nodeid, self.clamp(interval))
+            # spread the first polls over the interval
+            self.schedule(p, p.interval * random())
+        return True
+
+    def remove(self, valueid):
+        with self.lock:
+            p = self.values.pop(valueid, None)
+            if p is not None and p.entry is not None:
+                self.timer.cancel(p.entry)
+
+    """ Called with the lock held """
+    def schedule(self, p, delay):
+        if p.entry is not None:
+            self.timer.cancel(p.entry)
+        p.entry = self.timer.call(delay, self.poll, (p,))
+
+    """ A reading of a value arrived, changed tells if it differs from the one before """
+    def reading(self, valueid, changed, now = None):
+        if now is None: now = time()
+        with self.lock:
+            p = self.values.get(valueid)
+            if p is None:
+                return
+            if p.watched > now:
+                p.interval = self.min
+            elif changed:
+                p.interval = self.clamp(p.interval / 2.0)
+            else:
+                p.interval = self.clamp(p.interval * self.backoff)
+            self.schedule(p, p.interval)
+
+    """ Poll a value every 'min' seconds for the next seconds """
+    def watch(self, valueid, seconds):
+        with self.lock:
+            p = self.values.get(valueid)
+            if p is None:
+                return False
+            p.watched = time() + seconds
+            if p.interval > self.min:
+                p.interval = self.min
+                self.schedule(p, 0)
+        return True
+
+    """ Take a poll from the budget, returns the seconds until one is available if it is spent """
+    def take(self, now):
+        self.tokens = min(self.budget, self.tokens + (now - self.filled) * self.budget / 60.0)
+        self.filled = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) * 60.0 / self.budget
+
+    def poll(self, p):
+        now = time()
+        with self.lock:
+            if self.values.get(p.valueid) is not p:
+                return
+            p.entry = None
+            state, checked = self.nodes.get(p.nodeid, (None, None))
+        if checked is None or now - checked >= self.min:
+            # asked without the lock, the callback thread takes it for every reading
+            try:
+                state = self.nodestate(p.nodeid)
+            except Exception:
+                logger.exception("State of node %s could not be read", p.nodeid)
+                state = 'failed'
+            checked = now
+        with self.lock:
+            self.nodes[p.nodeid] = (state, checked)
+            if self.values.get(p.valueid) is not p or p.entry is not None:
+                # removed, or a reading scheduled the next poll meanwhile
+                return
+            if state != 'awake':
+                self.asleep += 1
+                p.interval = self.clamp(p.interval * self.backoff)
+                self.schedule(p, p.interval)
+                return
+            wait = self.take(now)
+            if wait:
+                self.deferred += 1
+                self.schedule(p, wait)
+                return
+            self.polls += 1
+            # polled again an interval later if no reading comes back
+            self.schedule(p, p.interval)
+        try:
+            self.refresh(p.valueid)
+        except Exception:
+            logger.exception("Polling value %s failed", p.valueid)
+
+    """ Return a dict of the values polled, polls sent, skipped for sleeping nodes and deferred by the budget,
+        and the shortest, longest and mean interval
+    """
+    def stats(self):
+        with self.lock:
+            intervals = [ p.interval for p in self.values.itervalues() ]
+        return {'values': len(intervals), 'polls': self.polls, 'asleep': self.asleep, 'deferred': self.deferred,
+                'min': min(intervals) if intervals else None, 'max': max(intervals) if intervals else None,
+                'mean': sum(intervals) / len(intervals) if intervals else None}
+
+    def stop(self):
+        with self.lock:
+            for p in self.values.itervalues():
+                if p.entry is not None:
+                    self.timer.cancel(p.entry)
+            self.values = dict()
+
+
+# MAIN #
+if __name__ == '__main__':
+    from agent.openzwave_store import value
+
+    """ Simulate a day of 40 values, 10 volatile, 25 stable and 5 on sleeping nodes, polled at a fixed interval or
+        adaptively. Returns the polls sent and the mean seconds a change of a volatile value waits to be read.
+        The timer is driven by hand so the day runs in simulated time.
+    """
+    def simulate(adaptive, base = 300, day = 86400):
+        sent = list()
+        config = {'interval': {'COMMAND_CLASS_SENSOR_MULTILEVEL': base}, 'budget': 30}
+        if not adaptive:
+            config.update({'min': base, 'max': base})
+        clock[0] = 0
+        p = poller(config, {}, sent.append, lambda nodeid: 'asleep' if nodeid >= 35 else 'awake')
+        p.timer = manual()
+        for i in range(40):
+            p.add(value(i, i, 'Value'), 'COMMAND_CLASS_SENSOR_MULTILEVEL')
+        staleness = list()
+        changed = dict()
+        while True:
+            when, entry = p.timer.next()
+            if when > day:
+                break
+            clock[0] = when
+            n = len(sent)
+            entry[2](*entry[3])
+            if len(sent) > n:
+                vid = sent[-1]
+                # volatile values change every 10 minutes
+                volatile = vid < 10 and int(when // 600) != changed.get(vid, 0)
+                if volatile:
+                    staleness.append(when % 600)
+                    changed[vid] = int(when // 600)
+                p.reading(vid, volatile, when)
+        return len(sent), sum(staleness) / len(staleness)
+
+    """ A timer whose calls are taken in order by the simulation """
+    class manual:
+        def __init__(self):
+            self.heap = list()
+            self.sequence = 0
+        def call(self, delay, callback, args = ()):
+            self.sequence += 1
+            entry = [clock[0] + delay, self.sequence, callback, args]
+            heappush(self.heap, entry)
+            return entry
+        def cancel(self, entry):
+            entry[2] = None
+        def next(self):
+            while self.heap[0][2] is None:
+                heappop(self.heap)
+            entry = heappop(self.heap)
+            return entry[0], entry
+
+    from heapq import heappush, heappop
+    clock = [0]
+    time = lambda: clock[0]
+    for adaptive in (False, True):
+        polls, stale = simulate(adaptive)
+        print '{:9} polling: {:5} polls a day, a volatile value is read {:4.0f} s after it changes'.format(
+            'adaptive' if adaptive else 'fixed', polls, stale)
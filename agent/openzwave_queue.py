@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module queues the value writes the openzwave agent sends to the Zwave network.
+
+Writes wait in a queue per node and are sent at no more than 'rate' frames per second, taking nodes in turn.
+A write to a value that is still queued replaces the queued one, so only the newest value is sent and the write keeps
+its place in the queue. Interactive writes, from user commands, are sent before scheduled ones.
+The queue depth, the writes coalesced and the time from the last write of a value to its frame being sent are reported.
+"""
+from collections import OrderedDict, deque
+from threading import Thread, Condition
+from time import time
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+RATE = 10
+INTERACTIVE, SCHEDULED = 0, 1
+CLASSES = ('interactive', 'scheduled')
+# latencies kept for the report
+LATENCIES = 100
+
+"""
+    A queued write, the newest value for a valueId
+"""
+class write:
+    __slots__ = ('valueid', 'nodeid', 'value', 'cls', 'queued')
+
+    def __init__(self, valueid, nodeid, value, cls, queued):
+        self.valueid = valueid
+        self.nodeid = nodeid
+        self.value = value
+        self.cls = cls
+        self.queued = queued
+
+class sendqueue:
+    """ send(valueid, value) transmits a write, it is called from the queue's thread """
+    def __init__(self, send, config = dict()):
+        self.send = send
+        rate = config.get('rate', RATE)
+        self.interval = 1.0 / rate if rate else 0
+        self.condition = Condition()
+        # valueid -> write, and per class the nodes in turn, each with its queued valueids
+        self.writes = dict()
+        self.nodes = [ OrderedDict() for c in CLASSES ]
+        self.running = True
+        self.last = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.latencies = [ deque(maxlen=LATENCIES) for c in CLASSES ]
+        self.thread = Thread(name='openzwave-queue', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    """ Queue a write of value to valueid on node nodeid """
+    def put(self, valueid, nodeid, value, interactive = False):
+        cls = INTERACTIVE if interactive else SCHEDULED
+        now = time()
+        with self.condition:
+            w = self.writes.get(valueid)
+            if w is not None:
+                # superseded, the newest value is sent in place of the queued one
+                self.coalesced += 1
+                w.value = value
+                w.queued = now
+                if cls < w.cls:
+                    self.unlink(w)
+                    w.cls = cls
+                    self.link(w)
+                return
+            w = self.writes[valueid] = write(valueid, nodeid, value, cls, now)
+            self.link(w)
+            self.condition.notify()
+
+    def link(self, w):
+        queue = self.nodes[w.cls].get(w.nodeid)
+        if queue is None:
+            queue = self.nodes[w.cls][w.nodeid] = OrderedDict()
+        queue[w.valueid] = w
+
+    def unlink(self, w):
+        queue = self.nodes[w.cls][w.nodeid]
+        del queue[w.valueid]
+        if not queue:
+            del self.nodes[w.cls][w.nodeid]
+
+    """ Take the next write, interactive first and nodes in turn, called with the lock held """
+    def take(self):
+        for nodes in self.nodes:
+            if nodes:
+                nodeid, queue = nodes.popitem(last=False)
+                valueid, w = queue.popitem(last=False)
+                if queue:
+                    # the node goes to the back of the line
+                    nodes[nodeid] = queue
+                del self.writes[valueid]
+                return w
+        return None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.writes:
+                    self.condition.wait()
+                if not self.writes:
+                    return
+                wait = self.last + self.interval - time()
+                if wait > 0 and self.running:
+                    self.condition.wait(wait)
+                    continue
+                w = self.take()
+            self.last = time()
+            try:
+                self.send(w.valueid, w.value)
+            except Exception:
+                logger.exception("Sending value %s = %s failed", w.valueid, w.value)
+            self.sent += 1
+            self.latencies[w.cls].append(time() - w.queued)
+
+    """ Return a dict of the queue depth per class, writes sent and coalesced, and latency per class """
+    def stats(self):
+        with self.condition:
+            depth = dict((name, sum(len(q) for q in self.nodes[cls].itervalues())) for cls, name in enumerate(CLASSES))
+        latency = dict()
+        for cls, name in enumerate(CLASSES):
+            l = list(self.latencies[cls])
+            latency[name] = {'mean': sum(l) / len(l) if l else None, 'max': max(l) if l else None}
+        return {'depth': depth, 'sent': self.sent, 'coalesced': self.coalesced, 'latency': latency}
+
+    """ Send what is queued, without pacing, and stop the queue thread """
+    def stop(self, timeout = 5):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(timeout)
+
+
+# MAIN #
+if __name__ == '__main__':
+    from time import sleep
+    from Queue import Queue
+
+    """ A scene of dimmers lights each written steps times by a schedule, with one interactive write at the end.
+        Returns the frames sent and the seconds until the interactive write was sent.
+    """
+    def scene(queued, dimmers = 5, steps = 10, rate = 20):
+        frames = list()
+        sent = dict()
+        def send(valueid, value):
+            frames.append((valueid, value))
+            sent[valueid] = time()
+        interval = 1.0 / rate
+        start = time()
+        if queued:
+            q = sendqueue(send, {'rate': rate})
+            for s in range(steps):
+                for d in range(dimmers):
+                    q.put(d, d, s * 10)
+            q.put('porch', 99, 99, interactive=True)
+            q.stop(30)
+        else:
+            # each write sent right away, as frames the mesh can carry at rate per second
+            fifo = Queue()
+            for s in range(steps):
+                for d in range(dimmers):
+                    fifo.put((d, s * 10))
+            fifo.put(('porch', 99))
+            while not fifo.empty():
+                send(*fifo.get())
+                sleep(interval)
+        return len(frames), sent['porch'] - start, frames[-dimmers - 1:]
+
+    for queued in (False, True):
+        frames, latency, last = scene(queued)
+        print '{:28} {:3} frames sent for 51 writes, interactive write sent after {:.2f} s'.format(
+            'send queue:' if queued else 'every write sent at once:', frames, latency)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module keeps the rendered status report of the Zwave nodes for the openzwave agent.
+
+Each node has its rows of the report, its name and values, rendered when the node changed since the report was last
+asked for, so a status reply only renders the nodes touched by notifications since the one before. The text of a
+node, with how long ago it was seen and its values updated, is kept until one of those would read differently.
+Node statistics are refreshed for every node by a background job each 'ttl' seconds and answered from memory.
+"""
+from threading import Lock
+from time import time
+from logging import getLogger
+
+from lib.timetools import howlongago
+from lib.schedule import timer
+
+logger = getLogger(__name__)
+
+TTL = 300
+# the seconds of the unit howlongago shows, by the age it shows it up to
+UNITS = ((60, 1), (3600, 60), (86400, 3600), (604800, 86400), (2592000, 604800), (None, 2592000))
+
+""" Return the time the text howlongago gives for t changes """
+def changes(t, now):
+    age = now - t
+    for upto, unit in UNITS:
+        if upto is None:
+            return t + (int(age // unit) + 1) * unit
+        if age < upto:
+            return t + min((int(age // unit) + 1) * unit, upto)
+
+class statusview:
+    """ store is the openzwave value store, statistics(nodeid) returns the statistics dict of a node """
+    def __init__(self, store, statistics, config = dict()):
+        self.store = store
+        self.statistics = statistics
+        self.ttl = config.get('ttl', TTL)
+        self.lock = Lock()
+        # node id -> [(text, time)], the time is rendered as how long ago after the text
+        self.rows = dict()
+        # node id -> (text, time it changes)
+        self.blocks = dict()
+        self.dirty = set(store.nodes)
+        # node id -> (statistics, refreshed)
+        self.stats = dict()
+        self.rendered = 0
+        self.timer = timer('openzwave-status')
+        self.entry = self.timer.call(0, self.refreshstats)
+
+    """ Mark a node changed, its rows are rendered again when the status is next asked for """
+    def touch(self, nodeid):
+        with self.lock:
+            self.dirty.add(nodeid)
+
+    def render(self, n):
+        rows = [ (u'{} ID: {} Last: '.format(n.name, n.id), n.lastseen) ]
+        # a snapshot, the callback thread adds values while the report is rendered
+        for v in sorted(n.values.values(), key=lambda v: v.label):
+            if v.updated is None:
+                continue
+            text = u'\t{} = {} {}'.format(v.label if v.label is not None else 'N/A', v.value, v.units)
+            if v.readonly:
+                text += ' (readonly)'
+            rows.append((text + ' Updated: ', v.updated))
+        stats = self.stats.get(n.id)
+        if stats is not None:
+            rows.append((u'\tStatistics: {} Refreshed: '.format(self.statstext(stats[0])), stats[1]))
+        return rows
+
+    def statstext(self, s):
+        return 'sent {} ({} failed, {} retries), received {} ({} unsolicited), average RTT {} ms, quality {}'.format(
+            s.get('sentCnt', 0), s.get('sentFailed', 0), s.get('retries', 0), s.get('receivedCnt', 0),
+            s.get('receivedUnsolicited', 0), s.get('averageRequestRTT', 0), s.get('quality', 0))
+
+    """ Render the rows of the nodes changed since the last report, called with the lock held """
+    def update(self):
+        dirty, self.dirty = self.dirty, set()
+        for nodeid in dirty:
+            n = self.store.nodes.get(nodeid)
+            self.blocks.pop(nodeid, None)
+            if n is None:
+                self.rows.pop(nodeid, None)
+            else:
+                self.rows[nodeid] = self.render(n)
+                self.rendered += 1
+
+    """ Return the text of a node, made again when it changed or a time in it reads differently, called with the lock held """
+    def block(self, nodeid, now):
+        block = self.blocks.get(nodeid)
+        if block is not None and now < block[1]:
+            return block[0]
+        out = list()
+        expires = None
+        for text, t in self.rows.get(nodeid, ()):
+            if t is None:
+                out.append(text + 'never\n')
+                continue
+            out.append(text + howlongago(t, now) + '\n')
+            c = changes(t, now)
+            if expires is None or c < expires:
+                expires = c
+        text = ''.join(out)
+        self.blocks[nodeid] = (text, expires if expires is not None else float('inf'))
+        return text
+
+    """ Return the status report of the nodes with the ids in nodeids, or of every node """
+    def dump(self, nodeids = None):
+        # commands may ask for reports from several threads at once
+        with self.lock:
+            self.update()
+            now = time()
+            return ''.join(self.block(nodeid, now) for nodeid in (nodeids if nodeids else sorted(self.rows)))
+
+    """ Return the statistics of a node and when they were refreshed, (None, None) if there are none yet """
+    def nodestats(self, nodeid):
+        return self.stats.get(nodeid, (None, None))
+
+    """ Refresh the statistics of every node and schedule the next refresh """
+    def refreshstats(self):
+        now = time()
+        for nodeid in list(self.store.nodes):
+            try:
+                stats = self.statistics(nodeid)
+            except Exception:
+                logger.exception("Statistics of node %s could not be read", nodeid)
+                continue
+            if stats is not None:
+                self.stats[nodeid] = (stats, now)
+                self.touch(nodeid)
+        self.entry = self.timer.call(self.ttl, self.refreshstats)
+
+    """ Refresh the statistics now, the next refresh is 'ttl' seconds later """
+    def refresh(self):
+        if self.timer.cancel(self.entry):
+            self.entry = self.timer.call(0, self.refreshstats)
+
+    def stop(self):
+        self.timer.cancel(self.entry)
+
+
+# MAIN #
+if __name__ == '__main__':
+    from timeit import timeit
+    from agent.openzwave_store import store
+
+    NODES, VALUES = 200, 10
+
+    """ The report as dumpnode made it, from nested dicts of every node on each call """
+    def dictdump(nodes):
+        msg = str()
+        for nodeid in nodes.keys():
+            longago = howlongago(nodes[nodeid]['lastseen'])
+            msg += "{} ID: {} Last: {}\n".format(nodes[nodeid]['name'], nodeid, longago)
+            for valueid in nodes[nodeid]['values']:
+                v = nodes[nodeid]['values'][valueid]
+                value = v['value'] if v.has_key('value') else 'N/A'
+                label = v['label'] if v.has_key('label') else 'N/A'
+                units = v['units'] if v.has_key('units') else ''
+                msg += "\t{} = {} {}".format(label, value, units)
+                if v.has_key('readonly') and v['readonly']:
+                    msg += ' (readonly)'
+                msg += " Updated: {}".format(howlongago(v['updated']))
+                msg += "\n"
+        return msg
+
+    import random
+    random.seed(1)
+    s = store(dict())
+    now = time()
+    # values updated over the last day
+    for n in range(NODES):
+        node = s.node(n, now - random.random() * 3600)
+        for i in range(VALUES):
+            s.update(node, {'id': n * 1000 + i, 'label': u'Value {}'.format(i), 'value': 70.5 + i, 'units': 'F',
+                            'readOnly': True}, now - random.random() * 86400)
+    nodes = dict((n.id, {'name': n.name, 'lastseen': n.lastseen,
+                         'values': dict((v.id, {'label': v.label, 'value': v.value, 'units': v.units, 'readonly': v.readonly,
+                                                'updated': v.updated}) for v in n.values.itervalues())})
+                 for n in s.nodes.itervalues())
+    view = statusview(s, lambda nodeid: None)
+    view.dump()
+
+    number = 20
+    tdict = timeit(lambda: dictdump(nodes), number=number) / number
+    # each report follows notifications from 5 nodes
+    def changed():
+        for nodeid in range(5):
+            view.touch(nodeid)
+        return view.dump()
+    tview = timeit(changed, number=number) / number
+    print '{} nodes, {} values'.format(NODES, NODES * VALUES)
+    print 'status report rebuilt: {:.2f} ms, materialized with 5 nodes changed: {:.2f} ms'.format(tdict * 1000, tview * 1000)
+    print 'single node report: {:.3f} ms'.format(timeit(lambda: view.dump([150]), number=1000))
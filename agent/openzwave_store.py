@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module holds the nodes and values of the Zwave network for the openzwave agent.
+
+Nodes and values are records with __slots__, updated in place when a notification arrives.
+Values are indexed by valueId, by (node id, label) and by (node name, label), so a lookup is a single dict access.
+The node records are kept in the agent state and pickle as plain tuples, nodes restored in the older nested dict
+format are converted when the store is created.
+"""
+from time import time
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+"""
+    A Zwave value, identified by its valueId
+"""
+class value(object):
+    __slots__ = ('id', 'nodeid', 'label', 'value', 'units', 'readonly', 'updated')
+
+    def __init__(self, id, nodeid, label = None, value = '', units = '', readonly = False, updated = None):
+        self.id = id
+        self.nodeid = nodeid
+        self.label = label
+        self.value = value
+        self.units = units
+        self.readonly = readonly
+        self.updated = updated
+
+    def __getstate__(self):
+        return (self.id, self.nodeid, self.label, self.value, self.units, self.readonly, self.updated)
+
+    def __setstate__(self, state):
+        self.id, self.nodeid, self.label, self.value, self.units, self.readonly, self.updated = state
+
+    def __repr__(self):
+        return 'value({!r}, {!r}, {!r}, {!r}, {!r})'.format(self.id, self.nodeid, self.label, self.value, self.units)
+
+"""
+    A Zwave node and its values by valueId
+"""
+class node(object):
+    __slots__ = ('id', 'name', 'lastseen', 'values', 'bylabel')
+
+    def __init__(self, id, name = None, lastseen = None):
+        self.id = id
+        self.name = name if name is not None else 'Node '+ str(id)
+        self.lastseen = lastseen
+        self.values = dict()
+        self.bylabel = dict()
+
+    def __getstate__(self):
+        return (self.id, self.name, self.lastseen, self.values.values())
+
+    def __setstate__(self, state):
+        self.id, self.name, self.lastseen, values = state
+        self.values = dict((v.id, v) for v in values)
+        self.bylabel = dict((v.label, v) for v in values if v.label is not None)
+
+    def __repr__(self):
+        return 'node({!r}, {!r}, {} values)'.format(self.id, self.name, len(self.values))
+
+class store:
+    """ nodes is the dict of node records by node id, usually from the agent state, config the 'nodes' config """
+    def __init__(self, nodes, config = dict()):
+        self.nodes = nodes
+        for nodeid, n in nodes.items():
+            if isinstance(n, dict):
+                nodes[nodeid] = self.convert(nodeid, n)
+        for nodeid, conf in config.items():
+            n = self.nodes.get(nodeid)
+            if n is None:
+                self.nodes[nodeid] = node(nodeid, conf.get('name'))
+            elif conf.get('name'):
+                n.name = conf['name']
+        self.reindex()
+
+    """ Convert a node in the nested dict format """
+    def convert(self, nodeid, n):
+        new = node(nodeid, n.get('name'), n.get('lastseen'))
+        for valueid, v in n.get('values', {}).items():
+            new.values[valueid] = value(valueid, nodeid, v.get('label'), v.get('value', ''), v.get('units', ''),
+                                        v.get('readonly', False), v.get('updated'))
+        return new
+
+    """ Rebuild the indexes from the node records """
+    def reindex(self):
+        self.values = dict()
+        self.bylabel = dict()
+        self.byname = dict()
+        self.nodesbyname = dict()
+        for n in self.nodes.itervalues():
+            n.bylabel = dict()
+            self.nodesbyname[n.name] = n
+            for v in n.values.itervalues():
+                self.values[v.id] = v
+                if v.label is not None:
+                    self.index(n, v)
+
+    def index(self, n, v):
+        n.bylabel[v.label] = v
+        self.bylabel[(n.id, v.label)] = v
+        self.byname[(n.name, v.label)] = v
+
+    """ Remove the index entries of a value under its label, unless they are another value's """
+    def unindex(self, n, v):
+        if n.bylabel.get(v.label) is v:
+            del n.bylabel[v.label]
+        if self.bylabel.get((n.id, v.label)) is v:
+            del self.bylabel[(n.id, v.label)]
+        if self.byname.get((n.name, v.label)) is v:
+            del self.byname[(n.name, v.label)]
+
+    """ Return the node, created if it is new, and mark it seen """
+    def node(self, nodeid, now = None):
+        n = self.nodes.get(nodeid)
+        if n is None:
+            n = self.nodes[nodeid] = node(nodeid)
+            self.nodesbyname[n.name] = n
+        n.lastseen = now if now is not None else time()
+        return n
+
+    """ Update a value of node n in place from a notification's valueId dict, returns the value record """
+    def update(self, n, v, now = None):
+        record = self.values.get(v['id'])
+        if record is None:
+            record = self.values[v['id']] = n.values[v['id']] = value(v['id'], n.id)
+        label = v.get('label')
+        if label is not None and label != record.label:
+            if record.label is not None:
+                self.unindex(n, record)
+            record.label = label
+            self.index(n, record)
+        record.value = v.get('value', '')
+        record.units = v.get('units', '')
+        record.readonly = bool(v.get('readOnly'))
+        record.updated = now if now is not None else time()
+        return record
+
+    """ Rename a node, keeping the name index up to date """
+    def rename(self, n, name):
+        self.nodesbyname.pop(n.name, None)
+        for label in n.bylabel:
+            self.byname.pop((n.name, label), None)
+        n.name = name
+        self.nodesbyname[name] = n
+        for label, v in n.bylabel.iteritems():
+            self.byname[(name, label)] = v
+
+    """ Return the value of a node, by name or id, with a label, None if there is none """
+    def lookup(self, node, label):
+        if isinstance(node, (int, long)):
+            return self.bylabel.get((node, label))
+        return self.byname.get((node, label))
+
+
+# MAIN #
+if __name__ == '__main__':
+    import sys
+    import gc
+    import cPickle as pickle
+    from timeit import timeit
+
+    NODES, VALUES = 200, 10
+
+    """ Return the notifications of a network of NODES nodes with VALUES values each """
+    def notifications():
+        for n in range(NODES):
+            for i in range(VALUES):
+                yield {'homeId': 25480663, 'notificationType': 'ValueChanged', 'nodeId': n,
+                       'valueId': {'index': i, 'units': u'F', 'type': 'Decimal', 'nodeId': n, 'value': 70.5 + i,
+                                   'commandClass': 'COMMAND_CLASS_SENSOR_MULTILEVEL', 'instance': 1, 'readOnly': True,
+                                   'homeId': 25480663, 'label': u'Value {}'.format(i), 'genre': 'User',
+                                   'id': 72057594076479506 + n * 1000 + i}}
+
+    """ The nested dict structure and update of the agent callback before the store """
+    def dictupdate(nodes, byname, args):
+        nodeid = args['nodeId']
+        try:
+            nodename = nodes[nodeid]['name']
+            nodes[nodeid]['lastseen'] = time()
+        except KeyError:
+            nodename = 'Node '+ str(nodeid)
+            nodes[nodeid] = { 'name': nodename, 'lastseen': time() }
+        try: nodes[nodeid]['values']
+        except KeyError:
+            nodes[nodeid]['values'] = dict()
+        try: nodes[nodeid]['bylabel']
+        except KeyError:
+            nodes[nodeid]['bylabel'] = dict()
+        if nodename not in byname:
+            byname[nodename] = nodes[nodeid]
+        v = args['valueId']
+        if not nodes[nodeid]['values'].has_key(v['id']):
+            nodes[nodeid]['values'][v['id']] = { 'id': v['id'] }
+        if v.has_key('label'):
+            nodes[nodeid]['values'][v['id']]['label'] = v['label']
+            if not nodes[nodeid]['bylabel'].has_key(v['label']):
+                nodes[nodeid]['bylabel'][v['label']] = nodes[nodeid]['values'][v['id']]
+        nodes[nodeid]['values'][v['id']]['value'] = v['value']
+        nodes[nodeid]['values'][v['id']]['units'] = v['units']
+        nodes[nodeid]['values'][v['id']]['readonly'] = bool(v.get('readOnly'))
+        nodes[nodeid]['values'][v['id']]['updated'] = time()
+
+    def storeupdate(s, args):
+        s.update(s.node(args['nodeId']), args['valueId'])
+
+    """ Size in bytes of obj and all the objects it refers to, each counted once """
+    def deepsize(obj):
+        seen = set()
+        stack = [obj]
+        size = 0
+        while stack:
+            o = stack.pop()
+            if id(o) in seen or isinstance(o, type):
+                continue
+            seen.add(id(o))
+            size += sys.getsizeof(o)
+            stack.extend(gc.get_referents(o))
+        return size
+
+    args = list(notifications())
+    nodes, byname = dict(), dict()
+    s = store(dict())
+    for a in args:
+        dictupdate(nodes, byname, a)
+        storeupdate(s, a)
+    print '{} nodes, {} values'.format(NODES, NODES * VALUES)
+    print 'nested dicts:   {:8} bytes'.format(deepsize((nodes, byname)))
+    print 'store:          {:8} bytes'.format(deepsize(s.__dict__))
+
+    number = 20
+    tdict = timeit(lambda: [dictupdate(nodes, byname, a) for a in args], number=number) / number / len(args)
+    tstore = timeit(lambda: [storeupdate(s, a) for a in args], number=number) / number / len(args)
+    print 'update nested dicts: {:.2f} us, store: {:.2f} us'.format(tdict * 1e6, tstore * 1e6)
+    name = 'Node 150'
+    tdict = timeit(lambda: byname[name]['bylabel'][u'Value 3']['id'], number=100000) / 100000
+    tstore = timeit(lambda: s.byname[(name, u'Value 3')].id, number=100000) / 100000
+    print 'setValue lookup nested dicts: {:.3f} us, store: {:.3f} us'.format(tdict * 1e6, tstore * 1e6)
+    print 'state pickle nested dicts: {} bytes, store: {} bytes'.format(len(pickle.dumps(nodes, 2)), len(pickle.dumps(s.nodes, 2)))
+    restored = store(pickle.loads(pickle.dumps(s.nodes, 2)))
+    print 'restored store has the same values: {}'.format(
+        all(restored.values[k].__getstate__() == v.__getstate__() for k, v in s.values.iteritems()))
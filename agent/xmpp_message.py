@@ -2,6 +2,9 @@
 # -*- coding: utf-8 -*-
 """
 This agent connects to a XMPP instant messaging server and translates messages to MCP events and vice versa.
+
+In the mcp the connection's socket is served by the shared event loop (lib.eventloop) and messages are sent from it,
+so all of the client's I/O happens on the loop thread. Without an event loop the agent processes on its own thread.
 """
 import xmpp
 import time
@@ -9,6 +12,7 @@ import sys
 import logging
 
 from lib.event import event
+from lib.eventloop import getloop
 
 logger = logging.getLogger(__name__)
 
@@ -50,10 +54,18 @@ class xmpp_message:
     def shutdown(self):
         logger.debug("Shutdown called")
         self.daemonize = False 
-        if self.client.isConnected(): self.client.disconnect()
-        time.sleep(2)
+        # the client is only used from the thread that serves its socket
+        if self.loop is not None:
+            self.loop.call_soon(self.disconnect)
+        else:
+            self.thread.join()
         logger.info("Shutdown complete")
 
+    def disconnect(self):
+        if self.loop is not None:
+            self.unwatch()
+        if self.client.isConnected(): self.client.disconnect()
+
     def eventhandler(self, event):
         logger.debug("Eventhandler - event: %s", event.dump())
         if event.eventid() == 'shutdown':
@@ -65,10 +77,40 @@ class xmpp_message:
             self.send(event.eventuser(), event.eventbody()) 
 
     def send(self,contact, message):
-        if not self.client.isConnected(): self.client.reconnectAndReauth()
+        if self.loop is not None:
+            self.loop.call_soon(self.sendnow, contact, message)
+            return
+        self.sendnow(contact, message)
+        self.client.Process(1)
+
+    def sendnow(self, contact, message):
+        if not self.client.isConnected():
+            if self.loop is not None:
+                self.reconnect(contact, message)
+                return
+            self.client.reconnectAndReauth()
         # ...send an ASCII message
         self.client.send(xmpp.Message(contact, message))
-        self.client.Process(1)
+
+    """ Reconnect on the loop's executor, the connect and auth block and the loop serves other agents meanwhile.
+        Messages sent until the connection is back are held and sent once it is. Runs on the loop thread.
+    """
+    def reconnect(self, contact, message):
+        self.held.append((contact, message))
+        if self.reconnecting:
+            return
+        self.reconnecting = True
+        self.loop.run_in_executor(self.client.reconnectAndReauth).add_done_callback(self.reconnected)
+
+    def reconnected(self, done):
+        self.reconnecting = False
+        held, self.held = self.held, list()
+        if done.exception() is not None or not self.client.isConnected():
+            logger.error("Reconnecting to the server failed, %i messages dropped: %s", len(held), done.exception())
+            return
+        self.watch()
+        for contact, message in held:
+            self.client.send(xmpp.Message(contact, message))
 
     def receive(self, con, xmppevent):
         type = xmppevent.getType()
@@ -85,16 +127,47 @@ class xmpp_message:
         while self.daemonize:
             self.client.Process(1)
             #time.sleep(2)
+        self.disconnect()
         logger.debug("Stopping processing")
 
+    """ Serve the connection's socket from the event loop """
+    def watch(self):
+        self.unwatch()
+        self.fd = self.client.Connection._sock.fileno()
+        self.loop.add_reader(self.fd, self.readable)
+
+    def unwatch(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.fd = None
+
+    """ Process the stanzas received on the socket, runs on the event loop thread """
+    def readable(self):
+        self.client.Process(0)
+        # TLS data already read from the socket is not seen by the event loop
+        while self.daemonize and self.client.isConnected() and self.client.Connection.pending_data(0):
+            self.client.Process(0)
+        if not self.client.isConnected():
+            # reconnected on the next send
+            logger.error("Disconnected from the server")
+            self.unwatch()
+
     def daemonizeit(self):
         if self.daemonize: return
+        self.loop = getloop()
+        self.fd = None
+        self.reconnecting = False
+        self.held = list()
+        if self.loop is not None:
+            self.daemonize = True
+            self.watch()
+            return
         import threading
         
         self.daemonize = True
-        d = threading.Thread(name='process', target=self.process)
-        d.setDaemon(False)
-        d.start()
+        self.thread = threading.Thread(name='process', target=self.process)
+        self.thread.setDaemon(False)
+        self.thread.start()
 
 
 ### Main ###
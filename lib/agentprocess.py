@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This core library hosts agents in child processes, so CPU heavy agents run on their own core and
+do not hold the interpreter lock the mcp dispatcher needs.
+
+An agentprocess hosts a group of one or more agents in a child process linked to the mcp by a pipe.
+The agent contract is unchanged: in the child each agent is created with its config, state and an eventcallback
+that sends events to the mcp, and proxy() returns the handler the mcp attaches to the agent's mailbox,
+which sends events to the agent's eventhandler in the child.
+Inside the child each agent has its own mailbox, so agents in a group do not wait for each other.
+
+The child is forked when the agentprocess is created and its messages are read once listen() is called, so the mcp
+can fork every group before it starts a thread: a lock another thread holds during a fork stays held in the child.
+If the child process exits it is restarted after 'restart' seconds, events delivered while it is down are dropped.
+On stop each agent's state is sent back to the mcp.
+
+Messages on the pipe are a kind byte followed by the message, events are sent in the lib.wire encoding:
+    mcp -> child: 'E' agent NUL event, 'X' stop
+    child -> mcp: 'E' event, 'R' agent NUL startup seconds, 'F' agent NUL startup seconds NUL error, 'S' pickled (agent, state)
+Agents that fail to start are reported and skipped, the other agents in the group keep running.
+"""
+import signal
+import logging
+import importlib
+import cPickle as pickle
+from multiprocessing import Process, Pipe
+from threading import Thread, Lock, RLock
+from time import sleep, time
+from logging import getLogger
+
+from lib.event import event, agentstatus
+from lib.mailbox import mailbox
+from lib.wire import encode, decode, encodable
+
+logger = getLogger(__name__)
+
+""" Import an agent module and create the agent, as the mcp does for agents in its own process """
+def loadagent(name, config, state, eventcallback):
+    amod = importlib.import_module('agent.'+ name)
+    if getattr(amod, 'event', None) is event:
+        amod.event = event.bind('agent.'+ name)
+    return getattr(amod, name)(config, state, eventcallback)
+
+""" Return an event encoded for the pipe, see lib.wire.encodable for events that cannot be, None if it is dropped """
+def encodepipe(e):
+    try:
+        return encode(e)
+    except (TypeError, ValueError):
+        e = encodable(e)
+        return encode(e) if e is not None else None
+
+""" Child process main, create the agents and deliver the events received from the mcp to them """
+def hostmain(conn, agents, states, load):
+    # the mcp handles signals and stops its children
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # a restart forks from the reader thread while other threads may hold a logging lock
+    logging._lock = RLock()
+    for ref in logging._handlerList:
+        if ref() is not None:
+            ref().createLock()
+    lock = Lock()
+
+    def send(msg):
+        with lock:
+            conn.send_bytes(msg)
+
+    def eventcallback(e):
+        payload = encodepipe(e)
+        if payload is not None:
+            send('E'+ payload)
+
+    instances = dict()
+    mailboxes = dict()
+    for name, config in agents:
+        start = time()
+        mailboxes[name] = mailbox('agent.'+ name)
+        try:
+            instances[name] = load(name, config, states[name], eventcallback)
+        except Exception as e:
+            # events sent to the agent are discarded
+            mailboxes[name].attach(lambda e: None)
+            send('F'+ name +'\0'+ repr(time() - start) +'\0'+ str(e))
+            continue
+        mailboxes[name].attach(instances[name].eventhandler)
+        send('R'+ name +'\0'+ repr(time() - start))
+
+    while True:
+        try:
+            msg = conn.recv_bytes()
+        except (EOFError, IOError):
+            break
+        if msg[0] == 'E':
+            end = msg.index('\0')
+            mailboxes[msg[1:end]].put(decode(memoryview(msg)[end + 1:]))
+        elif msg[0] == 'X':
+            for name in instances:
+                mailboxes[name].join()
+                send('S'+ pickle.dumps((name, states[name]), 2))
+            break
+    conn.close()
+
+class agentprocess:
+    """ The child is forked now, with listen the messages it sends are read, otherwise call listen() """
+    def __init__(self, name, agents, states, eventcallback, restart = 5, load = loadagent, listen = True):
+        self.name = name
+        self.agents = agents
+        self.states = states
+        self.eventcallback = eventcallback
+        self.restart = restart
+        self.load = load
+        self.lock = Lock()
+        self.running = True
+        self.dropped = 0
+        self.restarts = 0
+        self.fork()
+        if listen:
+            self.listen()
+
+    def spawn(self):
+        self.fork()
+        self.listen()
+
+    def fork(self):
+        conn, child = Pipe()
+        with self.lock:
+            self.conn = conn
+        self.process = Process(name='agentprocess-'+ self.name, target=hostmain,
+                               args=(child, self.agents, self.states, self.load))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.started = time()
+        logger.info("Agent process '%s' started - pid: %i agents: %s", self.name, self.process.pid,
+                    ', '.join(name for name, config in self.agents))
+
+    """ Start the thread reading the messages of the child """
+    def listen(self):
+        self.reader = Thread(name='agentprocess-'+ self.name, target=self.receive, args=(self.conn, ))
+        self.reader.daemon = True
+        self.reader.start()
+
+    """ Return the eventhandler for an agent in this process, it is attached to the agent's mailbox """
+    def proxy(self, agent):
+        prefix = 'E'+ agent +'\0'
+        def eventhandler(e):
+            payload = encodepipe(e)
+            if payload is not None:
+                self.send(prefix + payload)
+        return eventhandler
+
+    def send(self, msg):
+        try:
+            with self.lock:
+                self.conn.send_bytes(msg)
+        except (IOError, OSError, ValueError):
+            self.dropped += 1
+            logger.warning("Agent process '%s' is down, event dropped (%i dropped)", self.name, self.dropped)
+
+    """ Read messages from the child process, restart it if it exits """
+    def receive(self, conn):
+        while True:
+            try:
+                msg = conn.recv_bytes()
+            except (EOFError, IOError):
+                break
+            if msg[0] == 'E':
+                self.eventcallback(decode(memoryview(msg)[1:]))
+            elif msg[0] in 'RF':
+                fields = msg[1:].split('\0', 2)
+                seconds = float(fields[1])
+                if msg[0] == 'R':
+                    logger.info("Agent process '%s' - %s ready in %.3f seconds", self.name, fields[0], seconds)
+                    self.eventcallback(agentstatus(fields[0], seconds))
+                else:
+                    logger.error("Agent process '%s' - %s failed to start after %.3f seconds: %s", self.name, fields[0],
+                                 seconds, fields[2])
+                    self.eventcallback(agentstatus(fields[0], seconds, fields[2]))
+            elif msg[0] == 'S':
+                name, state = pickle.loads(msg[1:])
+                # update in place, the mcp holds a reference to each agent's state
+                self.states[name].clear()
+                self.states[name].update(state)
+        conn.close()
+        self.process.join()
+        if not self.running:
+            return
+
+        self.restarts += 1
+        logger.error("Agent process '%s' exited with code %s after %.1f seconds, restarting in %s seconds (restart %i)",
+                     self.name, self.process.exitcode, time() - self.started, self.restart, self.restarts)
+        sleep(self.restart)
+        if self.running:
+            self.spawn()
+
+    """ Stop the child process once the agents have handled the events sent to them, and collect their state """
+    def stop(self, timeout = 10):
+        self.running = False
+        self.send('X')
+        self.reader.join(timeout)
+        if self.process.is_alive():
+            logger.warning("Agent process '%s' did not stop, terminating", self.name)
+            self.process.terminate()
+
+
+# MAIN #
+if __name__ == '__main__':
+    import sys
+    import logging
+    from multiprocessing import cpu_count
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        datefmt='%Y/%m/%d-%H:%M:%S', level=logging.INFO)
+
+    # a CPU bound agent that answers each event once the work is done
+    class busy:
+        def __init__(self, config, state, eventcallback):
+            self.eventcallback = eventcallback
+            self.work = config['work']
+
+        def eventhandler(self, e):
+            sum(i * i for i in xrange(self.work))
+            self.eventcallback(event('done', e.eventbody()))
+
+    def loadbusy(name, config, state, eventcallback):
+        return busy(config, state, eventcallback)
+
+    """ Send count events to agents agents, hosted in procs processes (0 for threads in this process), return events per second """
+    def run(procs, agents, count, work):
+        from Queue import Queue
+        replies = Queue()
+        config = {'work': work}
+        names = ['busy{}'.format(i) for i in range(agents)]
+        handlers = list()
+        hosts = list()
+        if procs:
+            for p in range(procs):
+                group = names[p::procs]
+                host = agentprocess('bench{}'.format(p), [(n, config) for n in group], dict((n, dict()) for n in group),
+                                    replies.put, load=loadbusy)
+                hosts.append(host)
+                handlers += [host.proxy(n) for n in group]
+        else:
+            for n in names:
+                m = mailbox('agent.'+ n)
+                m.attach(loadbusy(n, config, dict(), replies.put).eventhandler)
+                handlers.append(m.put)
+        start = time()
+        for i in range(count):
+            handlers[i % len(handlers)](event('bench', str(i)))
+        for i in range(count):
+            replies.get()
+        elapsed = time() - start
+        for host in hosts:
+            host.stop()
+        return count / elapsed
+
+    # benchmark: python -m lib.agentprocess --benchmark [events]
+    if '--benchmark' in sys.argv:
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        logging.getLogger().setLevel(logging.WARNING)
+        agents = max(cpu_count(), 2)
+        base = run(0, agents, count, 20000)
+        print '{} agents in threads:        {:8.0f} events/s'.format(agents, base)
+        procs = 1
+        while procs <= agents:
+            rate = run(procs, agents, count, 20000)
+            print '{} agents in {:2} processes:   {:8.0f} events/s ({:.1f}x)'.format(agents, procs, rate, rate / base)
+            procs *= 2
+        sys.exit(0)
+
+    host = agentprocess('demo', [('busy', {'work': 1000})], {'busy': dict()},
+                        lambda e: logger.info('Reply from child: %s %s', e.eventid(), e.eventbody()), load=loadbusy)
+    handler = host.proxy('busy')
+    for i in range(3):
+        handler(event('demo', 'event {}'.format(i)))
+    host.stop()
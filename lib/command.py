@@ -3,12 +3,22 @@
 '''
 This core library provides command registration, parsing and processing.
 Other components register commands either with the add method or through a command register event.
+
+Commands and subcommands can be abbreviated to any prefix that matches only one of them, 'por of' runs 'porch off'.
+The prefix index and the help and list output are built once after commands are added or removed.
+
+Commands from command events run on a pool of 'workers' threads, not the dispatcher thread that delivered the event.
+A command that runs longer than its 'timeout' (set per command or by config) gets a timed out reply,
+and a user or a command already running 'peruser' or 'percommand' commands gets a busy reply straight away.
 '''
 
 import re
+from threading import Lock
 from logging import getLogger
 
 from lib.event import event
+from lib.eventloop import executor
+from lib.schedule import timer
 
 # Global Variables
 logger = getLogger(__name__)
@@ -18,10 +28,42 @@ COMMANDS = { 'help':   { 'description': 'List available commands',
                          'handlername': 'help' },
            }
 
+# command execution limits, see the 'command:' core config
+WORKERS = 4
+TIMEOUT = 30
+PERUSER = 2
+PERCOMMAND = 2
+
+""" Return a dict mapping every prefix of names to the name, or to a tuple of the names it is ambiguous between.
+    A complete name always maps to itself.
+"""
+def prefixes(names):
+    matches = dict()
+    for name in names:
+        key = name.lower()
+        for i in range(1, len(key) + 1):
+            matches.setdefault(key[:i], list()).append(name)
+    index = dict()
+    for prefix, found in matches.iteritems():
+        index[prefix] = found[0] if len(found) == 1 else tuple(sorted(found))
+    for name in names:
+        index[name.lower()] = name
+    return index
+
 class command:
-    def __init__(self, eventcallback, state = dict()):
+    def __init__(self, eventcallback, state = None, config = dict()):
         self.eventcallback = eventcallback
-        self.commands = state
+        self.commands = state if state is not None else dict()
+        # prefix index, help and list output, rebuilt by compile() after add() and remove()
+        self.compiled = None
+        self.lock = Lock()
+        self.timeout = config.get('timeout', TIMEOUT)
+        self.peruser = config.get('peruser', PERUSER)
+        self.percommand = config.get('percommand', PERCOMMAND)
+        # commands running per user and per command name
+        self.running = { 'user': dict(), 'command': dict() }
+        self.pool = executor(config.get('workers', WORKERS), 'command')
+        self.timer = timer('command')
         # register default commands
         self.add(COMMANDS)
         # register commands from state
@@ -53,8 +95,10 @@ class command:
                 logger.critical("Command '{}' details not passed, skipping {}".format(cmd, command[cmd]))
                 continue
                 
-            logger.debug("Adding command: {}".format(cmd))
-            self.commands[cmd] = command[cmd]
+            logger.debug("Adding command: %s", cmd)
+            with self.lock:
+                self.commands[cmd] = command[cmd]
+                self.compiled = None
 
     # remove a command
     def remove(self, command):
@@ -63,56 +107,83 @@ class command:
         elif command not in self.commands:
             logger.error("Command not registered")
         else:
-            logger.debug("Removing command: {}".format(command))
-            del self.commands[command]
+            logger.debug("Removing command: %s", command)
+            with self.lock:
+                del self.commands[command]
+                self.compiled = None
+
+    """ Build the prefix index of commands and subcommands and render the help and list output """
+    def compile(self):
+        with self.lock:
+            commands = dict(self.commands)
+        subindex = dict((name, prefixes(info.keys())) for name, info in commands.iteritems() if 'description' not in info)
+        index = dict()
+        for prefix, name in prefixes(commands.keys()).iteritems():
+            index[prefix] = (name, subindex.get(name) if type(name) is not tuple else None)
 
-    # list command information
-    def list(self):
         lst = list()
-            
-        for comm in sorted(self.commands.iterkeys()):
-            if 'description' in self.commands[comm]:
-                lst.append(comm) 
+        msg = str()
+        for comm in sorted(commands.iterkeys()):
+            if 'description' in commands[comm]:
+                lst.append(comm)
+                msg += "{:10}{:15}{}\n".format(comm, ' ', commands[comm]['description'])
             else:
-                for subc in self.commands[comm]:
+                msg += comm +"\n"
+                for subc in sorted(commands[comm].iterkeys()):
                     lst.append('{} {}'.format(comm, subc))
-        return lst
+                    msg += "{:10}{:15}{}\n".format('', subc, commands[comm][subc]['description'])
+        compiled = (commands, index, msg, lst)
+        with self.lock:
+            # swapped in at once, other threads see the old or the new index, unless commands changed meanwhile
+            if self.commands == commands:
+                self.compiled = compiled
+        logger.debug("Compiled command index - commands: %i prefixes: %i", len(lst), len(index))
+        return compiled
+
+    # list command information
+    def list(self):
+        return list((self.compiled or self.compile())[3])
 
     def parse(self, msg):
+        name, cmdinfo, args = self.lookup(msg)
+        return cmdinfo, args
+
+    """ Return the full command name, the command info and the arguments, or None, an error message and None """
+    def lookup(self, msg):
         # parse command message
         words = msg.split()
-        logger.debug("got words: {}".format(words))
-        if len(words) >= 1:
-            words[0] = words[0].lower()
-        if len(words) >= 2: 
-            words[1] = words[1].lower()
+        logger.debug("got words: %s", words)
         if not words:
             words.append('help')
+        commands, index, helpmsg, lst = self.compiled or self.compile()
 
-        # find command
-        args = list() 
-        cmdinfo = dict() 
-
-        first = 2
-        if words[0] in self.commands:
-            logger.debug("Found first word in commands")
-            if 'description' in self.commands[words[0]]:
-                logger.debug("Found single word command: '{}'".format(words[0]))
-                cmdinfo = self.commands[words[0]]
-                first = 1
-            elif len(words) > 1 and words[1] in self.commands[words[0]]:
-                logger.debug("Found command: '{} {}'".format(words[0], words[1]))
-                cmdinfo = self.commands[words[0]][words[1]]
-            else:
-                logger.debug("Command not found: '{}'".format(words[0]))
-                return "Command not found: '{}'".format(words[0]), None
+        # find command, either word can be abbreviated
+        found = index.get(words[0].lower())
+        if found is None:
+            logger.debug("Command not found: '%s'", words[0])
+            return None, "Command not found: '{}'".format(words[0]), None
+        name, subindex = found
+        if type(name) is tuple:
+            return None, "Ambiguous command '{}': {}".format(words[0], ', '.join(name)), None
+
+        if subindex is None:
+            logger.debug("Found single word command: '%s'", name)
+            cmdinfo = commands[name]
+            first = 1
         else:
-            logger.debug("Command not found: '{}'".format(words[0]))
-            return "Command not found: '{}'".format(words[0]), None
+            sub = subindex.get(words[1].lower()) if len(words) > 1 else None
+            if sub is None:
+                logger.debug("Command not found: '%s'", words[0])
+                return None, "Command not found: '{}'".format(' '.join(words[:2])), None
+            if type(sub) is tuple:
+                return None, "Ambiguous command '{} {}': {}".format(name, words[1], ', '.join(sub)), None
+            logger.debug("Found command: '%s %s'", name, sub)
+            cmdinfo = commands[name][sub]
+            name = name +' '+ sub
+            first = 2
 
-        logger.debug("Command info: {}".format(cmdinfo))
         args = words[first:]
-        return cmdinfo, args
+        return name, cmdinfo, args
 
     def authorize(self, user, info):
         # check permissions
@@ -141,17 +212,15 @@ class command:
 
 
     # run command
-    def run(self, cmdinfo, args, user):
-        logger.debug("Got command args: {}".format(args))
+    def run(self, cmdinfo, args, user, returnid = None):
+        logger.debug("Got command args: %s", args)
         #logger.debug("globals: {}".format(globals()))
         #logger.debug("locals: {}".format(locals()))
         #reply = globals()['self.'+ commandInfo['handler']](args)
         reply = str() 
         # execute a callable object
         if 'handler' in cmdinfo:
-            logger.debug("Found command handler: {}".format(cmdinfo['handler']))
-            logger.debug("Command function type: {}".format(type(cmdinfo['handler'])))
-            logger.debug("Command function callable? {}".format(callable(cmdinfo['handler'])))
+            logger.debug("Found command handler: %s", cmdinfo['handler'])
             if callable(cmdinfo['handler']):
                 reply = cmdinfo['handler'](args)
             else:
@@ -160,25 +229,29 @@ class command:
         # create an event
         elif 'handlerevent' in cmdinfo:
             handevent = dict(cmdinfo['handlerevent'])
-            logger.debug("Found command handler event: {}".format(handevent))
-            if not 'data' in handevent: handevent['data'] = dict()
+            logger.debug("Found command handler event: %s", handevent)
+            # the command definition's data is shared by every run
+            handevent['data'] = dict(handevent.get('data', {}))
             handevent['data']['args'] = args
+            # the agent handling the event can reply to the user
+            if returnid is not None: handevent['data']['returnid'] = returnid
             handevent['user'] = user 
+            # events from user commands are interactive
+            handevent.setdefault('priority', 'high')
             he = event(**handevent)
             self.eventcallback(he)
+            return None
         # run a function by name
         else:
-            logger.debug("Found command handler name: {}".format(cmdinfo['handlername']))
+            logger.debug("Found command handler name: %s", cmdinfo['handlername'])
             func = getattr(self, cmdinfo['handlername'], None) 
-            logger.debug("Command function type: {}".format(type(func)))
             if func is None: return "Could not locate function"
 
-            logger.debug("Got function: {}".format(func))
             reply = func(args)
 
         #reply = eval(('self.'+ commandInfo['handler'])(args))
         #reply = globals()[commandInfo['handler']](args)
-        logger.debug("Got reply:\n{}".format(reply))
+        logger.debug("Got reply:\n%s", reply)
         if reply is None:
            return('no response')
         else:
@@ -187,20 +260,10 @@ class command:
 
     def help(self, args):
         logger.debug("Command: 'help'")
-        msg = str()
-
-        for comm in sorted(self.commands.iterkeys()):
-            logger.debug("Command:\n{}\n".format(self.commands[comm]))
-            if 'description' in self.commands[comm]:
-                msg += "{:10}{:15}{}\n".format(comm, ' ', self.commands[comm]['description'])
-            else:
-                msg += comm +"\n"
-                for subc in sorted(self.commands[comm].iterkeys()):
-                    msg += "{:10}{:15}{}\n".format('', subc, self.commands[comm][subc]['description'])
-        return msg 
+        return (self.compiled or self.compile())[2]
 
     def handle(self, user, msg):
-        logger.debug("handle got command: {}".format(msg))
+        logger.debug("handle got command: %s", msg)
         cmdinfo, args = self.parse(msg)
         if not type(cmdinfo) is dict:
             return cmdinfo 
@@ -210,6 +273,71 @@ class command:
         ret = self.run(cmdinfo, args, user)
         return ret
 
+    """ Run a command on the pool, the reply is sent to returnid when it finishes or times out.
+        Returns False if the command was not started.
+    """
+    def submit(self, user, msg, returnid = None):
+        name, cmdinfo, args = self.lookup(msg)
+        if name is None:
+            self.reply(returnid, user, cmdinfo)
+            return False
+
+        with self.lock:
+            users, commands = self.running['user'], self.running['command']
+            if users.get(user, 0) >= self.peruser:
+                busy = "Busy: you already have {} commands running, try again later".format(users[user])
+            elif commands.get(name, 0) >= self.percommand:
+                busy = "Busy: '{}' is already running, try again later".format(name)
+            else:
+                busy = None
+                users[user] = users.get(user, 0) + 1
+                commands[name] = commands.get(name, 0) + 1
+        if busy is not None:
+            logger.warning("Command '%s' from '%s' not started: %s", name, user, busy)
+            self.reply(returnid, user, busy)
+            return False
+
+        # the reply is sent once, by whichever of finish and expiry comes first
+        replied = list()
+        timeout = cmdinfo.get('timeout', self.timeout)
+        done = self.pool.submit(self.run, cmdinfo, args, user, returnid)
+        expiry = self.timer.call(timeout, self.expire, (name, user, returnid, timeout, replied))
+        done.add_done_callback(lambda f: self.finished(f, name, user, returnid, expiry, replied))
+        return True
+
+    def finished(self, done, name, user, returnid, expiry, replied):
+        self.timer.cancel(expiry)
+        with self.lock:
+            self.release(self.running['user'], user)
+            self.release(self.running['command'], name)
+            if replied:
+                logger.warning("Command '%s' from '%s' finished after it timed out", name, user)
+                return
+            replied.append(True)
+        if done.exception() is not None:
+            logger.error("Command '%s' from '%s' failed: %s", name, user, done.exception())
+            self.reply(returnid, user, 'An error occurred')
+        elif done.result() is not None:
+            # None from a handler event, the agent handling it replies
+            self.reply(returnid, user, done.result())
+
+    def expire(self, name, user, returnid, timeout, replied):
+        with self.lock:
+            if replied:
+                return
+            replied.append(True)
+        logger.error("Command '%s' from '%s' timed out after %s seconds", name, user, timeout)
+        self.reply(returnid, user, "Command '{}' timed out after {} seconds".format(name, timeout))
+
+    def release(self, counts, key):
+        counts[key] -= 1
+        if not counts[key]:
+            del counts[key]
+
+    def reply(self, returnid, user, msg):
+        if returnid is not None:
+            self.eventcallback(event(**{'id': returnid, 'event': msg, 'user': user, 'priority': 'high' }))
+
     # event handler
     # events of type 'command' are routed to this function by the mcp dispatcher
     def event(self, cmdevent):
@@ -219,18 +347,15 @@ class command:
             if data['operation'] == 'add':
                 self.add(data['command'])
             elif data['operation'] == 'remove':
-                self.add(data['command'])
+                self.remove(data['command'])
             elif data['operation'] == 'list':
                 clist = self.list()
                 if 'returnevent' in data:
                     data['returnevent'].data['return'] = clist
-                    self.eventhcallback(data['returnevent'])
+                    self.eventcallback(data['returnevent'])
         elif len(body) > 0:
-            ret = self.handle(cmdevent.eventuser(), body)
-            # send response
-            if 'returnid' in data:
-                re = event(**{'id': data['returnid'], 'event': ret, 'user': cmdevent.eventuser() })
-                self.eventcallback(re)
+            # runs on the pool, the response is sent when it finishes
+            self.submit(cmdevent.eventuser(), body, data.get('returnid'))
         else:
             logger.critical("Cannot process event: {}".format(cmdevent.dump()))
         #cmdinfo, args = self.parse(msg)
@@ -246,6 +371,27 @@ if __name__ == "__main__":
                 datefmt='%Y/%m/%d-%H:%M:%S', level=logging_DEBUG)
     argv.pop(0) # remove program name from arg list
 
+    # benchmark: python -m lib.command --benchmark
+    if argv and argv[0] == '--benchmark':
+        from timeit import timeit
+        from logging import getLogger as logging_getLogger, WARNING as logging_WARNING
+        logging_getLogger().setLevel(logging_WARNING)
+        c = command(lambda e: None)
+        # 100 rooms of 10 subcommands
+        actions = ['on', 'off', 'half', 'dim', 'bright', 'red', 'green', 'blue', 'white', 'status']
+        for r in range(100):
+            c.add({ 'room{}'.format(r): dict((a, { 'description': 'Turn room {} {}'.format(r, a), 'authorized': 'ALL',
+                                                   'handlerevent': { 'id': 'openzwave', 'event': 'setValue' }}) for a in actions) })
+        number = 10000
+        tcompile = timeit(c.compile, number=10) / 10
+        print 'commands: {} compile: {:.2f} ms'.format(len(c.list()), tcompile * 1000)
+        for msg in ('room42 off', 'room42 of', 'room9 status now', 'nothere'):
+            t = timeit(lambda: c.parse(msg), number=number) / number
+            print 'parse {:18} {:6.2f} us'.format("'{}'".format(msg), t * 1e6)
+        t = timeit(lambda: c.help([]), number=number) / number
+        print 'help (cached):           {:6.2f} us, {} bytes'.format(t * 1e6, len(c.help([])))
+        exit(0)
+
     def dummycallback(event):
         logger.debug("Dummycallback got event: {}".format(event.dump()))
 
@@ -258,3 +404,9 @@ if __name__ == "__main__":
     # using event
     e1 = event(**{'id': 'eventid1', 'event': 'help', 'type': 'command', 'user': 'bob@home', 'data': { 'returnid': 'someid' }})
     c.event(e1)
+    # a slow command times out, and a second one while it runs is busy
+    from time import sleep
+    c.add({ 'slow': { 'description': 'Sleep for 2 seconds', 'authorized': 'ALL', 'timeout': 1, 'handler': lambda args: sleep(2) } })
+    for i in range(3):
+        c.event(event(**{'id': 'eventid2', 'event': 'slow', 'type': 'command', 'user': 'bob@home', 'data': { 'returnid': 'someid' }}))
+    sleep(2.5)
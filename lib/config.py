@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This core library loads the mcp configuration file, keeping a compiled copy of it so a start with an unchanged
+configuration does not parse the YAML again.
+
+The YAML is parsed and checked once, then the resulting dict is pickled to the cache file along with the
+modification time, size and sha1 digest of the configuration file. At the next start the cache is used if the
+digest still matches, otherwise, or if the cache cannot be read, the configuration is parsed in full and cached again.
+A cache with a different size is discarded without hashing the file.
+"""
+import os
+import cPickle as pickle
+from hashlib import sha1
+from time import time
+from logging import getLogger
+
+import yaml
+
+logger = getLogger(__name__)
+
+VERSION = 1
+# use the libyaml parser when PyYAML was built with it
+LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+""" Parse the configuration text and check it, returns the config dict """
+def parse(text, path = 'config'):
+    config = yaml.load(text, Loader=LOADER)
+    if config is None:
+        config = dict()
+    if not isinstance(config, dict):
+        raise ValueError("Config '{}' must be a mapping of sections, not {}".format(path, type(config).__name__))
+    for section, value in config.items():
+        if value is not None and not isinstance(value, dict):
+            raise ValueError("Config '{}' section '{}' must be a mapping, not {}".format(path, section, type(value).__name__))
+    for agent, value in (config.get('agent') or {}).items():
+        if value is not None and not isinstance(value, dict):
+            raise ValueError("Config '{}' agent '{}' must be a mapping, not {}".format(path, agent, type(value).__name__))
+    return config
+
+""" Return the cached config if it was compiled from this version of the file, None otherwise """
+def cached(cache, st, data):
+    try:
+        with open(cache, 'rb') as f:
+            version, mtime, size, digest, config = pickle.load(f)
+    except Exception as e:
+        # a missing, corrupt or stale cache only means a full parse
+        logger.debug("Config cache '%s' not used: %s", cache, e)
+        return None
+    if version != VERSION or size != st.st_size or digest != sha1(data).digest():
+        return None
+    if mtime != st.st_mtime:
+        logger.debug("Config file touched but unchanged, using the cache")
+    return config
+
+def store(cache, st, data, config):
+    if os.path.dirname(cache) and not os.path.isdir(os.path.dirname(cache)):
+        os.makedirs(os.path.dirname(cache))
+    tmp = cache +'.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump((VERSION, st.st_mtime, st.st_size, sha1(data).digest(), config), f, 2)
+    os.rename(tmp, cache)
+
+""" Load the config file, from its compiled cache when the file has not changed """
+def load(path = 'etc/mcp.conf', cache = 'var/mcp.conf.cache'):
+    start = time()
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        data = f.read()
+    if cache:
+        config = cached(cache, st, data)
+        if config is not None:
+            logger.info("Config '%s' loaded from cache in %.3f seconds", path, time() - start)
+            return config
+
+    config = parse(data, path)
+    if cache:
+        try:
+            store(cache, st, data, config)
+        except (IOError, OSError, pickle.PicklingError) as e:
+            logger.warning("Config cache '%s' could not be written: %s", cache, e)
+    logger.info("Config '%s' parsed in %.3f seconds", path, time() - start)
+    return config
+
+
+# MAIN #
+if __name__ == '__main__':
+    import sys
+    import shutil
+    import tempfile
+    import logging
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        datefmt='%Y/%m/%d-%H:%M:%S', level=logging.INFO)
+
+    path = sys.argv[1] if len(sys.argv) > 1 and not sys.argv[1].startswith('--') else 'etc/mcp.conf'
+    tmp = tempfile.mkdtemp()
+    try:
+        cache = os.path.join(tmp, 'mcp.conf.cache')
+        # benchmark: python -m lib.config --benchmark, with a generated config of many nodes and users
+        if '--benchmark' in sys.argv:
+            path = os.path.join(tmp, 'mcp.conf')
+            big = {'agent': {'openzwave': {'enabled': True, 'nodes': dict((n, {'name': 'Node {}'.format(n), 'label': 'Room {}'.format(n % 40),
+                             'values': dict((v, {'label': 'Value {}'.format(v), 'deadband': 0.5}) for v in range(8))}) for n in range(500))}},
+                   'user': dict(('user{}'.format(u), {'xmpp': 'user{}@DOMAIN'.format(u), 'alertlevel': u % 4}) for u in range(200)),
+                   'schedule': dict(('schedule{}'.format(s), {'time': '{}:00'.format(s % 24), 'event': 'command', 'body': 'status'}) for s in range(200))}
+            with open(path, 'w') as f:
+                yaml.dump(big, f, default_flow_style=False)
+            t = time()
+            yaml.load(open(path), Loader=yaml.Loader)
+            print 'yaml.load:          {:7.1f} ms'.format((time() - t) * 1000)
+        t = time()
+        first = load(path, cache)
+        print 'parse and cache:    {:7.1f} ms'.format((time() - t) * 1000)
+        t = time()
+        second = load(path, cache)
+        print 'load from cache:    {:7.1f} ms, same config: {}'.format((time() - t) * 1000, first == second)
+    finally:
+        shutil.rmtree(tmp)
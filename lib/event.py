@@ -10,52 +10,80 @@ An event can represent a subscribe/unsubscribe request, a message, usermessage o
 A subscribe request can be used to match other events or event emitters using using specific agent or event ids or regular expressions.
 A message event is for passing a message string between agents/components.
 A usermessage event is to represent a message send on behalf of a user.
+
+The event body may be a function returning the text instead of the text. It is called the first time the body is asked
+for, so an event whose subscribers only use its data never renders the text.
 """
 
-#from re import sub
-from re import compile, match, sub
-from inspect import getmodule, currentframe, stack
+from re import compile
 
 agentregex = compile('^agent\..+$')
 
-class event:
-    def __init__(self, id, event = '', type = 'message', agent = '', user = '', data = dict()):
+class event(object):
+    __slots__ = ('id', 'body', 'type', 'agent', 'user', 'data', 'emitter', 'agentevent', 'priority', 'coalesce')
+    # emitter of events created without an explicit emitter, see bind()
+    defaultemitter = 'mcp'
+    defaultagentevent = False
+    bound = dict()
+
+    def __init__(self, id, event = '', type = 'message', agent = '', user = '', data = None, emitter = None, priority = None, coalesce = None):
         self.id = id
         self.body = event
         self.type = type
         self.agent = agent
         self.user = user
-        self.data = data
-        self.emitter = getmodule(currentframe().f_back).__name__
-        agentmatch = agentregex.match(self.emitter) 
-        self.agentevent = True
-        # this event was created by the mcp core 
-        if not agentmatch:
-            self.emitter = currentframe().f_back.f_code.co_name
-            self.agentevent = False 
+        self.data = data if data is not None else dict()
+        self.priority = priority
+        self.coalesce = coalesce
+        if emitter is None:
+            self.emitter = self.defaultemitter
+            self.agentevent = self.defaultagentevent
+        else:
+            self.emitter = emitter
+            self.agentevent = agentregex.match(emitter) is not None
+
+    """ Return an event class with the emitter bound, cached per emitter.
+        The mcp binds 'agent.NAME' into each agent module when it is loaded,
+        so events carry their emitter without inspecting the caller.
+    """
+    @classmethod
+    def bind(cls, emitter):
+        try:
+            return cls.bound[emitter]
+        except KeyError:
+            sub = type(cls.__name__, (cls,), { '__slots__': (), '__module__': cls.__module__,
+                      'defaultemitter': emitter, 'defaultagentevent': agentregex.match(emitter) is not None })
+            cls.bound[emitter] = sub
+            return sub
+
+    """ Pickle as the base event class, bound classes only exist in the process that created them """
+    def __reduce__(self):
+        return (event, (self.id, self.eventbody(), self.type, self.agent, self.user, self.data, self.emitter, self.priority, self.coalesce))
 
     def __eq__(self, other):
         print "EQ got self:\n\t", self, "\nother:\n\t", other
         return True
 
     def __str__(self):
-        return str(self.body)
+        return str(self.eventbody())
 
     def dict(self):
-        return { 'agent': self.agent, 'id': self.id, 'type': self.type,
-                 'event': self.body, 'user': self.user, 'emitter': self.emitter, 'agentevent': self.agentevent }
+        return { 'agent': self.agent, 'id': self.id, 'type': self.type, 'event': self.eventbody(), 'user': self.user,
+                 'data': self.data, 'emitter': self.emitter, 'agentevent': self.agentevent }
 
     """ Return the event id.
     """
     def eventid(self):
         return self.id
     
-    """ Return the event.
+    """ Return the event, rendered from its function the first time when the body is a function.
     """
     def eventbody(self, body = None):
         if body != None:
             self.body = body
         else: 
+            if callable(self.body):
+                self.body = self.body()
             return self.body
 
     """ Return the event type.
@@ -85,6 +113,18 @@ class event:
     def eventemitter(self):
         return self.emitter
 
+    """ Return the priority class the event declares, or None to use the default for its id or type.
+        Priority classes: critical, high, normal, low
+    """
+    def eventpriority(self):
+        return self.priority
+
+    """ Return the coalesce key, or None if the event is always delivered.
+        Of queued events with the same emitter, id and coalesce key the dispatcher may deliver only the newest.
+    """
+    def eventcoalesce(self):
+        return self.coalesce
+
     """ Return True or False whether the event is from an agent.
     """
     def isagentevent(self):
@@ -92,10 +132,37 @@ class event:
 
     def dump(self):
         return "emitter: '{}' id: '{}' event: '{}' type: '{}' agent: '{}' user: '{}' data: '{}' agentevent: '{}'".format(self.emitter,
-            self.id, self.body, self.type, self.agent, self.user, self.data, self.agentevent)
+            self.id, self.eventbody(), self.type, self.agent, self.user, self.data, self.agentevent)
+
+""" Return the event announcing an agent has started, or failed to start with error, emitted as the agent.
+    Agents can subscribe to the 'ready' or 'failed' event id of another agent to wait for it.
+"""
+def agentstatus(name, seconds, error = None):
+    data = {'agent': name, 'seconds': seconds}
+    if error is None:
+        return event('ready', 'agent.{} ready in {:.3f} seconds'.format(name, seconds), data=data, emitter='agent.'+ name)
+    data['error'] = error
+    return event('failed', 'agent.{} failed to start after {:.3f} seconds: {}'.format(name, seconds, error), data=data,
+                 emitter='agent.'+ name, priority='high')
 
 # MAIN #
 if __name__ == '__main__':
+    import sys
+    # benchmark: python -m lib.event --benchmark
+    if '--benchmark' in sys.argv:
+        from timeit import timeit
+        from inspect import getmodule, currentframe
+        number = 100000
+        agentevent = event.bind('agent.openzwave')
+        data = {'node': 'Thermostat', 'value': 71.0}
+        tnew = timeit(lambda: agentevent('openzwave', 'Thermostat: ValueChanged', 'message', '', '', data), number=number)
+        # the emitter lookup events used to do on every construction
+        tlookup = timeit(lambda: agentregex.match(getmodule(currentframe().f_back).__name__), number=number)
+        print 'event construction:      {:.2f} us'.format(tnew / number * 1e6)
+        print 'frame and module lookup: {:.2f} us ({} modules loaded)'.format(tlookup / number * 1e6, len(sys.modules))
+        print 'event size: {} bytes'.format(sys.getsizeof(agentevent('openzwave')))
+        sys.exit(0)
+
     ev1 = event('eventid1', 'event1')
     ev2 = event(**{'id': 'eventid2', 'event': 'event2', 'type': 'eventtype2'})
 
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This core library provides a single threaded event loop. The mcp always runs one, it dispatches and delivers events
+when 'runtime: loop' is configured, and is the I/O reactor agents share with either runtime.
+
+The loop runs callbacks, timers, coroutines and file descriptor readers from one thread. It sleeps in epoll
+(select where there is no epoll) on the registered file descriptors and a wakeup pipe, so work queued from other
+threads, and stop(), are picked up immediately.
+Agents register a file descriptor with add_reader(fd, callback), the callback runs on the loop thread whenever
+the descriptor is readable, and must not block. remove_reader(fd) stops it, before the descriptor is closed.
+Coroutines are generator functions, an agent eventhandler written as one is run on the loop:
+    yield seconds - sleep for a number of seconds
+    yield future  - wait for a future, its result is sent back into the coroutine (or its exception raised)
+Synchronous functions, such as the eventhandler of existing agents, are bridged to a thread pool with
+run_in_executor, which returns a future.
+"""
+import os
+import select
+import errno
+from fcntl import fcntl, F_GETFL, F_SETFL
+from time import time, sleep
+from heapq import heappush, heappop
+from collections import deque
+from threading import Thread, Lock, Event, currentThread
+from Queue import Queue
+from types import GeneratorType
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# the loop created most recently in this process, see getloop()
+LOOP = None
+
+""" Return the event loop of this process, None if there is none.
+    A child process forked from the mcp does not have the loop thread, it gets None.
+"""
+def getloop():
+    if LOOP is not None and LOOP.pid == os.getpid():
+        return LOOP
+    return None
+
+"""
+    The result of work that completes later.
+    Done callbacks run on the loop thread when the future belongs to a loop, otherwise in the thread that completes it.
+"""
+class future:
+    def __init__(self, loop = None):
+        self.loop = loop
+        self.finished = Event()
+        self.value = None
+        self.error = None
+        self.callbacks = list()
+        self.lock = Lock()
+
+    def done(self):
+        return self.finished.is_set()
+
+    def set_result(self, value):
+        self.finish(value, None)
+
+    def set_exception(self, error):
+        self.finish(None, error)
+
+    def finish(self, value, error):
+        with self.lock:
+            if self.finished.is_set():
+                return
+            self.value, self.error = value, error
+            self.finished.set()
+            callbacks, self.callbacks = self.callbacks, list()
+        for callback in callbacks:
+            self.schedule(callback)
+
+    """ Call callback with this future once it is done """
+    def add_done_callback(self, callback):
+        with self.lock:
+            if not self.finished.is_set():
+                self.callbacks.append(callback)
+                return
+        self.schedule(callback)
+
+    def schedule(self, callback):
+        if self.loop is not None:
+            self.loop.call_soon(callback, self)
+        else:
+            callback(self)
+
+    """ Wait for and return the result, raises the exception the work raised """
+    def result(self, timeout = None):
+        if not self.finished.wait(timeout):
+            raise RuntimeError('Future not done after {} seconds'.format(timeout))
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def exception(self):
+        return self.error
+
+""" Run a coroutine to completion in the calling thread, without a loop, and return its return value.
+    Used by the 'threads' runtime so coroutine eventhandlers work there too.
+"""
+def runsync(coroutine):
+    value, error = None, None
+    while True:
+        try:
+            if error is not None:
+                waitfor = coroutine.throw(error)
+            else:
+                waitfor = coroutine.send(value)
+        except StopIteration as e:
+            return e.args[0] if e.args else None
+        value, error = None, None
+        if isinstance(waitfor, future):
+            waitfor.finished.wait()
+            value, error = waitfor.value, waitfor.error
+        elif isinstance(waitfor, GeneratorType):
+            try:
+                value = runsync(waitfor)
+            except Exception as e:
+                error = e
+        elif isinstance(waitfor, (int, long, float)):
+            sleep(waitfor)
+        else:
+            error = TypeError('Coroutine yielded {!r}, expected seconds or a future'.format(waitfor))
+
+"""
+    A fixed pool of worker threads running submitted functions
+"""
+class executor:
+    def __init__(self, workers = 4, name = 'executor'):
+        self.jobs = Queue()
+        self.threads = list()
+        for i in range(workers):
+            t = Thread(name='{}-{}'.format(name, i), target=self.work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    """ Run fn(*args) on a worker thread, returns a future for the result """
+    def submit(self, fn, *args, **kwargs):
+        f = future(kwargs.get('loop'))
+        self.jobs.put((f, fn, args))
+        return f
+
+    def work(self):
+        while True:
+            f, fn, args = self.jobs.get()
+            try:
+                f.set_result(fn(*args))
+            except Exception as e:
+                f.set_exception(e)
+
+class eventloop:
+    def __init__(self, workers = 4):
+        global LOOP
+        self.ready = deque()
+        self.timers = list()
+        self.sequence = 0
+        self.lock = Lock()
+        self.running = False
+        self.thread = None
+        self.pid = os.getpid()
+        self.rfd, self.wfd = os.pipe()
+        fcntl(self.rfd, F_SETFL, fcntl(self.rfd, F_GETFL) | os.O_NONBLOCK)
+        self.woken = False
+        # fd -> (callback, args)
+        self.readers = dict()
+        self.poller = None
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.poller.register(self.rfd, select.EPOLLIN)
+        # the pool is started on first use, the 'threads' runtime only uses the loop for I/O
+        self.workers = workers
+        self.executor = None
+        LOOP = self
+
+    """ Run callback(*args) on the loop thread, may be called from any thread """
+    def call_soon(self, callback, *args):
+        self.ready.append((callback, args))
+        self.wakeup()
+
+    """ Run callback(*args) on the loop thread after delay seconds """
+    def call_later(self, delay, callback, *args):
+        with self.lock:
+            self.sequence += 1
+            heappush(self.timers, (time() + delay, self.sequence, callback, args))
+        self.wakeup()
+
+    def wakeup(self):
+        if self.thread is not currentThread() and not self.woken:
+            self.woken = True
+            os.write(self.wfd, 'x')
+
+    """ Run a coroutine on the loop, returns a future for its return value """
+    def spawn(self, coroutine):
+        task = future(self)
+        self.call_soon(self.step, coroutine, task, None, None)
+        return task
+
+    """ Run a synchronous function on the executor thread pool, returns a future for its result """
+    def run_in_executor(self, fn, *args):
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = executor(self.workers, 'loopexecutor')
+        return self.executor.submit(fn, *args, loop=self)
+
+    """ Run callback(*args) on the loop thread whenever fd is readable, may be called from any thread """
+    def add_reader(self, fd, callback, *args):
+        with self.lock:
+            if self.poller is not None:
+                if fd in self.readers:
+                    self.poller.modify(fd, select.EPOLLIN)
+                else:
+                    self.poller.register(fd, select.EPOLLIN)
+            self.readers[fd] = (callback, args)
+        self.wakeup()
+
+    """ Stop watching fd, returns False if it was not registered """
+    def remove_reader(self, fd):
+        with self.lock:
+            if self.readers.pop(fd, None) is None:
+                return False
+            if self.poller is not None:
+                try:
+                    self.poller.unregister(fd)
+                except (IOError, OSError):
+                    # already closed
+                    pass
+        self.wakeup()
+        return True
+
+    """ Run the reader of fd, unless it was removed after fd became readable """
+    def read(self, fd):
+        reader = self.readers.get(fd)
+        if reader is not None:
+            reader[0](*reader[1])
+
+    """ Wait up to timeout seconds (None for no limit), returns the readable file descriptors """
+    def poll(self, timeout):
+        try:
+            if self.poller is not None:
+                return [ fd for fd, mask in self.poller.poll(-1 if timeout is None else timeout) ]
+            return select.select([self.rfd] + self.readers.keys(), [], [], timeout)[0]
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] != errno.EINTR: raise
+            return []
+
+    """ Advance a coroutine until it waits or finishes """
+    def step(self, coroutine, task, value, error):
+        try:
+            if error is not None:
+                waitfor = coroutine.throw(error)
+            else:
+                waitfor = coroutine.send(value)
+        except StopIteration as e:
+            # a coroutine returns a value with raise StopIteration(value)
+            task.set_result(e.args[0] if e.args else None)
+            return
+        except Exception as e:
+            task.set_exception(e)
+            return
+
+        if isinstance(waitfor, future):
+            waitfor.add_done_callback(lambda f: self.step(coroutine, task, f.value, f.error))
+        elif isinstance(waitfor, GeneratorType):
+            self.spawn(waitfor).add_done_callback(lambda f: self.step(coroutine, task, f.value, f.error))
+        elif isinstance(waitfor, (int, long, float)):
+            self.call_later(waitfor, self.step, coroutine, task, None, None)
+        else:
+            self.call_soon(self.step, coroutine, task, None,
+                           TypeError('Coroutine yielded {!r}, expected seconds or a future'.format(waitfor)))
+
+    """ Run the loop in the calling thread until stop() is called """
+    def run(self):
+        self.thread = currentThread()
+        self.running = True
+        while self.running:
+            timeout = None
+            if self.ready:
+                timeout = 0
+            elif self.timers:
+                timeout = max(0, self.timers[0][0] - time())
+            readable = self.poll(timeout)
+            if self.woken:
+                self.woken = False
+                try:
+                    os.read(self.rfd, 4096)
+                except OSError as e:
+                    if e.errno != errno.EAGAIN: raise
+            for fd in readable:
+                if fd in self.readers:
+                    self.ready.append((self.read, (fd, )))
+
+            now = time()
+            with self.lock:
+                while self.timers and self.timers[0][0] <= now:
+                    when, seq, callback, args = heappop(self.timers)
+                    self.ready.append((callback, args))
+            # run what is ready now, callbacks added while running wait for the next pass
+            for i in range(len(self.ready)):
+                callback, args = self.ready.popleft()
+                try:
+                    callback(*args)
+                except Exception:
+                    logger.exception("Event loop callback failed: %s", callback)
+        logger.debug("Event loop stopped")
+
+    """ Run the loop in a new daemon thread """
+    def start(self):
+        t = Thread(name='eventloop', target=self.run)
+        t.daemon = True
+        t.start()
+        return t
+
+    """ Stop the loop once the callbacks ready now have run, waits for the loop thread when called from another thread """
+    def stop(self, timeout = 5):
+        self.call_soon(setattr, self, 'running', False)
+        if self.thread is not None and self.thread is not currentThread():
+            self.thread.join(timeout)
+
+
+# MAIN #
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        datefmt='%Y/%m/%d-%H:%M:%S', level=logging.DEBUG)
+
+    loop = eventloop()
+
+    def blocking(seconds):
+        sleep(seconds)
+        return 'slept {}'.format(seconds)
+
+    def worker(name):
+        for i in range(3):
+            logger.debug('%s step %i', name, i)
+            yield 0.1
+        result = yield loop.run_in_executor(blocking, 0.2)
+        logger.debug('%s executor returned: %s', name, result)
+
+    # a reader, as an agent registers its socket or inotify descriptor
+    rfd, wfd = os.pipe()
+    def readable():
+        logger.debug('reader got: %s', os.read(rfd, 4096))
+    loop.add_reader(rfd, readable)
+    loop.call_later(0.2, os.write, wfd, 'data from a file descriptor')
+
+    done = [loop.spawn(worker('coroutine {}'.format(n))) for n in range(3)]
+    done[-1].add_done_callback(lambda f: loop.remove_reader(rfd))
+    done[-1].add_done_callback(lambda f: loop.stop())
+    loop.run()
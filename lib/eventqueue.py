@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This core library provides the priority aware event queue used by the mcp core.
+
+Events are placed in one of several priority classes, and the highest class with queued events is served first.
+A class is picked by the priority the event declares, or else by its event id or event type (see PRIORITYMAP).
+To keep lower classes from starving, a class passed over 'starvation' times in a row is served next.
+"""
+from Queue import Queue
+from collections import deque
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# priority classes, highest first
+PRIORITIES = ('critical', 'high', 'normal', 'low')
+# default priority class by event id or event type
+PRIORITYMAP = { 'shutdown':    'critical',
+                'subscribe':   'high',
+                'unsubscribe': 'high',
+                'command':     'high' }
+
+class eventqueue(Queue):
+    def __init__(self, config = dict(), maxsize = 0):
+        self.prioritymap = dict(PRIORITYMAP)
+        self.prioritymap.update(config.get('priority', {}))
+        self.starvation = config.get('starvation', 20)
+        Queue.__init__(self, maxsize)
+
+    # the methods below are called by Queue with its mutex held
+    def _init(self, maxsize):
+        self.classes = [deque() for p in PRIORITIES]
+        self.index = dict((p, i) for i, p in enumerate(PRIORITIES))
+        self.default = self.index['normal']
+        self.skipped = [0] * len(PRIORITIES)
+        self.puts = [0] * len(PRIORITIES)
+        self.maxdepth = [0] * len(PRIORITIES)
+        self.size = 0
+
+    def _qsize(self, len = len):
+        return self.size
+
+    def _put(self, event):
+        i = self.classify(event)
+        self.classes[i].append(event)
+        self.size += 1
+        self.puts[i] += 1
+        if len(self.classes[i]) > self.maxdepth[i]:
+            self.maxdepth[i] = len(self.classes[i])
+
+    def _get(self):
+        classes = self.classes
+        first = 0
+        while not classes[first]:
+            first += 1
+        serve = first
+        # serve the lowest class that has waited too long, otherwise the highest with events
+        for i in range(len(classes) - 1, first, -1):
+            if classes[i]:
+                self.skipped[i] += 1
+                if self.skipped[i] > self.starvation and serve == first:
+                    serve = i
+        self.skipped[serve] = 0
+        self.size -= 1
+        return classes[serve].popleft()
+
+    """ Remove and return up to maxitems events, in priority order, waiting until at least one is queued
+        unless block is False. The queue lock is taken once for the whole batch.
+    """
+    def getmany(self, maxitems, block = True):
+        with self.not_empty:
+            while block and not self._qsize():
+                self.not_empty.wait()
+            events = [self._get() for i in range(min(maxitems, self._qsize()))]
+            self.not_full.notify(len(events))
+            return events
+
+    """ Mark count queued events as processed """
+    def task_done(self, count = 1):
+        with self.all_tasks_done:
+            unfinished = self.unfinished_tasks - count
+            if unfinished <= 0:
+                if unfinished < 0:
+                    raise ValueError('task_done() called too many times')
+                self.all_tasks_done.notify_all()
+            self.unfinished_tasks = unfinished
+
+    """ Remove and return the oldest event of the lowest priority class, None if the queue is empty """
+    def discard(self):
+        with self.mutex:
+            for i in range(len(self.classes) - 1, -1, -1):
+                if self.classes[i]:
+                    self.size -= 1
+                    self.unfinished_tasks -= 1
+                    if not self.unfinished_tasks:
+                        self.all_tasks_done.notify_all()
+                    self.not_full.notify()
+                    return self.classes[i].popleft()
+
+    """ Return the index of the priority class for an event """
+    def classify(self, event):
+        priority = event.eventpriority()
+        if priority is None:
+            priority = self.prioritymap.get(event.eventid()) or self.prioritymap.get(event.eventtype())
+        return self.index.get(priority, self.default)
+
+    """ Return per class queue depth, maximum depth and total events queued """
+    def stats(self):
+        with self.mutex:
+            return [ { 'priority': p, 'depth': len(self.classes[i]), 'maxdepth': self.maxdepth[i], 'queued': self.puts[i] }
+                     for i, p in enumerate(PRIORITIES) ]
+
+
+# MAIN #
+if __name__ == '__main__':
+    import logging
+    from lib.event import event
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        datefmt='%Y/%m/%d-%H:%M:%S', level=logging.DEBUG)
+
+    q = eventqueue({'starvation': 3})
+    for i in range(6):
+        q.put(event('openzwave', 'ValueChanged {}'.format(i), priority='low'))
+        q.put(event('openzwave', 'setValue {}'.format(i)))
+    q.put(event('command-user', 'porch on', 'command'))
+    q.put(event('shutdown'))
+    logger.debug('Queue stats: %s', q.stats())
+    while q.qsize():
+        logger.debug('Got event: %s', q.get().eventbody())
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This core library provides the event journal, an append only record of the events the mcp dispatches.
+
+The journal is a directory of segment files, each memory mapped and filled with records, one record per dispatched batch
+(group commit). When a segment is full a new one is started, and the oldest segments are removed once there are more
+than 'segments' of them or they are older than 'days'. Writes go to the mapped pages, which survive a crash of the
+mcp, and are synced to disk every 'commit' seconds.
+
+Segment layout:
+    header - 'MCJ', version (B)
+    record - payload length (I), time (d), the batch of events in the lib.wire encoding
+A zero payload length marks the end of the records in a segment.
+"""
+import os
+import mmap
+from struct import Struct, error as structerror
+from time import time, sleep
+from threading import Thread, Lock
+from logging import getLogger
+
+from lib.wire import encodebatch, decodebatch, encodable
+
+logger = getLogger(__name__)
+
+MAGIC = 'MCJ'
+VERSION = 1
+SEGMENTHEADER = Struct('<3sB')
+RECORD = Struct('<Id')
+PAGE = mmap.PAGESIZE
+
+class journal:
+    def __init__(self, config = dict()):
+        self.path = config.get('path', 'var/journal')
+        self.segmentsize = int(config.get('segment', 16)) * 1024 * 1024
+        self.segments = config.get('segments', 16)
+        self.days = config.get('days')
+        self.commit = config.get('commit', 1)
+        self.lock = Lock()
+        self.records = 0
+        self.bytes = 0
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        names = self.list()
+        # the journal always continues in a new segment
+        self.sequence = int(names[-1][8:16]) if names else 0
+        self.mm = None
+        self.open(self.segmentsize)
+        self.running = True
+        t = Thread(name='journal', target=self.flusher)
+        t.daemon = True
+        t.start()
+
+    """ Return the segment file names, oldest first """
+    def list(self):
+        return sorted(n for n in os.listdir(self.path) if n.startswith('journal-') and n.endswith('.seg'))
+
+    def open(self, size):
+        self.sequence += 1
+        self.file = open(os.path.join(self.path, 'journal-{:08d}.seg'.format(self.sequence)), 'w+b')
+        self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), size)
+        self.mm[0:SEGMENTHEADER.size] = SEGMENTHEADER.pack(MAGIC, VERSION)
+        self.offset = SEGMENTHEADER.size
+        self.flushed = 0
+        logger.debug("Journal segment %i started", self.sequence)
+
+    """ Sync the current segment and trim the file to the records written """
+    def finish(self):
+        self.mm.flush()
+        self.mm.close()
+        self.file.truncate(self.offset + RECORD.size)
+        self.file.close()
+
+    """ Start a new segment and apply the retention limits """
+    def rotate(self, size):
+        self.finish()
+        self.open(max(size, self.segmentsize))
+        names = self.list()
+        now = time()
+        for name in names[:-1]:
+            path = os.path.join(self.path, name)
+            if len(names) > self.segments or (self.days and now - os.path.getmtime(path) > self.days * 86400):
+                os.remove(path)
+                names.remove(name)
+                logger.info("Journal segment %s removed", name)
+
+    """ Append a batch of events as one record, events that cannot be encoded are logged and left out """
+    def append(self, events):
+        try:
+            payload = encodebatch(events)
+        except (TypeError, ValueError):
+            events = [ e for e in (encodable(e) for e in events) if e is not None ]
+            if not events:
+                return
+            payload = encodebatch(events)
+        with self.lock:
+            if not self.running:
+                # agents still emit events while they shut down, after the journal is closed
+                logger.debug("Journal closed, %i events not journaled", len(events))
+                return
+            end = self.offset + RECORD.size + len(payload)
+            # leave room for the end marker
+            if end + RECORD.size > len(self.mm):
+                self.rotate(SEGMENTHEADER.size + RECORD.size * 2 + len(payload))
+                end = self.offset + RECORD.size + len(payload)
+            self.mm[self.offset + RECORD.size:end] = payload
+            # the length is written last, a reader never sees a partial record
+            self.mm[self.offset:self.offset + RECORD.size] = RECORD.pack(len(payload), time())
+            self.offset = end
+            self.records += 1
+            self.bytes += len(payload)
+
+    """ Sync written records to disk every commit seconds """
+    def flusher(self):
+        while self.running:
+            sleep(self.commit)
+            with self.lock:
+                if self.running and self.offset > self.flushed:
+                    start = self.flushed - self.flushed % PAGE
+                    self.mm.flush(start, self.offset - start)
+                    self.flushed = self.offset
+
+    def close(self):
+        with self.lock:
+            self.running = False
+            self.finish()
+        logger.info("Journal closed - records: %i bytes: %i", self.records, self.bytes)
+
+    """ Return an iterator of (time, event) for journaled events between start and end (seconds since the epoch) """
+    def events(self, start = None, end = None):
+        # events journaled while iterating, such as replayed ones, are not included
+        if end is None or end > time():
+            end = time()
+        names = self.list()
+        for i, name in enumerate(names):
+            # skip segments that end before start, the next segment starts after them
+            if start is not None and i + 1 < len(names):
+                first = self.firsttime(names[i + 1])
+                if first is not None and first < start:
+                    continue
+            for t, e in self.segmentevents(name):
+                if start is not None and t < start:
+                    continue
+                if t > end:
+                    return
+                yield t, e
+
+    """ Queue journaled events between start and end with callback, such as mcp.queueevent, returns the number queued.
+        Only events of the given types are replayed, all events when types is None.
+    """
+    def replay(self, callback, start = None, end = None, types = None):
+        count = 0
+        for t, e in self.events(start, end):
+            if types is not None and e.eventtype() not in types:
+                continue
+            callback(e)
+            count += 1
+        logger.info("Journal replayed %i events", count)
+        return count
+
+    def firsttime(self, name):
+        for t, events in self.segmentrecords(name):
+            return t
+
+    def segmentevents(self, name):
+        for t, events in self.segmentrecords(name):
+            for e in events:
+                yield t, e
+
+    """ Iterate the (time, events) records of a segment """
+    def segmentrecords(self, name):
+        with open(os.path.join(self.path, name), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < SEGMENTHEADER.size + RECORD.size:
+                return
+            mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                magic, version = SEGMENTHEADER.unpack_from(mm, 0)
+                if magic != MAGIC or version != VERSION:
+                    logger.error("Journal segment %s has an unknown format, skipping", name)
+                    return
+                offset = SEGMENTHEADER.size
+                while offset + RECORD.size <= size:
+                    length, t = RECORD.unpack_from(mm, offset)
+                    if not length:
+                        break
+                    offset += RECORD.size
+                    # an mmap has no memoryview in python 2, each record is copied out once
+                    try:
+                        events = decodebatch(mm[offset:offset + length])
+                    except (ValueError, IndexError, structerror) as error:
+                        logger.error("Journal segment %s has a record that cannot be read at %s, skipping the rest: %s",
+                                     name, offset, error)
+                        return
+                    yield t, events
+                    offset += length
+            finally:
+                mm.close()
+
+
+# MAIN #
+if __name__ == '__main__':
+    import sys
+    import shutil
+    import tempfile
+    import logging
+    from lib.event import event
+    from lib.eventqueue import eventqueue
+    from lib.mailbox import mailbox
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        datefmt='%Y/%m/%d-%H:%M:%S', level=logging.INFO)
+
+    zwave = event.bind('agent.openzwave')
+    def zwaveevent(i):
+        return zwave('openzwave', 'Thermostat - Hallway: ValueChanged Temperature = {} F'.format(60 + i % 20),
+                     priority='low', coalesce=72057594109853697)
+
+    """ Queue and dispatch count events to two mailboxes in batches like the mcp dispatcher, return events per second """
+    def dispatch(count, j):
+        q = eventqueue()
+        mailboxes = [mailbox('bench{}'.format(i), lambda e: None) for i in range(2)]
+        start = time()
+        for i in xrange(count):
+            q.put(zwaveevent(i))
+        while q.qsize():
+            events = q.getmany(32)
+            if j is not None:
+                j.append(events)
+            for e in events:
+                for m in mailboxes:
+                    m.put(e)
+            q.task_done(len(events))
+        for m in mailboxes:
+            m.join()
+        return count / (time() - start)
+
+    # benchmark: python -m lib.journal --benchmark [events]
+    if '--benchmark' in sys.argv:
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        path = tempfile.mkdtemp()
+        try:
+            j = journal({'path': path, 'segment': 4, 'segments': 4})
+            base = dispatch(count, None)
+            rate = dispatch(count, j)
+            j.close()
+            print 'dispatch without journal: {:8.0f} events/s'.format(base)
+            print 'dispatch with journal:    {:8.0f} events/s ({:.0f}% of the rate, {:.1f} bytes/event)'.format(
+                rate, rate / base * 100, float(j.bytes) / count)
+            t = time()
+            replayed = sum(1 for e in j.events())
+            print 'read back {} events at {:.0f} events/s'.format(replayed, replayed / (time() - t))
+        finally:
+            shutil.rmtree(path)
+        sys.exit(0)
+
+    path = tempfile.mkdtemp()
+    j = journal({'path': path, 'segment': 1, 'segments': 2})
+    for n in range(5):
+        j.append([zwaveevent(i) for i in range(n * 3000, (n + 1) * 3000)])
+    middle = time()
+    j.append([event('xmpp_message', 'porch light is on')])
+    j.close()
+    logger.info('Segments: %s', j.list())
+    for t, e in j.events(middle):
+        logger.info('Replay: %s', e.dump())
+    shutil.rmtree(path)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This core library provides mailboxes, a bounded event queue and delivery thread for each subscriber.
+The dispatcher only places events in mailboxes, so a slow event handler delays its own events and no others.
+Mailboxes use the core priority event queue, so interactive events are not held up behind queued background events.
+
+Overflow policies, used when a mailbox is full:
+    block - wait for room in the mailbox, the dispatcher waits with it and so do the other mailboxes
+    dropnew - discard the new event
+    dropold - discard the oldest queued event of the lowest priority to make room for the new one
+The mcp uses dropold unless the config asks for another policy.
+"""
+from Queue import Full
+from threading import Thread, Event
+from inspect import isgeneratorfunction
+from types import GeneratorType
+from logging import getLogger
+
+from lib.eventqueue import eventqueue
+from lib.eventloop import runsync
+
+logger = getLogger(__name__)
+
+OVERFLOW = ('block', 'dropnew', 'dropold')
+
+class mailbox:
+    def __init__(self, name, handler = None, size = 0, overflow = 'block', priority = dict()):
+        self.name = name
+        self.handler = handler
+        if overflow not in OVERFLOW:
+            logger.error("Mailbox '%s' unknown overflow policy '%s', using 'block'", name, overflow)
+            overflow = 'block'
+        self.overflow = overflow
+        self.queue = eventqueue(priority, size)
+        self.dropped = 0
+        # events are held until a handler is attached
+        self.attached = Event()
+        if handler is not None: self.attached.set()
+        self.start()
+
+    def start(self):
+        self.thread = Thread(name='mailbox-'+ self.name, target=self.deliver)
+        self.thread.daemon = True
+        self.thread.start()
+
+    """ Set the handler events are delivered to and start delivery """
+    def attach(self, handler):
+        self.handler = handler
+        self.attached.set()
+
+    """ Queue an event for delivery, returns False if the event or an older one was dropped """
+    def put(self, event):
+        # shutdown must always be delivered
+        if self.overflow == 'block' or event.eventid() == 'shutdown':
+            self.queue.put(event)
+            return True
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except Full:
+            pass
+
+        self.dropped += 1
+        if self.overflow == 'dropold':
+            self.queue.discard()
+            try:
+                self.queue.put_nowait(event)
+            except Full:
+                pass
+        logger.warning("Mailbox '%s' full, %s (%i dropped)", self.name, self.overflow, self.dropped)
+        return False
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    """ Wait until all queued events have been handled """
+    def join(self):
+        self.queue.join()
+
+    def deliver(self):
+        self.attached.wait()
+        while True:
+            e = self.queue.get()
+            try:
+                result = self.handler(e)
+                # a coroutine eventhandler is run to completion on this thread
+                if isinstance(result, GeneratorType):
+                    runsync(result)
+            except Exception:
+                logger.exception("Mailbox '%s' handler failed for event: %s", self.name, e.dump())
+            self.queue.task_done()
+
+"""
+    A mailbox served by an event loop instead of its own thread.
+    Events are handled one at a time in order, a coroutine eventhandler runs on the loop and
+    any other eventhandler runs on the loop's executor thread pool.
+    The loop thread cannot wait for room, so the block overflow policy does not limit the size.
+"""
+class loopmailbox(mailbox):
+    def __init__(self, name, handler, loop, size = 0, overflow = 'block', priority = dict()):
+        self.loop = loop
+        self.busy = False
+        if overflow == 'block': size = 0
+        mailbox.__init__(self, name, handler, size, overflow, priority)
+
+    def start(self):
+        pass
+
+    def attach(self, handler):
+        mailbox.attach(self, handler)
+        self.loop.call_soon(self.deliver)
+
+    def put(self, event):
+        queued = mailbox.put(self, event)
+        self.loop.call_soon(self.deliver)
+        return queued
+
+    """ Start handling the next event, runs on the loop thread """
+    def deliver(self):
+        if self.busy or self.handler is None:
+            return
+        events = self.queue.getmany(1, False)
+        if not events:
+            return
+        self.busy = True
+        if isgeneratorfunction(self.handler):
+            done = self.loop.spawn(self.handler(events[0]))
+        else:
+            done = self.loop.run_in_executor(self.handler, events[0])
+        done.add_done_callback(lambda f: self.delivered(events[0], f))
+
+    def delivered(self, event, done):
+        if done.exception() is not None:
+            logger.error("Mailbox '%s' handler failed for event: %s: %s", self.name, event.dump(), done.exception())
+        self.queue.task_done()
+        self.busy = False
+        self.deliver()
+
+
+# MAIN #
+if __name__ == '__main__':
+    import logging
+    from time import sleep
+    from lib.event import event
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        datefmt='%Y/%m/%d-%H:%M:%S', level=logging.DEBUG)
+
+    def slowhandler(e):
+        logger.debug('Slow handler got event: %s', e.eventbody())
+        sleep(0.5)
+
+    m = mailbox('slow', slowhandler, 2, 'dropold')
+    for i in range(5):
+        m.put(event('test', 'event {}'.format(i)))
+    logger.debug('Queued 5 events, %i dropped', m.dropped)
+    m.join()
@@ -6,42 +6,119 @@ See timetools for more information on ways to specify time.
 """
 from time import time, strftime, localtime
 import logging
-from threading import Timer
+from threading import Thread, Condition, RLock
+from heapq import heappush, heappop, heapify
 
 from lib.event import event
-from lib.timetools import inseconds
-from lib.command import command
+from lib.timetools import timespec
 
 logger = logging.getLogger(__name__)
 
+"""
+    Single thread timer engine.
+    Pending calls are kept in one min-heap ordered by fire time and served by one thread,
+    adding is O(log n) and cancelling marks the entry so it is discarded when it reaches the top.
+"""
+class timer:
+    def __init__(self, name = 'timer'):
+        self.heap = list()
+        self.sequence = 0
+        self.cancelled = 0
+        self.cond = Condition()
+        self.thread = Thread(name=name, target=self.loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    """ Call callback with args after delay seconds, returns a handle for cancel """
+    def call(self, delay, callback, args = ()):
+        with self.cond:
+            self.sequence += 1
+            # [fire time, tie breaker, callback, args]
+            entry = [time() + delay, self.sequence, callback, args]
+            heappush(self.heap, entry)
+            # wake the timer thread only when the next fire time moved earlier
+            if self.heap[0] is entry:
+                self.cond.notify()
+        return entry
+
+    """ Cancel a pending call, returns False if it already ran or was cancelled """
+    def cancel(self, entry):
+        with self.cond:
+            if entry[2] is None:
+                return False
+            entry[2] = None
+            self.cancelled += 1
+            # drop cancelled entries once they make up most of the heap
+            if self.cancelled > 64 and self.cancelled * 2 > len(self.heap):
+                self.heap = [e for e in self.heap if e[2] is not None]
+                heapify(self.heap)
+                self.cancelled = 0
+        return True
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while True:
+                    while self.heap and self.heap[0][2] is None:
+                        heappop(self.heap)
+                        self.cancelled -= 1
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    delay = self.heap[0][0] - time()
+                    if delay <= 0:
+                        entry = heappop(self.heap)
+                        break
+                    self.cond.wait(delay)
+                callback, args = entry[2], entry[3]
+                entry[2] = None
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception("Timer callback failed: {}".format(callback))
+
 class schedule:
     def __init__(self, queueevent, config):
         self.queueevent = queueevent 
         self.config = config
         self.events = dict()
+        # each add gets a new generation, a timer only runs the schedule it was added with
+        self.generation = 0
+        self.lock = RLock()
+        self.timer = timer('schedule')
 
         #for e in config['events']:
         #    logger.debug('Loading stored event: {}'.format(event))
         #    self.add(e.id, e.when, event(**e.event))
 
+    """ Schedule an event, when is a time definition dict or a compiled timespec """
     def add(self, id, when, event):
-        interval = inseconds(when)
+        spec = when if isinstance(when, timespec) else timespec(when)
+        interval = spec.inseconds()
+        if interval is None:
+            logger.error("Schedule id '{}' does not match any time in the future, skipping".format(id))
+            return
         target = strftime("%a, %d %b %Y %H:%M:%S %Z", localtime(interval + time()))
-        logger.debug("Adding schedule id '{}' to run on {} ({} seconds)".format(id, strftime("%a, %d %b %Y %H:%M:%S %Z", localtime(interval + time())), interval))
-        if when.has_key('recurring') and when['recurring']:
-            self.events[id] = {'timer': Timer(interval, self.runreschedule, (id, when, event)), 'target': target, 'when': when, 'event': event}
-        else:
-            self.events[id] = {'timer': Timer(interval, self.run, (id, event)), 'target': target, 'when': when, 'event': event}
-        self.events[id]['timer'].start()
+        logger.debug("Adding schedule id '{}' to run on {} ({} seconds)".format(id, target, interval))
+        with self.lock:
+            if id in self.events:
+                self.timer.cancel(self.events[id]['timer'])
+            self.generation += 1
+            self.events[id] = {'timer': self.timer.call(interval, self.run, (id, self.generation)), 'target': target,
+                               'when': spec.when, 'spec': spec, 'event': event, 'generation': self.generation}
 
     def remove(self, id):
         logger.debug('Removing shedule id: {}'.format(id))
-        e = self.events.pop(id, None)
+        with self.lock:
+            e = self.events.pop(id, None)
         if e == None:
             logger.debug("Could not remove shedule: '{}' - not found".format(id))
             return True 
             
-        e['timer'].cancel()
+        self.timer.cancel(e['timer'])
         return False
 
     def removeall(self):
@@ -57,29 +134,71 @@ class schedule:
 
     def list(self):
         slist = list()
-        for id in self.events:
-            slist.append({ 'id': id, 'target': self.events['target'] })
+        for id in self.events.keys():
+            slist.append({ 'id': id, 'target': self.events[id]['target'] })
         return slist
 
-    def run(self, id, event):
-        logger.debug("Running schedule: '{}' event: '{}'".format(id, event))
-        self.queueevent(event)
-        self.remove(id)
-
-    def runreschedule(self, id, when, event):
-        logger.debug("Running recurring schedule: '{}' event: '{}'".format(id, event))
-        self.queueevent(event)
-        self.remove(id)
-        self.add(id, when, event)
+    """ Called from the timer thread, queue the event and reschedule it if recurring.
+        A schedule replaced by add() while its timer was already running is left to its own timer.
+    """
+    def run(self, id, generation):
+        with self.lock:
+            e = self.events.get(id)
+            if e == None or e['generation'] != generation:
+                return
+            del self.events[id]
+        logger.debug("Running schedule: '{}' event: '{}'".format(id, e['event']))
+        self.queueevent(e['event'])
+        if e['spec'].recurring:
+            self.add(id, e['spec'], e['event'])
 
 # MAIN #
 if __name__ == '__main__':
+    import sys
     logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
 	                datefmt='%Y/%m/%d-%H:%M:%S', level=logging.DEBUG)
 
     def dummycallback(event):
             logger.debug('Callback received event: %s', event.eventbody())
 
+    # benchmark: python -m lib.schedule --benchmark [count]
+    if '--benchmark' in sys.argv:
+        from threading import Timer, active_count
+        from resource import getrusage, RUSAGE_SELF
+        logging.getLogger().setLevel(logging.WARNING)
+        count = int(sys.argv[-1]) if sys.argv[-1].isdigit() else 10000
+
+        def report(label, started):
+            print '{:28} threads: {:6} max rss: {:8} KB  time: {:.2f}s'.format(label,
+                active_count(), getrusage(RUSAGE_SELF).ru_maxrss, time() - started)
+
+        report('baseline', time())
+        started = time()
+        s = schedule(dummycallback, {})
+        for i in xrange(count):
+            s.add('bench {}'.format(i), {'seconds': 3600 + i}, event('openzwave', 'healNetwork', 'message'))
+        report('{} schedules (timer heap)'.format(count), started)
+        s.removeall()
+
+        # one threading.Timer per schedule, as the scheduler used to do. Each sleeping Timer thread wakes every
+        # few milliseconds to poll, so starting them slows down as they add up, the run stops after 'budget' seconds
+        budget = 30
+        started = time()
+        timers = list()
+        try:
+            for i in xrange(count):
+                timers.append(Timer(3600 + i, dummycallback, (None,)))
+                timers[-1].start()
+                if time() - started > budget:
+                    print 'threading.Timer stopped after {} of {} timers, starting them took over {} seconds'.format(
+                        len(timers), count, budget)
+                    break
+        except Exception as e:
+            print 'threading.Timer failed after {} timers: {}'.format(len(timers), e)
+        report('{} threading.Timer'.format(len(timers)), started)
+        for t in timers: t.cancel()
+        sys.exit(0)
+
     s = schedule(dummycallback, {})
     logger.debug('Scheduling events')
 
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This core library stores the mcp state, such as the state dict of each agent, and restores it at startup.
+
+The state is split into units, the values found 'depth' levels down the state dict (by default one unit per item
+under each key of an agent's state, for example each node in state['agent']['openzwave']['nodes']). A checkpoint appends only the units
+that changed since the last checkpoint to the state file, along with a removal record for
+units that are gone. Restore reads the file and the last record of each unit wins. Once the file holds
+'compact' times more than the live state it is rewritten with the live units only.
+
+Checkpoints run every 'interval' seconds and on store(). Changes are found by comparing a digest of each unit's
+pickle, which is cheap to produce, and changed units are stored encoded with lib.wire, or pickled if they hold
+other objects. Values shared between units, or within a unit, are restored as separate copies.
+
+Record layout: length (I), then the path encoded with lib.wire, and the value as 'W' and the lib.wire encoding,
+'P' and a pickle, or 'D' for a removed unit.
+"""
+import os
+import cPickle as pickle
+from hashlib import sha1
+from struct import Struct
+from threading import Lock
+from time import time
+from logging import getLogger
+
+from lib.wire import encodedata, decodedata
+from lib.schedule import timer
+
+logger = getLogger(__name__)
+
+LENGTH = Struct('<I')
+PATHLENGTH = Struct('<H')
+REMOVED = 'D'
+
+class storage:
+    def __init__(self, config, state):
+        self.state = state
+        self.file = config.get('file', 'var/mcp.state')
+        self.depth = config.get('depth', 4)
+        self.interval = config.get('interval', 60)
+        self.compactratio = config.get('compact', 4)
+        self.lock = Lock()
+        # digest of each stored unit and the size of its record
+        self.digests = dict()
+        self.sizes = dict()
+        self.size = 0
+        # units that could not be stored, logged once until they can be
+        self.failed = set()
+        self.timer = None
+        if os.path.dirname(self.file) and not os.path.isdir(os.path.dirname(self.file)):
+            os.makedirs(os.path.dirname(self.file))
+
+    """ Start periodic checkpoints """
+    def start(self):
+        if self.interval:
+            self.timer = timer('storage')
+            self.timer.call(self.interval, self.periodic)
+
+    def periodic(self):
+        try:
+            self.checkpoint()
+        finally:
+            self.timer.call(self.interval, self.periodic)
+
+    """ Checkpoint the state, called by the mcp on shutdown """
+    def store(self):
+        return self.checkpoint()
+
+    """ Return (path, value) for each unit of the state """
+    def units(self, node = None, path = ()):
+        if node is None:
+            node = self.state
+        if len(path) == self.depth or not isinstance(node, dict) or not node:
+            yield path, node
+            return
+        for key, value in node.items():
+            for unit in self.units(value, path + (key, )):
+                yield unit
+
+    def digest(self, value):
+        try:
+            return sha1(pickle.dumps(value, 2)).digest()
+        except (pickle.PicklingError, TypeError):
+            return sha1(self.encode(value)).digest()
+
+    def encode(self, value):
+        try:
+            return 'W'+ encodedata(value)
+        except TypeError:
+            return 'P'+ pickle.dumps(value, 2)
+
+    def decode(self, buf):
+        if buf[0] == 'W':
+            return decodedata(buf[1:])
+        return pickle.loads(buf[1:])
+
+    def record(self, path, value):
+        encpath = encodedata(path)
+        payload = PATHLENGTH.pack(len(encpath)) + encpath + value
+        return LENGTH.pack(len(payload)) + payload
+
+    """ Append the units that changed since the last checkpoint to the state file, returns the number written """
+    def checkpoint(self):
+        start = time()
+        with self.lock:
+            records = list()
+            seen = set()
+            for path, value in self.units():
+                seen.add(path)
+                try:
+                    digest = self.digest(value)
+                    if self.digests.get(path) == digest:
+                        continue
+                    r = self.record(path, self.encode(value))
+                except RuntimeError:
+                    # changed by its agent while encoding, it is stored at the next checkpoint
+                    continue
+                except Exception:
+                    # neither pickled nor encoded, the other units are still stored
+                    if path not in self.failed:
+                        self.failed.add(path)
+                        logger.exception("Storage unit %s cannot be stored, skipping it", '/'.join(map(str, path)))
+                    continue
+                self.failed.discard(path)
+                self.digests[path] = digest
+                self.sizes[path] = len(r)
+                records.append(r)
+            for path in set(self.digests) - seen:
+                del self.digests[path]
+                del self.sizes[path]
+                records.append(self.record(path, REMOVED))
+            if not records:
+                return 0
+
+            data = ''.join(records)
+            with open(self.file, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            self.size += len(data)
+            logger.debug("Storage checkpoint - units written: %i bytes: %i in %.3f seconds",
+                         len(records), len(data), time() - start)
+            if self.size > sum(self.sizes.itervalues()) * self.compactratio and self.size > 65536:
+                self.compact()
+            return len(records)
+
+    """ Rewrite the state file with the stored units only """
+    def compact(self):
+        live = self.read()
+        data = ''.join(self.record(path, buf) for path, buf in live.iteritems())
+        tmp = self.file +'.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.file)
+        logger.info("Storage compacted - %i bytes to %i bytes", self.size, len(data))
+        self.size = len(data)
+
+    """ Return the last stored encoding of each unit in the state file """
+    def read(self):
+        live = dict()
+        if not os.path.exists(self.file):
+            return live
+        with open(self.file, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + LENGTH.size <= len(data):
+            length = LENGTH.unpack_from(data, offset)[0]
+            offset += LENGTH.size
+            if offset + length > len(data):
+                offset -= LENGTH.size
+                logger.warning("Storage file '%s' ends with a partial record, removing it", self.file)
+                with open(self.file, 'r+b') as f:
+                    f.truncate(offset)
+                break
+            pathlength = PATHLENGTH.unpack_from(data, offset)[0]
+            path = decodedata(data[offset + PATHLENGTH.size:offset + PATHLENGTH.size + pathlength])
+            buf = data[offset + PATHLENGTH.size + pathlength:offset + length]
+            offset += length
+            if buf == REMOVED:
+                live.pop(path, None)
+            else:
+                live[path] = buf
+        self.size = offset
+        return live
+
+    """ Load the stored state into the state dict, before agents are loaded. Returns the number of units restored. """
+    def restore(self):
+        start = time()
+        with self.lock:
+            live = self.read()
+            for path, buf in sorted(live.iteritems(), key=lambda unit: len(unit[0])):
+                try:
+                    value = self.decode(buf)
+                except Exception:
+                    logger.exception("Storage could not restore %s", '/'.join(str(p) for p in path))
+                    continue
+                self.digests[path] = self.digest(value)
+                self.sizes[path] = len(self.record(path, buf))
+                if not path:
+                    self.state.update(value)
+                    continue
+                node = self.state
+                for key in path[:-1]:
+                    node = node.setdefault(key, dict())
+                node[path[-1]] = value
+        logger.info("Storage restored %i units from '%s' in %.3f seconds", len(live), self.file, time() - start)
+        return len(live)
+
+
+# MAIN #
+if __name__ == '__main__':
+    import sys
+    import shutil
+    import tempfile
+    import logging
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        datefmt='%Y/%m/%d-%H:%M:%S', level=logging.INFO)
+
+    """ State like that of an openzwave network with count nodes of 10 values """
+    def zwavestate(count):
+        nodes = dict()
+        for n in range(count):
+            values = dict((72057594076479506 + n * 1000 + v, {'id': 72057594076479506 + n * 1000 + v, 'label': u'Value {}'.format(v),
+                           'value': 20.5 + v, 'units': u'F', 'readonly': False, 'updated': time()}) for v in range(10))
+            nodes[n] = {'name': 'Node {} - Room {}'.format(n, n % 7), 'lastseen': time(), 'values': values}
+        return {'agent': {'openzwave': {'nodes': nodes, 'homeid': 25480663},
+                          'xmpp_message': {'roster': ['user1@DOMAIN', 'user2@DOMAIN']}}}
+
+    path = tempfile.mkdtemp()
+    try:
+        config = {'file': os.path.join(path, 'mcp.state'), 'depth': 4, 'interval': 0}
+        state = zwavestate(200)
+        s = storage(config, state)
+        t = time()
+        full = s.checkpoint()
+        tfull = time() - t
+        state['agent']['openzwave']['nodes'][3]['values'][72057594076482506]['value'] = 99
+        t = time()
+        changed = s.checkpoint()
+        tdiff = time() - t
+        print 'full checkpoint: {} units in {:.1f} ms, one value changed: {} unit in {:.1f} ms, file {} bytes'.format(
+            full, tfull * 1000, changed, tdiff * 1000, os.path.getsize(config['file']))
+
+        restored = dict()
+        t = time()
+        storage(config, restored).restore()
+        print 'restore in {:.1f} ms, same state: {}'.format((time() - t) * 1000, restored == state)
+        if '--benchmark' in sys.argv:
+            t = time()
+            pickle.dump(state, open(os.path.join(path, 'full.pickle'), 'wb'), 2)
+            print 'full pickle snapshot for comparison: {:.1f} ms, {} bytes'.format(
+                (time() - t) * 1000, os.path.getsize(os.path.join(path, 'full.pickle')))
+    finally:
+        shutil.rmtree(path)
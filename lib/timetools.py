@@ -212,53 +212,191 @@ def randomize(when, seconds = None):
 
 
 '''
-    Convert the various time definitions to a time in seconds from now
+    Return the lowest bit number set in mask that is >= start, or -1 if there is none
 '''
-# TODO: convert subroutines to return time/date structure that inseconds will convert to seconds from now
-# TODO: modify subroutines to accept nowst peramiter for current time like matchtime
-def inseconds(when, nowst = None, seconds = None):
-    # FIXME: make DST aware
-    if not nowst: nowst = localtime()
-    sectmp = timedelta(when)
-    if sectmp and seconds: seconds += sectmp
-    elif sectmp: seconds = sectmp
-
-    st = specifictime(when, nowst)
-
-    if st:
-        if seconds == None: seconds = 0
-        seconds += mktime(st) - mktime(nowst) 
-    elif ('secondlist' in when and when['secondlist'] != None) or \
-         ('minutelist' in when and when['minutelist'] != None) or \
-         ('hourlist' in when and when['hourlist'] != None) or \
-         ('daylist' in when and when['daylist'] != None) or \
-         ('dowlst' in when and when['dowlist'] != None) or \
-         ('monthlist' in when and when['monthlist'] != None) or \
-         ('daynames' in when and when['daynames'] != None) or \
-         ('monthnames' in when and when['monthnames'] != None) :
-
-        if 'daynames' in when and when['daynames'] != None:
-            when['dowlist'] = convertdaynames(when['daynames'])
-        if 'monthnames' in when and when['monthnames'] != None:
-            when['monthlist'] = convertmonthnames(when['monthnames'])
-
-        mst = matchtime(when, nowst)
-
-        if mst:
+def nextbit(mask, start):
+    mask >>= start
+    if not mask: return -1
+    return start + (mask & -mask).bit_length() - 1
+
+
+'''
+    Convert a list of numbers to a bitmask, or return allmask if the list is not defined
+'''
+def tomask(values, allmask):
+    if values == None: return allmask
+    mask = 0
+    for v in values:
+        mask |= 1 << v
+    return mask
+
+
+# bitmasks matching every month (1-12), day (1-31), day of week (0-6), hour (0-23), minute and second (0-59)
+ALLMONTHS  = 0x1ffe
+ALLDAYS    = 0xfffffffe
+ALLDOWS    = 0x7f
+ALLHOURS   = 0xffffff
+ALLMINUTES = (1 << 60) - 1
+# lowest value of year, month, day, hour, minute, second
+FIELDMIN   = (None, 1, 1, 0, 0, 0)
+
+
+'''
+    Expand a bitmask to a table giving the next set bit at or after each index up to size, -1 past the last one
+'''
+def nexttable(mask, size):
+    return tuple(nextbit(mask, v) for v in range(size + 1))
+
+
+'''
+    A time definition compiled once into bitmasks so the next occurrence can be calculated repeatedly.
+    The wildcard fields are matched by skipping ahead field by field from the current time,
+    calculating the same times as matchtime without calling mktime for every candidate.
+'''
+class timespec:
+    def __init__(self, when):
+        self.when = when
+        self.recurring = bool(when.get('recurring'))
+        self.delta = timedelta(when)
+
+        monthlist = when.get('monthlist')
+        if when.get('monthnames') != None:
+            monthlist = convertmonthnames(when['monthnames'])
+        dowlist = when.get('dowlist')
+        if when.get('daynames') != None:
+            dowlist = convertdaynames(when['daynames'])
+
+        fields = (when.get('yearlist'), monthlist, when.get('daylist'),
+                  when.get('hourlist'), when.get('minutelist'), when.get('secondlist'))
+        # the wildcard definition is only used if a field below year or a day of week is given
+        self.wildcard = any(f != None for f in fields[1:]) or dowlist != None
+        # the last field given, recurring schedules skip the rest of its current period
+        self.lastmatch = None
+        for i, f in enumerate(fields):
+            if f != None: self.lastmatch = i
+
+        self.years = tuple(sorted(fields[0])) if fields[0] != None else None
+        self.months = tomask(fields[1], ALLMONTHS)
+        self.days = tomask(fields[2], ALLDAYS)
+        # like matchtime, the day of week list only applies when there is no day list
+        self.dows = tomask(dowlist, ALLDOWS) if fields[2] == None else ALLDOWS
+        self.hours = tomask(fields[3], ALLHOURS)
+        self.minutes = tomask(fields[4], ALLMINUTES)
+        self.seconds = tomask(fields[5], ALLMINUTES)
+
+        # indexing one past the highest value gives -1, so carrying into the next field needs no range checks
+        self.nextmonth = nexttable(self.months, 13)
+        self.nexthour = nexttable(self.hours, 24)
+        self.nextminute = nexttable(self.minutes, 60)
+        self.nextsecond = nexttable(self.seconds, 60)
+        self.nextday = dict()
+
+    '''
+        Return the next day table for a month, the day mask limited to the days in the month
+        and the day of week list, cached per year and month
+    '''
+    def daytable(self, year, month):
+        firstdow, ndays = monthrange(year, month)
+        mask = self.days & ((1 << (ndays + 1)) - 1)
+        if self.dows != ALLDOWS:
+            dowdays = 0
+            for dow in range(7):
+                if self.dows & (1 << dow):
+                    for day in range(1 + (dow - firstdow) % 7, ndays + 1, 7):
+                        dowdays |= 1 << day
+            mask &= dowdays
+        table = self.nextday[(year, month)] = nexttable(mask, 32)
+        return table
+
+    '''
+        Return the next matching time at or after nowst as a (year, month, day, hour, minute, second) tuple,
+        or None if there is no match this year or next (or in the year list).
+    '''
+    def nextmatch(self, nowst):
+        y, mo, d, h, mi, s = nowst[:6]
+        if self.recurring and self.lastmatch != None:
+            start = [y, mo, d, h, mi, s]
+            start[self.lastmatch] += 1
+            start[self.lastmatch + 1:] = FIELDMIN[self.lastmatch + 1:]
+            y, mo, d, h, mi, s = start
+        years = self.years or (nowst[0], nowst[0] + 1)
+        lastyear = years[-1]
+        nextmonth, nexthour = self.nextmonth, self.nexthour
+        nextminute, nextsecond = self.nextminute, self.nextsecond
+        daysfor = days = None
+
+        while y <= lastyear:
+            if y not in years:
+                y, mo, d, h, mi, s = y + 1, 1, 1, 0, 0, 0
+                continue
+            nmo = nextmonth[mo]
+            if nmo < 0:
+                y, mo, d, h, mi, s = y + 1, 1, 1, 0, 0, 0
+                continue
+            if nmo != mo: mo, d, h, mi, s = nmo, 1, 0, 0, 0
+            if daysfor != (y, mo):
+                daysfor = (y, mo)
+                days = self.nextday.get(daysfor) or self.daytable(y, mo)
+            nd = days[d]
+            if nd < 0:
+                mo, d, h, mi, s = mo + 1, 1, 0, 0, 0
+                continue
+            if nd != d: d, h, mi, s = nd, 0, 0, 0
+            nh = nexthour[h]
+            if nh < 0:
+                d, h, mi, s = d + 1, 0, 0, 0
+                continue
+            if nh != h: h, mi, s = nh, 0, 0
+            nmi = nextminute[mi]
+            if nmi < 0:
+                h, mi, s = h + 1, 0, 0
+                continue
+            if nmi != mi: mi, s = nmi, 0
+            ns = nextsecond[s]
+            if ns < 0:
+                mi, s = mi + 1, 0
+                continue
+            return (y, mo, d, h, mi, ns)
+        return None
+
+    '''
+        Convert the time definition to a time in seconds from nowst (default now)
+    '''
+    def inseconds(self, nowst = None, seconds = None):
+        # FIXME: make DST aware
+        if not nowst: nowst = localtime()
+        if self.delta and seconds: seconds += self.delta
+        elif self.delta: seconds = self.delta
+
+        st = specifictime(self.when, nowst)
+
+        if st:
             if seconds == None: seconds = 0
-            seconds += mktime(mst) - mktime(nowst)
+            seconds += mktime(st) - mktime(nowst)
+        elif self.wildcard:
+            mst = self.nextmatch(nowst)
+            if mst:
+                if seconds == None: seconds = 0
+                seconds += mktime(mst + (0, 0, -1)) - mktime(nowst)
 
-    if seconds != None: 
-        seconds = randomize(when, seconds)
+        if seconds != None:
+            seconds = randomize(self.when, seconds)
 
-    return seconds
+        return seconds
 
 
-# calculate how long it was ago
-def howlongago(seconds):
-    sec = time.time() - float(seconds)
+'''
+    Convert the various time definitions to a time in seconds from now
+'''
+def inseconds(when, nowst = None, seconds = None):
+    return timespec(when).inseconds(nowst, seconds)
+
+
+# calculate how long it was ago, from now if given
+def howlongago(seconds, now = None):
+    sec = (now if now is not None else time()) - float(seconds)
     if sec < 60:
-        value = sec
+        value = int(sec)
         unit = 'second'
     elif sec < 3600:
         value = int(sec / 60)
@@ -276,7 +414,7 @@ def howlongago(seconds):
         value = int(sec / 60 / 60 / 24 / 30)
         unit = 'month'
 
-    if value > 1: unit += 's'
+    if value != 1: unit += 's'
     return '{} {}'.format(value, unit)
 
 
@@ -309,6 +447,7 @@ if __name__ == "__main__":
     parser.add_argument("--daynames", type=str, nargs='+', help="Name of one or more days to match")
     parser.add_argument("--monthlist", type=int, nargs='+', help="One or more months to match, use day number in year")
     parser.add_argument("--monthnames", type=str, nargs='+', help="Name of one or more months to match")
+    parser.add_argument("--recurring", action='store_true', help="Skip the current period of a recurring definition")
     # randomize
     parser.add_argument("--randseconds", type=int, help="Number of seconds to randomly adjust the resulting time")
     parser.add_argument("--randminutes", type=int, help="Number of minutes to randomly adjust the resulting time")
@@ -319,8 +458,27 @@ if __name__ == "__main__":
         parser.print_help(sys.stderr)
         sys.exit(1)
 
+    parser.add_argument("--benchmark", action='store_true', help="Time matchtime against a compiled timespec for the definition")
+
     args = parser.parse_args()
 
+    if args.benchmark:
+        from timeit import timeit
+        when = dict((k, v) for k, v in vars(args).items() if v != None and k != 'benchmark')
+        if when.get('monthnames'): when['monthlist'] = convertmonthnames(when['monthnames'])
+        if when.get('daynames'): when['dowlist'] = convertdaynames(when['daynames'])
+        logger.setLevel('WARNING')
+        nowst = localtime()
+        spec = timespec(when)
+        mst, cst = matchtime(when, nowst), spec.nextmatch(nowst)
+        print 'matchtime:', mst and strftime("%a, %d %b %Y %H:%M:%S", tuple(mst))
+        print 'timespec: ', cst and strftime("%a, %d %b %Y %H:%M:%S", cst + (0, 0, -1))
+        number = 20
+        told = timeit(lambda: matchtime(when, nowst), number=number) / number
+        tnew = timeit(lambda: spec.nextmatch(nowst), number=number * 100) / (number * 100)
+        print 'matchtime: {:.1f} us timespec: {:.1f} us speedup: {:.0f}x'.format(told * 1e6, tnew * 1e6, told / tnew)
+        sys.exit(0)
+
     print 'Start:', time()
     print "Input:", vars(args) 
     seconds = inseconds(vars(args))
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This core library provides a compact, versioned binary encoding of events, to ship events between processes
+and to persist them.
+
+Batch layout, integers are little endian:
+    header - 'MCE', version (B), event count (I)
+    event  - flags (B), priority (B), unicode field mask (B), references for id, type, agent, user and emitter (5H),
+             body length (I), the bytes of new strings in that order and the body, then the typed data value,
+             the typed coalesce value if flagged and the typed priority value if it is not a priority class
+    A reference with the high bit set is a new string of that many bytes, which is added to the batch string table
+    (until it holds 32767 strings), otherwise it is the index of a string already in the table. The id, type,
+    emitter and so on repeat in most events, so they are sent once per batch, and the decoded events share one
+    string object for each.
+Typed values are a tag byte followed by:
+    N None, T True, F False
+    b int8 (b), i int64 (q), L an integer outside int64 as decimal digits (I length)
+    d float64 (d)
+    s bytes (I length), u unicode as utf-8 (I length), strings up to 64 bytes are added to the string table
+    r a string already in the string table, its index (H)
+    l list or t tuple - item count (I) and the items
+    m dict - item count (I) and the key, value pairs
+    e event - an encoded event
+Version 1 batches, without 'b' and 'r' values and with no value strings in the table, are still decoded.
+Decoding reads the buffer in place with unpack_from and memoryview slices, the buffer can be a str, bytearray or memoryview.
+"""
+from struct import Struct
+from logging import getLogger
+
+from lib.event import event
+from lib.eventqueue import PRIORITIES
+
+logger = getLogger(__name__)
+
+MAGIC = 'MCE'
+VERSION = 2
+# the versions decodebatch reads, version 1 has no 'b' and 'r' values and adds no value strings to the table
+VERSIONS = (1, 2)
+HEADER = Struct('<3sBI')
+EVENT = Struct('<BBB5HI')
+NEWSTRING = 0x8000
+MAXSTRING = 0x7fff
+SHORTSTRING = 64
+BYTE = Struct('<b')
+INDEX = Struct('<H')
+COUNT = Struct('<I')
+INT = Struct('<q')
+EMPTY = 'm' + COUNT.pack(0)
+FLOAT = Struct('<d')
+
+# event flags
+COALESCE = 1
+PRIORITYVALUE = 2
+AGENTEVENT = 4
+# priority byte, 0 for none
+PRIORITYCODE = dict((p, i + 1) for i, p in enumerate(PRIORITIES))
+PRIORITYNAME = (None, ) + PRIORITIES
+INTMIN, INTMAX = -2 ** 63, 2 ** 63 - 1
+
+""" Return an event encoded on its own, as a batch of one """
+def encode(e):
+    return encodebatch([e])
+
+""" Return the event encoded in buf """
+def decode(buf):
+    return decodebatch(buf)[0]
+
+""" Return the event if it can be encoded, a copy with its data as text if only its data cannot be, or None if
+    neither can be. Callers try to encode first and only fall back to this for the events that failed.
+"""
+def encodable(e):
+    try:
+        encodebatch([e])
+        return e
+    except (TypeError, ValueError):
+        pass
+    copy = e.__class__(e.id, e.body, e.type, e.agent, e.user, {'repr': repr(e.data)}, e.emitter, e.priority, e.coalesce)
+    try:
+        encodebatch([copy])
+        return copy
+    except (TypeError, ValueError) as error:
+        logger.error("Event dropped, it cannot be encoded: %s: %s", error, e.dump()[:200])
+        return None
+
+""" Return a typed value, such as event data, encoded on its own """
+def encodedata(value):
+    parts = list()
+    encodevalue(value, parts, dict())
+    return ''.join(parts)
+
+""" Return the typed value encoded in buf """
+def decodedata(buf):
+    return decodevalue(memoryview(buf), 0, list())[0]
+
+""" Return a list of events encoded as one batch """
+def encodebatch(events):
+    parts = [HEADER.pack(MAGIC, VERSION, len(events))]
+    table = dict()
+    for e in events:
+        encodeevent(e, parts, table)
+    return ''.join(parts)
+
+""" Return the list of events in an encoded batch """
+def decodebatch(buf):
+    magic, version, count = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError('Not an encoded event batch')
+    if version not in VERSIONS:
+        raise ValueError('Unsupported event encoding version {}'.format(version))
+    view = memoryview(buf)
+    offset = HEADER.size
+    events = list()
+    table = list()
+    short = SHORTSTRING if version > 1 else -1
+    for i in xrange(count):
+        e, offset = decodeevent(view, offset, table, short)
+        events.append(e)
+    return events
+
+""" Append the encoded event to parts, table maps the strings already sent in this batch to their index """
+def encodeevent(e, parts, table):
+    get = table.get
+    refs = list()
+    new = list()
+    text = 0
+    for f in (e.id, e.type, e.agent, e.user, e.emitter):
+        ref = get(f) if type(f) is str else None
+        if ref is None:
+            # unicode keys are kept apart from equal str keys
+            if type(f) is unicode:
+                ref = get((unicode, f))
+                key, b = (unicode, f), f.encode('utf-8')
+                text |= 1 << len(refs)
+            else:
+                key = b = str(f)
+                ref = get(key)
+            if ref is None:
+                if len(b) > MAXSTRING:
+                    raise ValueError('Event field longer than {} bytes'.format(MAXSTRING))
+                # only the index is sent for strings that are already in the table
+                if len(table) < MAXSTRING:
+                    table[key] = len(table)
+                ref = NEWSTRING | len(b)
+                new.append(b)
+        refs.append(ref)
+    body = e.eventbody()
+    if type(body) is not str:
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+            text |= 32
+        else:
+            body = str(body)
+    flags = AGENTEVENT if e.agentevent else 0
+    if e.coalesce is not None:
+        flags |= COALESCE
+    priority = PRIORITYCODE.get(e.priority, 0)
+    if not priority and e.priority is not None:
+        flags |= PRIORITYVALUE
+    parts.append(EVENT.pack(flags, priority, text, refs[0], refs[1], refs[2], refs[3], refs[4], len(body)))
+    if new:
+        parts.extend(new)
+    parts.append(body)
+    if e.data is None:
+        parts.append('N')
+    elif type(e.data) is dict and not e.data:
+        parts.append(EMPTY)
+    else:
+        encodevalue(e.data, parts, table)
+    if flags & COALESCE:
+        encodevalue(e.coalesce, parts, table)
+    if flags & PRIORITYVALUE:
+        encodevalue(e.priority, parts, table)
+
+""" Return the event at offset and the offset after it, table is the list of strings of this batch and short the
+    length up to which value strings are added to it
+"""
+def decodeevent(view, offset, table, short = SHORTSTRING):
+    flags, priority, text, rid, rtype, ragent, ruser, remitter, lbody = EVENT.unpack_from(view, offset)
+    offset += EVENT.size
+    fields = [rid, rtype, ragent, ruser, remitter]
+    for i, ref in enumerate(fields):
+        if ref & NEWSTRING:
+            n = ref & MAXSTRING
+            f = view[offset:offset + n].tobytes()
+            offset += n
+            if text & (1 << i):
+                f = f.decode('utf-8')
+            if len(table) < MAXSTRING:
+                table.append(f)
+            fields[i] = f
+        else:
+            fields[i] = table[ref]
+    body = view[offset:offset + lbody].tobytes()
+    offset += lbody
+    if text & 32:
+        body = body.decode('utf-8')
+    # fill the slots directly, the constructor would match the emitter again
+    e = event.__new__(event)
+    e.id, e.type, e.agent, e.user, e.emitter = fields
+    e.body = body
+    e.agentevent = bool(flags & AGENTEVENT)
+    e.priority = PRIORITYNAME[priority]
+    e.data, offset = decodevalue(view, offset, table, short)
+    e.coalesce = None
+    if flags & COALESCE:
+        e.coalesce, offset = decodevalue(view, offset, table, short)
+    if flags & PRIORITYVALUE:
+        e.priority, offset = decodevalue(view, offset, table, short)
+    return e, offset
+
+def encodevalue(value, parts, table):
+    t = type(value)
+    if t is str:
+        encodestring('s', value, value, parts, table)
+    elif t is int or t is long:
+        if -128 <= value <= 127:
+            parts.append('b' + BYTE.pack(value))
+        elif INTMIN <= value <= INTMAX:
+            parts.append('i' + INT.pack(value))
+        else:
+            digits = str(value)
+            parts.append('L' + COUNT.pack(len(digits)))
+            parts.append(digits)
+    elif t is dict:
+        parts.append('m' + COUNT.pack(len(value)))
+        for k, v in value.iteritems():
+            encodevalue(k, parts, table)
+            encodevalue(v, parts, table)
+    elif value is None:
+        parts.append('N')
+    elif t is bool:
+        parts.append('T' if value else 'F')
+    elif t is float:
+        parts.append('d' + FLOAT.pack(value))
+    elif t is unicode:
+        encodestring('u', (unicode, value), value.encode('utf-8'), parts, table)
+    elif t is list or t is tuple:
+        parts.append(('l' if t is list else 't') + COUNT.pack(len(value)))
+        for v in value:
+            encodevalue(v, parts, table)
+    elif isinstance(value, event):
+        parts.append('e')
+        encodeevent(value, parts, table)
+    else:
+        raise TypeError('Cannot encode {!r} in event data'.format(value))
+
+def encodestring(tag, key, b, parts, table):
+    if len(b) <= SHORTSTRING:
+        ref = table.get(key)
+        if ref is not None:
+            parts.append('r' + INDEX.pack(ref))
+            return
+        if len(table) < MAXSTRING:
+            table[key] = len(table)
+    parts.append(tag + COUNT.pack(len(b)))
+    parts.append(b)
+
+def decodevalue(view, offset, table, short = SHORTSTRING):
+    tag = view[offset]
+    offset += 1
+    if tag == 'r':
+        return table[INDEX.unpack_from(view, offset)[0]], offset + 2
+    if tag == 's' or tag == 'u':
+        n = COUNT.unpack_from(view, offset)[0]
+        offset += 4
+        value = view[offset:offset + n].tobytes()
+        if tag == 'u':
+            value = value.decode('utf-8')
+        if n <= short and len(table) < MAXSTRING:
+            table.append(value)
+        return value, offset + n
+    if tag == 'b':
+        return BYTE.unpack_from(view, offset)[0], offset + 1
+    if tag == 'i':
+        return INT.unpack_from(view, offset)[0], offset + 8
+    if tag == 'm':
+        n = COUNT.unpack_from(view, offset)[0]
+        offset += 4
+        value = dict()
+        for i in xrange(n):
+            k, offset = decodevalue(view, offset, table, short)
+            value[k], offset = decodevalue(view, offset, table, short)
+        return value, offset
+    if tag == 'N':
+        return None, offset
+    if tag == 'T':
+        return True, offset
+    if tag == 'F':
+        return False, offset
+    if tag == 'd':
+        return FLOAT.unpack_from(view, offset)[0], offset + 8
+    if tag == 'l' or tag == 't':
+        n = COUNT.unpack_from(view, offset)[0]
+        offset += 4
+        value = list()
+        for i in xrange(n):
+            v, offset = decodevalue(view, offset, table, short)
+            value.append(v)
+        return (value if tag == 'l' else tuple(value)), offset
+    if tag == 'L':
+        n = COUNT.unpack_from(view, offset)[0]
+        offset += 4
+        return int(view[offset:offset + n].tobytes()), offset + n
+    if tag == 'e':
+        return decodeevent(view, offset, table, short)
+    raise ValueError('Unknown value tag {!r} at offset {}'.format(tag, offset - 1))
+
+
+# MAIN #
+if __name__ == '__main__':
+    import sys
+    import json
+    import cPickle as pickle
+    from timeit import timeit
+
+    zwave = event.bind('agent.openzwave')
+    xmpp = event.bind('agent.xmpp_message')
+    """ Events like those the openzwave agent and its commands produce """
+    def zwavemix(count):
+        nodes = [('Thermostat - Hallway', 'Temperature', 71.6, 'F'), ('Dimmer - Livingroom', 'Level', 99, ''),
+                 ('RGB Light - Porch', 'Color Index', 'Cool White', ''), ('Sensor - Garage', 'Luminance', 312, 'lux'),
+                 ('Sensor - Garage', 'Battery Level', 87, '%')]
+        events = list()
+        for i in xrange(count):
+            node, label, value, units = nodes[i % len(nodes)]
+            if i % 10 == 9:
+                # a command handler event
+                events.append(event('openzwave', 'setValue', user='user1@DOMAIN', priority='high',
+                                    data={'node': node, 'name': label, 'value': value, 'args': ['porch', 'on']}))
+            elif i % 10 == 8:
+                events.append(xmpp('xmpp_message', u'Porch light on', 'usermessage', user=u'user1@DOMAIN'))
+            else:
+                events.append(zwave('openzwave', '{}: ValueChanged {} = {} {}'.format(node, label, value, units),
+                                    priority='low', coalesce=72057594109853697 + (i % len(nodes)) * 0x10000))
+        return events
+
+    if '--benchmark' in sys.argv:
+        count = 10000
+        events = zwavemix(count)
+        asjson = lambda es: json.dumps([dict(e.dict(), priority=e.priority, coalesce=e.coalesce) for e in es])
+        fromjson = lambda s: [event(d['id'], d['event'], d['type'], d['agent'], d['user'], d['data'], d['emitter'],
+                                    d['priority'], d['coalesce']) for d in json.loads(s)]
+        codecs = [('wire', encodebatch, decodebatch),
+                  ('pickle', lambda es: pickle.dumps(es, 2), pickle.loads),
+                  ('json', asjson, fromjson)]
+        print 'Batch of {} Z-Wave mix events:'.format(count)
+        for name, enc, dec in codecs:
+            buf = enc(events)
+            tenc = timeit(lambda: enc(events), number=5) / 5
+            tdec = timeit(lambda: dec(buf), number=5) / 5
+            print '{:8} {:6.1f} bytes/event  encode {:5.2f} us/event  decode {:5.2f} us/event'.format(
+                name, float(len(buf)) / count, tenc / count * 1e6, tdec / count * 1e6)
+        sys.exit(0)
+
+    for e in zwavemix(10) + [event('command-x', 'queue', 'command', data={'returnevent': event('reply', 'r', data={'x': [1, 2.5, None]})})]:
+        d = decode(encode(e))
+        print len(encode(e)), d.dump(), d.eventpriority(), d.eventcoalesce()
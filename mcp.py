@@ -14,24 +14,33 @@ Basic duties:
 """
 import sys, os
 import signal
-from time import sleep
-import yaml
+from time import sleep, time, strftime, localtime
 import importlib
-from Queue import Queue
-from threading import Thread, active_count, currentThread
+from threading import Thread, Lock, active_count, currentThread
 import logging
 
 # core modules
 from lib.command import command
+from lib.config import load as loadconfig
 #import lib.authorize
 #import lib.logic
 from lib.schedule import schedule
-#import lib.storage
-from lib.event import event
+from lib.storage import storage
+from lib.event import event, agentstatus
+from lib.mailbox import mailbox, loopmailbox
+from lib.eventloop import eventloop
+from lib.eventqueue import eventqueue
+from lib.agentprocess import agentprocess
+from lib.journal import journal
 
 # Global Variables
 CONFIG = dict()
 WORKERNUM = 2 
+BATCHSIZE = 32
+JOURNALLINES = 50
+STARTUPTIMEOUT = 60
+# mailbox overflow policy, 'block' would let one stuck agent stall dispatch to all of them
+OVERFLOW = 'dropold'
 
 """
     Main mastercontrol program class
@@ -44,35 +53,72 @@ class mcp:
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
         #FIXME add try fail on config load
-        with open('etc/mcp.conf', 'r') as confile:
-            global CONFIG    
-            CONFIG = yaml.load(confile)
+        global CONFIG
+        CONFIG = loadconfig('etc/mcp.conf')
 
         self.state = dict()
         self.state['agent'] = dict()
-        #self.storage = lib.storage(CONFIG['storage'], self.state)
-        self.eventqueue = Queue()
+        # restore the stored state before agents are loaded
+        self.storage = None
+        if CONFIG.get('storage', {}).get('enabled'):
+            self.storage = storage(CONFIG['storage'], self.state)
+            self.storage.restore()
+        self.eventqueue = eventqueue(CONFIG.get('core', {}).get('eventqueue', {}))
+        self.batchsize = CONFIG.get('core', {}).get('batch', BATCHSIZE)
+        # the event loop is the I/O reactor agents register file descriptors with, see getloop(),
+        # the 'loop' runtime also dispatches and delivers events from it
+        self.runloop = CONFIG.get('core', {}).get('runtime', 'threads') == 'loop'
+        self.draining = False
+        self.loop = eventloop(CONFIG.get('core', {}).get('workers', 4))
+        self.mailbox = dict()
         self.subscription = dict()
-        self.command = command(self.queueevent) # TODO: config?
-        #self.command = command(self.queueevent, CONFIG)
+        # serializes changes to the subscription tree with the rebuild of the routing index
+        self.routelock = Lock()
+        with self.routelock:
+            self.buildroutes()
+        # agent processes are forked before any thread starts, a lock held by another thread during the fork
+        # would stay held in the child
+        self.forkagents()
+        if self.storage is not None:
+            self.storage.start()
+        # record dispatched events when the journal is enabled
+        self.journal = None
+        if CONFIG.get('core', {}).get('journal', {}).get('enabled'):
+            self.journal = journal(CONFIG['core']['journal'])
+        self.loop.start()
+        self.command = command(self.queueevent, config=CONFIG.get('core', {}).get('command', {}))
+        self.command.add({ 'queue': { 'description': 'Show event queue depth by priority',
+                                      'authorized': 'ALL',
+                                      'handler': self.queuestatus } })
+        self.command.add({ 'journal': { 'description': 'Show journaled events of the last N minutes (default 10)',
+                                        'authorized': 'ALL',
+                                        'handler': self.journalshow } })
         self.scheduler = schedule(self.queueevent, CONFIG)
-        self.loadagents()
-        #TODO: return agent load result
 
-        # Create queue worker threads
-        for i in range(WORKERNUM):
-            t = Thread(target=self.dispatch)
-            t.daemon = True 
-            t.start()
+        # Create queue worker threads, agents subscribe and emit events while they start
+        if not self.runloop:
+            for i in range(WORKERNUM):
+                t = Thread(target=self.dispatch)
+                t.daemon = True 
+                t.start()
+        self.loadagents()
 
 
     def shutdown(self):
         logging.info("Shutdown started - Queue size: %i", self.eventqueue.qsize())
-        #res = self.storage.store()
         self.scheduler.removeall()
         # send shutdown event to all agents
-        self.eventqueue.put(event('shutdown'))
+        self.queueevent(event('shutdown', emitter='shutdown'))
         self.eventqueue.join()
+        for m in self.mailbox.values():
+            m.join()
+        for p in self.processes.values():
+            p.stop()
+        if self.storage is not None:
+            self.storage.store()
+        if self.journal is not None:
+            self.journal.close()
+        self.loop.stop()
         logging.info("Shutdown complete")
 
     def signal_handler(self, signum, frame):
@@ -81,28 +127,130 @@ class mcp:
         self.shutdown()
         sys.exit(0)  
 
-    """ Load enabled agents. 
-        On load we pass a dictionary with the agent config, agent state, and a callback for agent events.
-        On load agents return a load result and a callback to receive events (optional).
-        Agents subscribe to events by sending specific subscribe/unsubscribe events. """
-    def loadagents(self):
+    """ Fork a child process for each group of agents with a 'process' setting, grouped by its value, and create
+        the mailbox of every enabled agent. Called before the mcp starts any thread, so each group is forked first and
+        the threads reading the children are started after the last fork.
+    """
+    def forkagents(self):
         self.agent = dict()
-        logging.info("Loading Agents")
+        self.processes = dict()
+        self.enabled = list()
+        groups = dict()
         for agent in CONFIG['agent'].keys():
             if CONFIG['agent'][agent].has_key('enabled') and CONFIG['agent'][agent]['enabled'] == True:
                 pass
             else:
                 logging.info("%s - disabled, skipping", agent)
                 continue
+            self.enabled.append(agent)
+            if not self.state['agent'].has_key(agent): self.state['agent'][agent] = dict()
+            process = CONFIG['agent'][agent].get('process')
+            if process:
+                groups.setdefault(agent if process is True else str(process), list()).append(agent)
+        for group, agents in groups.items():
+            p = agentprocess(group, [(agent, CONFIG['agent'][agent]) for agent in agents],
+                             dict((agent, self.state['agent'][agent]) for agent in agents), self.queueevent,
+                             CONFIG.get('core', {}).get('process', {}).get('restart', 5), listen=False)
+            self.processes[group] = p
+            for agent in agents:
+                self.agent['agent.'+ agent] = p
+        for agent in self.enabled:
+            # the mailbox must exist before the agent subscribes, events are held until it is attached
+            self.mailbox['agent.'+ agent] = self.newmailbox(agent, None)
+            p = self.agent.get('agent.'+ agent)
+            if p is not None:
+                self.mailbox['agent.'+ agent].attach(p.proxy(agent))
+        for p in self.processes.values():
+            p.listen()
 
+    """ Load enabled agents. 
+        On load we pass a dictionary with the agent config, agent state, and a callback for agent events.
+        On load agents return a load result and a callback to receive events (optional).
+        Agents subscribe to events by sending specific subscribe/unsubscribe events.
+        Agents are started concurrently, each on its own thread, and emit a 'ready' or 'failed' event once started.
+        Waits up to the core 'startup' timeout for all of them, agents still starting then carry on in the background.
+        Agents hosted in a child process and the mailboxes of all agents were created by forkagents().
+    """
+    def loadagents(self):
+        local = [ agent for agent in self.enabled if 'agent.'+ agent not in self.agent ]
+        start = time()
+        logging.info("Loading Agents")
+        threads = list()
+        for agent in local:
+            t = Thread(name='start-'+ agent, target=self.startagent, args=(agent, ))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        deadline = start + CONFIG.get('core', {}).get('startup', STARTUPTIMEOUT)
+        for t in threads:
+            t.join(max(deadline - time(), 0))
+        starting = [ t.name[6:] for t in threads if t.is_alive() ]
+        if starting:
+            logging.warning("Agents still starting after %.3f seconds: %s", time() - start, ', '.join(starting))
+        logging.info("Agents loaded in %.3f seconds", time() - start)
+
+    """ Import and create a local agent and attach it to its mailbox, runs on a startup thread """
+    def startagent(self, agent):
+        start = time()
+        try:
             logging.info("%s - importing", 'agent.'+ agent)
             amod = importlib.import_module('agent.'+ agent)
             logging.info("%s - imported", agent)
+            # events created by the agent module carry its identity as the emitter
+            if getattr(amod, 'event', None) is event:
+                amod.event = event.bind('agent.'+ agent)
             
-            if not self.state['agent'].has_key(agent): self.state['agent'][agent] = dict()
-            self.agent['agent.'+ agent] = getattr(amod, agent)(CONFIG['agent'][agent], self.state['agent'][agent], self.queueevent)
-            logging.info("%s - instance created", agent)
+            instance = getattr(amod, agent)(CONFIG['agent'][agent], self.state['agent'][agent], self.queueevent)
+        except Exception as e:
+            logging.exception("%s - failed to start after %.3f seconds", agent, time() - start)
+            # events sent to the agent are discarded
+            self.mailbox['agent.'+ agent].attach(lambda e: None)
+            self.queueevent(agentstatus(agent, time() - start, str(e)))
+            return
+        self.agent['agent.'+ agent] = instance
+        self.mailbox['agent.'+ agent].attach(instance.eventhandler)
+        logging.info("%s - ready in %.3f seconds", agent, time() - start)
+        self.queueevent(agentstatus(agent, time() - start))
+
+    """ Create the mailbox events are delivered to an agent through.
+        Size and overflow policy come from the agent 'mailbox' config, defaulting to the core 'mailbox' config.
+    """
+    def newmailbox(self, agent, handler):
+        mconf = dict(CONFIG.get('core', {}).get('mailbox', {}))
+        mconf.update(CONFIG['agent'].get(agent, {}).get('mailbox', {}))
+        if self.runloop:
+            return loopmailbox('agent.'+ agent, handler, self.loop, mconf.get('size', 0), mconf.get('overflow', OVERFLOW),
+                               CONFIG.get('core', {}).get('eventqueue', {}))
+        return mailbox('agent.'+ agent, handler, mconf.get('size', 0), mconf.get('overflow', OVERFLOW),
+                       CONFIG.get('core', {}).get('eventqueue', {}))
             
+    """ Command handler, report the event queue depth by priority class """
+    def queuestatus(self, args):
+        msg = str()
+        for s in self.eventqueue.stats():
+            msg += "{:10} depth: {} max: {} queued: {}\n".format(s['priority'], s['depth'], s['maxdepth'], s['queued'])
+        return msg
+
+    """ Command handler, show the events journaled in the last N minutes, the most recent last """
+    def journalshow(self, args):
+        if self.journal is None:
+            return "The journal is not enabled"
+        try:
+            minutes = float(args[0]) if args else 10
+        except ValueError:
+            return "Error: minutes must be a number"
+        lines = [ "{} {:20} {}".format(strftime('%H:%M:%S', localtime(t)), e.eventemitter(), e.eventbody())
+                  for t, e in self.journal.events(time() - minutes * 60) if e.eventtype() != 'subscribe' ]
+        if len(lines) > JOURNALLINES:
+            lines = ["... {} earlier events".format(len(lines) - JOURNALLINES)] + lines[-JOURNALLINES:]
+        return "\n".join(lines)
+
+    """ Replay journaled message events between start and end (seconds since the epoch) through the event queue.
+        Subscriptions and commands are not replayed.
+    """
+    def replay(self, start = None, end = None):
+        return self.journal.replay(self.queueevent, start, end, ('message', 'usermessage'))
+
     """ Events are queued by this function, and then processed by the dispatch thread. 
         Used as a callback by agents that emit events. 
     """
@@ -110,8 +258,14 @@ class mcp:
         #logging.debug("Queueevent - event: %s", event.dump()) 
         #TODO: check permissions
         self.eventqueue.put(event)
+        if self.runloop and not self.draining:
+            self.draining = True
+            self.loop.call_soon(self.drain)
 
     """ Loop, processing queued events, dispatching events to subscribers.
+        Up to BATCHSIZE queued events are taken at a time, subscribers are looked up once per
+        emitter and event id in the batch, and of coalescable events with the same emitter, id
+        and coalesce key only the newest is delivered.
         Special event ids:
             subscribe - subscribe to an event
             unsubscribe - unsubscribe from an event
@@ -122,70 +276,144 @@ class mcp:
         logging.debug("Dispatch starting - Queue size: %i", self.eventqueue.qsize())
       
         while True:
-            e = self.eventqueue.get()
+            events = self.eventqueue.getmany(self.batchsize)
             #logging.debug("Dispatch task started - thread: %s", currentThread().getName())
-            if e.eventtype() == 'subscribe':
-                self.subscribe(e)
-                logging.debug("Dispatch subscribe done")
-            elif e.eventtype() == 'unsubscribe':
-                self.unsubscribe(e)
-                logging.debug("Dispatch unsubscribe done")
-            elif e.eventtype() == 'command':
-                self.command.event(e)
-                logging.debug("Dispatch command handler called for event: {}".format(e.dump()))
-            else:
-                logging.debug("Dispatch calling hanlder for event: {}".format(e.dump()))
-           
-                for subscriber, handler in self.subscribers(e).iteritems():
-                    logging.debug("Dispatch calling handler for subscirber: %s", subscriber)
-                    handler(e)
-                    logging.debug("Dispatch handler done")
-            self.eventqueue.task_done()
+            self.dispatchbatch(events)
             #logging.debug("Dispatch task done - thread: %s queue size: %i", currentThread().getName(), self.eventqueue.qsize())
         logging.warning("XXXXXXXXX Dispatch done - Queue size: %i", self.eventqueue.qsize())
 
+    """ Dispatch queued events from the event loop, used instead of dispatch threads by the 'loop' runtime """
+    def drain(self):
+        self.draining = False
+        events = self.eventqueue.getmany(self.batchsize, False)
+        if events:
+            self.dispatchbatch(events)
+        # let other callbacks run between batches
+        if self.eventqueue.qsize() and not self.draining:
+            self.draining = True
+            self.loop.call_soon(self.drain)
+
+    """ Dispatch a batch of events taken from the event queue """
+    def dispatchbatch(self, events):
+        try:
+            if self.journal is not None:
+                try:
+                    self.journal.append(events)
+                except Exception:
+                    logging.exception("Dispatch could not journal a batch of %i events", len(events))
+            newest = dict()
+            for i, e in enumerate(events):
+                if e.eventcoalesce() is not None:
+                    newest[(e.eventemitter(), e.eventid(), e.eventcoalesce())] = i
+            routes = dict()
+            coalesced = 0
+
+            for i, e in enumerate(events):
+                if e.eventcoalesce() is not None and newest[(e.eventemitter(), e.eventid(), e.eventcoalesce())] != i:
+                    coalesced += 1
+                    continue
+                # a failing event is logged, the rest of the batch is still dispatched
+                try:
+                    if e.eventtype() == 'subscribe':
+                        self.subscribe(e)
+                        routes.clear()
+                        logging.debug("Dispatch subscribe done")
+                    elif e.eventtype() == 'unsubscribe':
+                        self.unsubscribe(e)
+                        routes.clear()
+                        logging.debug("Dispatch unsubscribe done")
+                    elif e.eventtype() == 'command':
+                        # command handlers run on the command pool, not on this thread
+                        self.command.event(e)
+                        logging.debug("Dispatch command handler called for event: %s", e)
+                    else:
+                        key = (e.eventemitter(), e.eventid())
+                        subs = routes.get(key)
+                        if subs is None:
+                            subs = routes[key] = self.subscribers(e)
+                        for subscriber, mbox in subs:
+                            mbox.put(e)
+                except Exception:
+                    logging.exception("Dispatch failed for event: %s", e.dump())
+            if len(events) > 1:
+                logging.debug("Dispatch batch done - events: %i coalesced: %i", len(events), coalesced)
+        finally:
+            self.eventqueue.task_done(len(events))
+
     """ Process subscribe events """
     def subscribe(self, event):
         logging.debug("Subscribe - event: %s", event.dump())
-        if not self.subscription.has_key(event.eventagent()):
-            self.subscription[event.eventagent()] = dict()
-        if not self.subscription[event.eventagent()].has_key(event.eventid()):
-            self.subscription[event.eventagent()][event.eventid()] = dict()
-        self.subscription[event.eventagent()][event.eventid()][event.eventemitter()] = self.agent[event.eventemitter()].eventhandler 
+        if not self.mailbox.has_key(event.eventemitter()):
+            logging.error("Subscribe from '%s', which is not an agent, to event '%s' ignored", event.eventemitter(),
+                          event.eventid())
+            return
+        with self.routelock:
+            if not self.subscription.has_key(event.eventagent()):
+                self.subscription[event.eventagent()] = dict()
+            if not self.subscription[event.eventagent()].has_key(event.eventid()):
+                self.subscription[event.eventagent()][event.eventid()] = dict()
+            self.subscription[event.eventagent()][event.eventid()][event.eventemitter()] = self.mailbox[event.eventemitter()]
+            self.buildroutes()
 
     """ Process unsubsribe events """
     def unsubscribe(self, event):         
         logging.debug("Unsubscribe - event: %s", event.dump())
-        try:
-            del self.subscription[event.eventagent()][event.eventid()][event.eventemitter()]
-        except KeyError:
-            logging.error("Agent '%s' is not subscribed to event '%s'", event.eventagent(), event.eventid())
+        with self.routelock:
+            try:
+                del self.subscription[event.eventagent()][event.eventid()][event.eventemitter()]
+            except KeyError:
+                logging.error("Agent '%s' is not subscribed to event '%s'", event.eventagent(), event.eventid())
+                return
+            self.buildroutes()
 
-    """ Return a list of subscriibers to an event """
+    """ Rebuild the routing index from the subscription tree.
+        The index maps (emitter, eventid) to an immutable tuple of (subscriber, mailbox) pairs.
+        A None emitter or eventid stands for any emitter or event id not named in a subscription.
+        The emitters and the index are swapped in as one tuple so dispatch threads never see a partial index.
+        Called with the route lock held, so a rebuild never reads a tree another thread is changing.
+    """
+    def buildroutes(self):
+        subs = self.subscription
+        emitters = set(k for k in subs if k != 'ALL')
+        eventids = set()
+        for byid in subs.itervalues():
+            for eventid, subscribers in byid.iteritems():
+                if eventid != 'ALL': eventids.add(eventid)
+                # subscribers are also emitters, their own events must not be sent back to them
+                emitters.update(subscribers)
+
+        def resolve(emitter, eventid):
+            found = dict()
+            if subs.has_key('ALL'):
+                found.update(subs['ALL'].get('ALL', {}))
+                if eventid is not None:
+                    found.update(subs['ALL'].get(eventid, {}))
+                # avoid sending events to the event emitter
+                found.pop(emitter, None)
+            if emitter is not None and subs.has_key(emitter):
+                found.update(subs[emitter].get('ALL', {}))
+                if eventid is not None:
+                    found.update(subs[emitter].get(eventid, {}))
+            return tuple(sorted(found.iteritems()))
+
+        routes = dict()
+        for emitter in emitters | set([None]):
+            for eventid in eventids | set([None]):
+                routes[(emitter, eventid)] = resolve(emitter, eventid)
+        self.routing = (frozenset(emitters), routes)
+        logging.debug("Routes rebuilt: %i emitters, %i event ids", len(emitters), len(eventids))
+
+    """ Return a tuple of (subscriber, mailbox) pairs for an event """
     def subscribers(self, event):         
-        #logging.debug("Subscribers - event: %s", event.dump())
-        #print "GOT HERE0:", self.subscription
-        subs = dict()
-        if self.subscription.has_key('ALL'):
-            if self.subscription['ALL'].has_key('ALL'):
-                #print "GOT HERE1 - ALL-ALL"
-                subs.update(self.subscription['ALL']['ALL'])
-            if self.subscription['ALL'].has_key(event.eventid()):
-                #print "GOT HERE2 - ALL-eventid"
-                subs.update(self.subscription['ALL'][event.eventid()])
-            # avoid sending events to the event emitter
-            if subs.has_key(event.eventemitter()): 
-                #print "\tRemoving emitter:", event.eventemitter() 
-                del subs[event.eventemitter()]
-        if self.subscription.has_key(event.eventemitter()):
-            if self.subscription[event.eventemitter()].has_key('ALL'):
-                #print "GOT HERE3 - eventemitter-ALL"
-                subs.update(self.subscription[event.eventemitter()]['ALL'])
-            if self.subscription[event.eventemitter()].has_key(event.eventid()):
-                #print "GOT HERE4 - eventemitter-eventid"
-                subs.update(self.subscription[event.eventemitter()][event.eventid()])
-        
-        logging.debug("Subscribers found: %i", len(subs))
+        emitters, routes = self.routing
+        emitter = event.eventemitter()
+        subs = routes.get((emitter, event.eventid()))
+        if subs is None:
+            if emitter in emitters:
+                subs = routes[(emitter, None)]
+            else:
+                subs = routes.get((None, event.eventid()))
+                if subs is None: subs = routes[(None, None)]
         return subs
 
     """